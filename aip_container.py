@@ -0,0 +1,126 @@
+from datetime import datetime
+from pathlib import Path
+import hashlib
+import os
+
+import fixity
+import io_scheduler
+import metrics
+
+
+CONTAINER_FORMATS = ('zip', 'tar')
+# Range of the MS-DOS dates of ZIP entries - modification times outside it are clamped
+ZIP_DATE_TIME_RANGE = ((1980, 1, 1, 0, 0, 0), (2107, 12, 31, 23, 59, 58))
+
+
+def zip_date_time(timestamp:float) -> tuple:
+    # A valid SIP can hold files older than 1980, which zipfile.ZipInfo would reject
+    earliest, latest = ZIP_DATE_TIME_RANGE
+    return min(max(datetime.fromtimestamp(timestamp).timetuple()[:6], earliest), latest)
+
+
+class _HashingReader:
+    # File wrapper that hashes everything read through it, for tarfile.addfile
+    def __init__(self, f, hasher):
+        self.f = f
+        self.hasher = hasher
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        # Everything read is written to the container as is
+        io_scheduler.read(len(data))
+        io_scheduler.write(len(data))
+        self.hasher.update(data)
+        return data
+
+
+class ContainerWriter:
+    # Writes an AIP straight into a ZIP or TAR container, hashing each file as it is streamed in
+    # compress=False stores members uncompressed (for already-compressed preservation zips)
+
+    def __init__(self, container_path:Path, container_format:str='zip', compress:bool=True, zip64:bool=True):
+        if container_format not in CONTAINER_FORMATS:
+            raise ValueError("Unknown container format '%s'" % container_format)
+        self.container_path = Path(container_path)
+        self.container_format = container_format
+        self.zip64 = zip64
+        # Written under a temporary name and renamed once complete
+        self.partial_path = self.container_path.with_name(self.container_path.name + '.partial')
+        if container_format == 'zip':
+            # zipfile and tarfile are imported only for the container written - they add to every script's start-up otherwise
+            import zipfile
+            self.archive = zipfile.ZipFile(self.partial_path, 'w', compression=zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED, allowZip64=zip64)
+        else:
+            import tarfile
+            self.archive = tarfile.open(self.partial_path, 'w', format=tarfile.PAX_FORMAT)
+        self.files_written = 0
+        self.bytes_written = 0
+
+    def add_file(self, source_path:Path, arcname:str) -> tuple[int, str]:
+        # Stream one file into the container, returns (size, sha256)
+        hasher = hashlib.sha256()
+        if self.container_format == 'zip':
+            import zipfile
+            stat = os.stat(source_path)
+            zinfo = zipfile.ZipInfo(arcname, date_time=zip_date_time(stat.st_mtime))
+            zinfo.compress_type = self.archive.compression
+            zinfo.external_attr = (stat.st_mode & 0xFFFF) << 16
+            zinfo.file_size = stat.st_size
+            buffer = bytearray(min(fixity.BUFFER_SIZE, stat.st_size + 1))
+            view = memoryview(buffer)
+            with io_scheduler.large_operation(stat.st_size), open(source_path, 'rb') as src, \
+                    self.archive.open(zinfo, 'w', force_zip64=self.zip64 and stat.st_size > zipfile.ZIP64_LIMIT) as dest:
+                io_scheduler.advise_sequential(src.fileno(), stat.st_size)
+                for read in iter(lambda: src.readinto(buffer), 0):
+                    # Writes are charged uncompressed
+                    io_scheduler.read(read)
+                    io_scheduler.write(read)
+                    hasher.update(view[:read])
+                    dest.write(view[:read])
+                io_scheduler.advise_done(src.fileno(), stat.st_size)
+            size = stat.st_size
+        else:
+            tarinfo = self.archive.gettarinfo(str(source_path), arcname)
+            with io_scheduler.large_operation(tarinfo.size), open(source_path, 'rb') as src:
+                io_scheduler.advise_sequential(src.fileno(), tarinfo.size)
+                self.archive.addfile(tarinfo, _HashingReader(src, hasher))
+                io_scheduler.advise_done(src.fileno(), tarinfo.size)
+            size = tarinfo.size
+        self.files_written += 1
+        self.bytes_written += size
+        metrics.add('files_packaged')
+        metrics.add('bytes_packaged', size)
+        return size, hasher.hexdigest()
+
+    def add_directory(self, arcname:str):
+        arcname = arcname.rstrip('/') + '/'
+        if self.container_format == 'zip':
+            import zipfile
+            zinfo = zipfile.ZipInfo(arcname, date_time=datetime.now().timetuple()[:6])
+            zinfo.external_attr = (0o40755 << 16) | 0x10
+            self.archive.writestr(zinfo, b'')
+        else:
+            import tarfile
+            tarinfo = tarfile.TarInfo(arcname)
+            tarinfo.type = tarfile.DIRTYPE
+            tarinfo.mode = 0o755
+            tarinfo.mtime = int(datetime.now().timestamp())
+            self.archive.addfile(tarinfo)
+
+    def close(self):
+        self.archive.close()
+        os.replace(self.partial_path, self.container_path)
+
+    def abort(self):
+        self.archive.close()
+        if self.partial_path.exists():
+            self.partial_path.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
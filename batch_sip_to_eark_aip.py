@@ -0,0 +1,164 @@
+from datetime import datetime
+from multiprocessing import Pool
+from pathlib import Path
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+from aip_container import CONTAINER_FORMATS
+from ingest import INGEST_STRATEGIES
+import io_scheduler
+import metrics
+from sip_to_eark_aip import LOG_DIRECTORY, AIPError, configure_logging, new_uuid, transform_sip_to_aip, validate_input_directories
+
+
+def read_manifest(manifest_path:Path) -> list[Path]:
+    # One SIP path per line, blank lines and '#' comments are ignored
+    # Relative paths are resolved against the manifest's directory
+    sip_paths = []
+    for line in manifest_path.read_text(encoding='utf-8').splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        sip_path = Path(line)
+        if not sip_path.is_absolute():
+            sip_path = (manifest_path.parent / sip_path)
+        sip_paths.append(sip_path)
+    return sip_paths
+
+
+def collect_sip_paths(source_path:Path, output_path:Path=None) -> list[Path]:
+    # A directory of SIPs or a manifest file listing SIP directories
+    if source_path.is_dir():
+        # Hidden directories, the logs directory and an output directory inside the source aren't SIPs
+        skipped = {LOG_DIRECTORY.resolve()}
+        if output_path is not None:
+            skipped.add(output_path.resolve())
+        return sorted(p for p in source_path.iterdir() if p.is_dir() and not p.name.startswith('.') and p.resolve() not in skipped)
+    if source_path.is_file():
+        return read_manifest(source_path)
+    raise FileNotFoundError(str(source_path) + " not found")
+
+
+def init_worker():
+    configure_logging()
+    # Opens the worker's own handles on the shared I/O scheduler state - flock doesn't separate handles inherited over fork
+    io_scheduler.configure_from_environment()
+
+
+def convert_sip(job:tuple[Path, Path, str, dict]) -> dict:
+    # Runs in a pool worker - every failure, an AIPError for an invalid SIP or anything unexpected, is caught
+    # and reported so that one bad SIP can't take down the rest of the batch
+    sip_path, output_path, aip_name, transform_options = job
+    result = {
+        'sip': str(sip_path),
+        'aip': aip_name,
+        'status': 'failed',
+        'error': None,
+        'started': datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+        'duration_seconds': None,
+    }
+    start = time.perf_counter()
+    metrics.enable_from_environment('sip_to_eark_aip', sip=str(sip_path), aip=aip_name)
+    try:
+        sip_path, output_path, sip_inventory = validate_input_directories(sip_path, output_path)
+        transform_sip_to_aip(sip_path, output_path, aip_name, sip_inventory=sip_inventory, **transform_options)
+        result['status'] = 'converted'
+    except AIPError as e:
+        logging.error("Conversion of '%s' failed: %s" % (sip_path, e))
+        result['error'] = 'Fatal Error: ' + str(e)
+    except SystemExit as e:
+        result['error'] = str(e.code)
+    except Exception as e:
+        logging.exception("Conversion of '%s' failed" % sip_path)
+        result['error'] = "%s: %s" % (type(e).__name__, e)
+    finally:
+        metrics.disable()
+    result['duration_seconds'] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def run_batch(sip_paths:list[Path], output_path:Path, workers:int=None, max_sips_per_worker:int=None, transform_options:dict=None) -> dict:
+    # AIP names are assigned up front so failed conversions can still be traced to their output
+    # transform_options are passed on to transform_sip_to_aip as keyword arguments
+    jobs = [(sip_path, output_path, new_uuid(), transform_options or {}) for sip_path in sip_paths]
+    results = []
+    start = time.perf_counter()
+    # Workers are recycled after max_sips_per_worker SIPs to bound their memory growth
+    with Pool(processes=workers, initializer=init_worker, maxtasksperchild=max_sips_per_worker) as pool:
+        for result in pool.imap_unordered(convert_sip, jobs, chunksize=1):
+            logging.info("%s '%s' -> '%s'" % (result['status'], result['sip'], result['aip']))
+            results.append(result)
+    results.sort(key=lambda r: r['sip'])
+    return {
+        'output': str(output_path),
+        'total': len(results),
+        'converted': sum(1 for r in results if r['status'] == 'converted'),
+        'failed': sum(1 for r in results if r['status'] != 'converted'),
+        'duration_seconds': round(time.perf_counter() - start, 3),
+        'sips': results,
+    }
+
+
+def main(argv) -> dict:
+    configure_logging()
+
+    parser = argparse.ArgumentParser(prog='batch_sip_to_eark_aip.py', description="Convert many SIPs to E-ARK AIPs in parallel")
+    parser.add_argument('source', help="Directory of SIP directories, or a manifest file with one SIP path per line")
+    parser.add_argument('output', help="Output directory for the AIPs")
+    parser.add_argument('--workers', type=int, default=None, help="Number of worker processes (default: CPU count)")
+    parser.add_argument('--max-sips-per-worker', type=int, default=None, help="Replace a worker process after it has converted this many SIPs")
+    parser.add_argument('--ingest', choices=INGEST_STRATEGIES, default='copy', help="How SIP files are brought into the AIPs (default: copy)")
+    parser.add_argument('--container', choices=CONTAINER_FORMATS, default=None, help="Write each AIP as a single ZIP or TAR file")
+    parser.add_argument('--store', action='store_true', help="Store ZIP members without compression")
+    parser.add_argument('--no-zip64', action='store_true', help="Refuse to write ZIP64 extensions")
+    parser.add_argument('--inventory', action='store_true', help="List every payload file with a fresh size and checksum in the rep METS")
+    parser.add_argument('--summary', default=None, help="Path of the JSON summary (default: <output>/batch-summary.json)")
+    parser.add_argument('--metrics-json', default=None, help="Append per-stage metrics of every SIP as JSON lines to this file")
+    parser.add_argument('--metrics-textfile', default=None, help="Write per-stage metrics of the last converted SIP to this Prometheus textfile")
+    io_scheduler.add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    # Workers pick the metrics outputs up from their inherited environment
+    if args.metrics_json:
+        os.environ[metrics.JSON_ENVIRONMENT_VARIABLE] = str(Path(args.metrics_json).resolve())
+    if args.metrics_textfile:
+        os.environ[metrics.TEXTFILE_ENVIRONMENT_VARIABLE] = str(Path(args.metrics_textfile).resolve())
+
+    output_path = Path(args.output)
+    if output_path.exists() and not output_path.is_dir():
+        logging.error("Output destination must be a directory")
+        sys.exit("Fatal Error: Output destination must be a directory")
+    try:
+        sip_paths = collect_sip_paths(Path(args.source), output_path)
+    except FileNotFoundError as e:
+        logging.error(e)
+        sys.exit('Fatal Error: ' + str(e))
+
+    # The I/O budgets are shared by all workers, through state files in the output directory
+    output_path.mkdir(parents=True, exist_ok=True)
+    io_scheduler.apply_arguments(args, (output_path / io_scheduler.SCHEDULER_DIRECTORY))
+
+    transform_options = {
+        'ingest_strategy': args.ingest,
+        'container_format': args.container,
+        'compress': not args.store,
+        'zip64': not args.no_zip64,
+        'payload_inventory': args.inventory,
+    }
+    summary = run_batch(sip_paths, output_path, args.workers, args.max_sips_per_worker, transform_options)
+
+    summary_path = Path(args.summary) if args.summary else (output_path / 'batch-summary.json')
+    summary_path.parent.mkdir(parents=True, exist_ok=True)
+    summary_path.write_text(json.dumps(summary, indent=4), encoding='utf-8')
+    logging.info("Batch summary written to '%s'" % summary_path)
+    return summary
+
+
+if __name__ == '__main__':
+    summary = main(sys.argv[1:])
+    print("%d converted, %d failed" % (summary['converted'], summary['failed']))
+    sys.exit(1 if summary['failed'] else 0)
@@ -0,0 +1,448 @@
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+import argparse
+import json
+import logging
+import os
+import platform
+import re
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+from generate_sip import METS_NAMESPACES, SCHEMA_LOCATION, generate_sip
+import create_preservation_mets
+from mets_stream import stream_update_mets
+import sip_to_eark_aip
+import xml_backend
+
+
+REPORT_VERSION = 1
+# Differences below these are treated as noise when comparing reports
+MIN_SECONDS = 0.05
+MIN_STARTUP_SECONDS = 0.01
+MIN_RSS_KB = 4096
+
+SCRIPT_DIRECTORY = Path(__file__).resolve().parent
+# Command lines timed by --startup, each in a fresh interpreter: (stage, arguments to python)
+STARTUP_COMMANDS = [
+    ('startup/sip_to_eark_aip --help', [str(SCRIPT_DIRECTORY / 'sip_to_eark_aip.py'), '--help']),
+    ('startup/create_preservation_mets --help', [str(SCRIPT_DIRECTORY / 'create_preservation_mets.py'), '--help']),
+    ('startup/batch_sip_to_eark_aip --help', [str(SCRIPT_DIRECTORY / 'batch_sip_to_eark_aip.py'), '--help']),
+    ('startup/import eark_aip', ['-c', 'import eark_aip']),
+]
+# Element counts of the METS rewritten by --mets-scaling, and how many times its cheapest cost per element
+# a rewriter may spend per element at any size before it counts as growing faster than linearly
+METS_SCALING_SIZES = [1000, 10000, 100000, 1000000]
+MAX_SCALING_RATIO = 2.0
+
+
+def _proc_status_kb(field:str) -> int:
+    try:
+        with open('/proc/self/status') as f:
+            return int(re.search(field + r':\s+(\d+)', f.read()).group(1))
+    except (OSError, AttributeError):
+        return None
+
+
+def peak_rss_kb() -> int:
+    # High-water mark of resident memory: since the last reset_peak_rss where Linux allows it, else since start
+    peak = _proc_status_kb('VmHWM')
+    return peak if peak is not None else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def rss_kb() -> int:
+    # Memory freed by an earlier stage usually stays resident, so each stage also records what it started with
+    return _proc_status_kb('VmRSS') or 0
+
+
+def reset_peak_rss() -> bool:
+    # Writing 5 to clear_refs resets VmHWM (Linux 4.0+), giving every stage its own peak
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+class StageTimer:
+    # Collects wall time, CPU time and peak RSS of each named stage of one run
+
+    def __init__(self):
+        self.stages = {}
+        self.per_stage_rss = True
+
+    @contextmanager
+    def measure(self, stage:str):
+        self.per_stage_rss = reset_peak_rss() and self.per_stage_rss
+        rss_start = rss_kb()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            self.stages[stage] = {
+                'wall_seconds': time.perf_counter() - wall_start,
+                'cpu_seconds': time.process_time() - cpu_start,
+                'start_rss_kb': rss_start,
+                'peak_rss_kb': peak_rss_kb(),
+            }
+
+    @contextmanager
+    def wrap(self, module, function_names:list, prefix:str):
+        # Time module level functions in place, so the real pipeline code runs unchanged
+        originals = {name: getattr(module, name) for name in function_names}
+
+        def timed(name, function):
+            def wrapper(*args, **kwargs):
+                with self.measure(prefix + name):
+                    return function(*args, **kwargs)
+            return wrapper
+
+        for name, function in originals.items():
+            setattr(module, name, timed(name, function))
+        try:
+            yield
+        finally:
+            for name, function in originals.items():
+                setattr(module, name, function)
+
+    @contextmanager
+    def wrap_stages(self, prefix:str):
+        # transform_sip_to_aip runs every stage through run_stage, so wrapping it times each one
+        run_stage = sip_to_eark_aip.run_stage
+
+        def timed_run_stage(journal, stage, function, *args):
+            with self.measure(prefix + stage):
+                run_stage(journal, stage, function, *args)
+
+        sip_to_eark_aip.run_stage = timed_run_stage
+        try:
+            yield
+        finally:
+            sip_to_eark_aip.run_stage = run_stage
+
+
+def add_preservation_rep(aip_path:Path, files:int) -> Path:
+    # Package the first data files of rep01 into the empty rep01-preservation the transformation created
+    source_files = sorted((aip_path / 'representations' / 'rep01' / 'data').iterdir())[:files]
+    rep_path = (aip_path / 'representations' / 'rep01-preservation')
+    with zipfile.ZipFile((rep_path / 'data' / 'preservation.zip'), 'w', compression=zipfile.ZIP_STORED) as archive:
+        for source_file in source_files:
+            archive.write(source_file, source_file.name)
+    return rep_path
+
+
+def run_once(sip_path:Path, work_path:Path, options:dict, run_number:int) -> dict:
+    timer = StageTimer()
+    output_path = (work_path / ('output-%d' % run_number))
+    output_path.mkdir()
+    if options['ingest_strategy'] == 'move':
+        # move consumes its SIP, so every run gets its own copy
+        run_sip_path = (work_path / ('sip-%d' % run_number) / sip_path.name)
+        shutil.copytree(sip_path, run_sip_path)
+        sip_path = run_sip_path
+    run_start = time.perf_counter()
+
+    with timer.measure('transform/validate_input_directories'):
+        sip_path, output_path, sip_inventory = sip_to_eark_aip.validate_input_directories(sip_path, output_path)
+    with timer.wrap_stages('transform/'):
+        aip_name = sip_to_eark_aip.transform_sip_to_aip(sip_path, output_path, 'aip', options['ingest_strategy'], options['container_format'],
+                                                        payload_inventory=options['payload_inventory'], sip_inventory=sip_inventory)['aip']
+
+    if options['container_format'] is None and options['preservation_files']:
+        rep_path = add_preservation_rep((output_path / aip_name), options['preservation_files'])
+        with timer.wrap(create_preservation_mets, ['validate_input_directory', 'create_preservation_mets', 'update_root_mets'], 'preservation/'):
+            create_preservation_mets.main([str(rep_path)])
+
+    total_seconds = time.perf_counter() - run_start
+    shutil.rmtree(output_path)
+    return {'stages': timer.stages, 'total_seconds': total_seconds, 'per_stage_rss': timer.per_stage_rss}
+
+
+def time_command(arguments:list, cwd:Path) -> dict:
+    # Wall and CPU time of one python child process - its exit status doesn't matter
+    # Memory isn't measured: Linux carries the parent's RSS at fork over into the child's ru_maxrss
+    environment = dict(os.environ, PYTHONPATH=str(SCRIPT_DIRECTORY))
+    wall_start = time.perf_counter()
+    process = subprocess.Popen([sys.executable] + arguments, cwd=cwd, env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # wait4 gives the child's own resource usage, not the sum over every child reaped so far
+    _, status, usage = os.wait4(process.pid, 0)
+    wall_seconds = time.perf_counter() - wall_start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return {
+        'wall_seconds': wall_seconds,
+        'cpu_seconds': usage.ru_utime + usage.ru_stime,
+        'start_rss_kb': 0,
+        'peak_rss_kb': 0,
+    }
+
+
+def measure_startup(repeat:int=10, work_path:Path=None) -> dict:
+    # Cold start-up of each command line: a new interpreter importing everything the script imports
+    # One unmeasured run per command first, so bytecode is compiled and the files are in the page cache
+    work_path = Path(tempfile.mkdtemp(prefix='sip-startup-', dir=work_path))
+    try:
+        runs = [{'stages': {}} for _ in range(repeat)]
+        for stage, arguments in STARTUP_COMMANDS:
+            time_command(arguments, work_path)
+            for run in runs:
+                run['stages'][stage] = time_command(arguments, work_path)
+    finally:
+        shutil.rmtree(work_path, ignore_errors=True)
+    return summarise(runs)
+
+
+def write_scaling_mets(mets_path:Path, elements:int):
+    # SIP root METS of about this many elements - a file, its FLocat and an fptr per payload file
+    # Every file refers to the dmdSec and amdSec with DMDID and ADMID, every fptr to its file, so each IDREF kind is remapped
+    files = max(1, elements // 3)
+    with open(mets_path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<mets:mets %s OBJID="scaling" TYPE="Other" xsi:schemaLocation="%s">\n'
+                '  <mets:metsHdr CREATEDATE="2020-01-01T00:00:00" RECORDSTATUS="NEW" csip:OAISPACKAGETYPE="SIP"/>\n'
+                '  <mets:dmdSec ID="dmd-scaling" CREATED="2020-01-01T00:00:00"/>\n'
+                '  <mets:amdSec ID="amd-scaling"/>\n'
+                '  <mets:fileSec ID="fileSec-scaling">\n'
+                '    <mets:fileGrp ID="fileGrp-documentation" USE="Documentation">\n' % (METS_NAMESPACES, SCHEMA_LOCATION))
+        for file_number in range(files):
+            f.write('      <mets:file ID="ID-%d" ADMID="amd-scaling" DMDID="dmd-scaling" SIZE="0">'
+                    '<mets:FLocat xlink:type="simple" xlink:href="documentation/file%d" LOCTYPE="URL"/></mets:file>\n' % (file_number, file_number))
+        f.write('    </mets:fileGrp>\n  </mets:fileSec>\n'
+                '  <mets:structMap ID="structMap-scaling" TYPE="PHYSICAL" LABEL="CSIP">\n'
+                '    <mets:div ID="div-root" LABEL="scaling">\n'
+                '      <mets:div ID="div-documentation" LABEL="Documentation" DMDID="dmd-scaling">\n')
+        for file_number in range(files):
+            f.write('        <mets:fptr FILEID="ID-%d"/>\n' % file_number)
+        f.write('      </mets:div>\n    </mets:div>\n  </mets:structMap>\n</mets:mets>\n')
+
+
+def measure_mets_scaling(sizes:list, repeat:int=3, work_path:Path=None) -> dict:
+    # Time both METS rewriters on growing METS files, to check that their cost grows linearly with the element count
+    work_path = Path(tempfile.mkdtemp(prefix='sip-mets-scaling-', dir=work_path))
+    rewriters = [
+        ('update_mets', sip_to_eark_aip.update_mets),
+        ('stream_update_mets', lambda mets_path: stream_update_mets(mets_path, sip_to_eark_aip.new_uuid, sip_to_eark_aip.date_time_now,
+                                                                     sip_to_eark_aip.SOFTWARE_NAME, sip_to_eark_aip.SOFTWARE_VERSION)),
+    ]
+    try:
+        runs = [StageTimer() for _ in range(repeat)]
+        source_path = (work_path / 'source.xml')
+        mets_path = (work_path / 'scaling' / 'METS.xml')
+        mets_path.parent.mkdir()
+        for elements in sizes:
+            write_scaling_mets(source_path, elements)
+            for timer in runs:
+                for name, rewrite in rewriters:
+                    shutil.copyfile(source_path, mets_path)
+                    with timer.measure('mets_scaling/%s/%d' % (name, elements)):
+                        rewrite(mets_path)
+    finally:
+        shutil.rmtree(work_path, ignore_errors=True)
+    return summarise([{'stages': timer.stages} for timer in runs])
+
+
+def check_mets_scaling(stages:dict) -> list:
+    # (rewriter, elements, ratio) for every size at which a rewriter spent over MAX_SCALING_RATIO times per element
+    # what it spent at a smaller size - small METS cost more per element, as the fixed costs are spread thinner
+    per_element = {}
+    for stage, result in stages.items():
+        if stage.startswith('mets_scaling/'):
+            _, rewriter, elements = stage.split('/')
+            per_element.setdefault(rewriter, {})[int(elements)] = result['wall_seconds'] / int(elements)
+    problems = []
+    for rewriter, costs in per_element.items():
+        cheapest = None
+        for elements, cost in sorted(costs.items()):
+            cheapest = cost if cheapest is None else min(cheapest, cost)
+            if cost > cheapest * MAX_SCALING_RATIO:
+                problems.append((rewriter, elements, cost / cheapest))
+    return problems
+
+
+def summarise(runs:list) -> dict:
+    # Medians of time over the repeats, the worst peak RSS
+    stages = {}
+    for stage in runs[0]['stages']:
+        samples = [run['stages'][stage] for run in runs if stage in run['stages']]
+        stages[stage] = {
+            'wall_seconds': statistics.median(sample['wall_seconds'] for sample in samples),
+            'cpu_seconds': statistics.median(sample['cpu_seconds'] for sample in samples),
+            'start_rss_kb': max(sample['start_rss_kb'] for sample in samples),
+            'peak_rss_kb': max(sample['peak_rss_kb'] for sample in samples),
+            'wall_seconds_runs': [sample['wall_seconds'] for sample in samples],
+        }
+    return stages
+
+
+def run_benchmark(parameters:dict, repeat:int=3, sip_path:Path=None, work_path:Path=None) -> dict:
+    work_path = Path(tempfile.mkdtemp(prefix='sip-benchmark-', dir=work_path))
+    cwd = os.getcwd()
+    # create_preservation_mets.main writes logs/ into the working directory
+    os.chdir(work_path)
+    try:
+        if sip_path is None:
+            start = time.perf_counter()
+            sip_path = generate_sip(work_path, 'benchmark-sip', parameters['reps'], parameters['files'], parameters['file_size'],
+                                    parameters['mets_entries'], parameters['dc'], parameters['seed'])
+            logging.info("Generated '%s' in %.2fs" % (sip_path, time.perf_counter() - start))
+        runs = [run_once(Path(sip_path).resolve(), work_path, parameters, run_number) for run_number in range(repeat)]
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_path, ignore_errors=True)
+
+    return {
+        'version': REPORT_VERSION,
+        'created': datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'xml_backend': xml_backend.BACKEND,
+        'parameters': parameters,
+        'repeat': repeat,
+        # False when peaks could not be reset between stages: each peak then includes all earlier stages
+        'per_stage_rss': all(run['per_stage_rss'] for run in runs),
+        'stages': summarise(runs),
+        'total_seconds': statistics.median(run['total_seconds'] for run in runs),
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def compare_reports(baseline:dict, report:dict, threshold:float) -> list:
+    # Stages whose time or memory growth rose by more than threshold (a fraction) over the baseline
+    regressions = []
+    compare_memory = report['per_stage_rss'] and baseline['per_stage_rss']
+    for stage, current in report['stages'].items():
+        previous = baseline['stages'].get(stage)
+        if previous is None:
+            continue
+        metrics = [('wall_seconds', current['wall_seconds'], previous['wall_seconds'], MIN_STARTUP_SECONDS if stage.startswith('startup/') else MIN_SECONDS)]
+        if compare_memory:
+            metrics.append(('rss_growth_kb', current['peak_rss_kb'] - current['start_rss_kb'], previous['peak_rss_kb'] - previous['start_rss_kb'], MIN_RSS_KB))
+        for metric, current_value, previous_value, noise in metrics:
+            if current_value - previous_value > max(noise, previous_value * threshold):
+                regressions.append((stage, metric, previous_value, current_value))
+    return regressions
+
+
+def print_report(report:dict, baseline:dict=None):
+    print("%-45s %10s %10s %12s %12s %10s" % ('stage', 'wall (s)', 'cpu (s)', 'peak RSS kB', 'growth kB', 'vs base'))
+    for stage, result in report['stages'].items():
+        change = ''
+        if baseline is not None and stage in baseline['stages'] and baseline['stages'][stage]['wall_seconds'] > 0:
+            change = '%+.0f%%' % ((result['wall_seconds'] / baseline['stages'][stage]['wall_seconds'] - 1) * 100)
+        print("%-45s %10.3f %10.3f %12d %12d %10s" % (stage, result['wall_seconds'], result['cpu_seconds'], result['peak_rss_kb'],
+                                                    result['peak_rss_kb'] - result['start_rss_kb'], change))
+    print("%-45s %10.3f %10s %12d" % ('total', report['total_seconds'], '', report['peak_rss_kb']))
+
+
+def main(argv) -> int:
+    parser = argparse.ArgumentParser(prog='benchmark.py', description="Time each stage of the SIP to AIP pipeline on a synthetic SIP")
+    parser.add_argument('--sip', help="Benchmark an existing SIP instead of generating one")
+    parser.add_argument('--reps', type=int, default=2, help="Representations in the generated SIP")
+    parser.add_argument('--files', type=int, default=200, help="Data files per representation")
+    parser.add_argument('--file-size', default='lognormal:65536:1.5', help="fixed:SIZE, uniform:MIN:MAX or lognormal:MEDIAN:SIGMA in bytes")
+    parser.add_argument('--mets-entries', type=int, default=0, help="Extra file entries per rep METS, to grow the METS")
+    parser.add_argument('--no-dc', action='store_true', help="Generate the SIP without DC.xml")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--preservation-files', type=int, default=20, help="Files in the preservation zip given to create_preservation_mets (0 skips it)")
+    parser.add_argument('--ingest', choices=sip_to_eark_aip.INGEST_STRATEGIES, default='copy', help="Ingest strategy")
+    parser.add_argument('--container', choices=sip_to_eark_aip.CONTAINER_FORMATS, help="Benchmark packaged output instead")
+    parser.add_argument('--inventory', action='store_true', help="Build payload inventories in the rep METS")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per benchmark, times are medians")
+    parser.add_argument('--work-dir', help="Where to generate and convert (default: system temp)")
+    parser.add_argument('--startup', action='store_true', help="Also time cold start-up of the command line scripts")
+    parser.add_argument('--startup-only', action='store_true', help="Only time cold start-up, without converting a SIP")
+    parser.add_argument('--startup-repeat', type=int, default=10, help="Runs per start-up command, times are medians (default: 10)")
+    parser.add_argument('--mets-scaling', action='store_true', help="Also time both METS rewriters on growing METS files and check they scale linearly")
+    parser.add_argument('--mets-scaling-only', action='store_true', help="Only run the METS scaling check, without converting a SIP")
+    parser.add_argument('--mets-scaling-sizes', default=','.join(str(size) for size in METS_SCALING_SIZES),
+                        help="Element counts of the METS files, comma separated (default: %(default)s)")
+    parser.add_argument('--report', help="Write the JSON report here")
+    parser.add_argument('--compare', help="Baseline JSON report to compare against")
+    parser.add_argument('--threshold', type=float, default=0.2, help="Fail when a stage is this fraction slower or larger than the baseline (default: 0.2)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s: %(message)s')
+    # Checksums must be computed, not served from a cache left by an earlier run
+    os.environ['FIXITY_CACHE'] = 'off'
+
+    parameters = {
+        'reps': args.reps,
+        'files': args.files,
+        'file_size': args.file_size,
+        'mets_entries': args.mets_entries,
+        'dc': not args.no_dc,
+        'seed': args.seed,
+        'preservation_files': args.preservation_files,
+        'ingest_strategy': args.ingest,
+        'container_format': args.container,
+        'payload_inventory': args.inventory,
+        'sip': args.sip,
+        'startup': args.startup or args.startup_only,
+    }
+    mets_scaling_sizes = [int(size) for size in args.mets_scaling_sizes.split(',')]
+    if args.mets_scaling or args.mets_scaling_only:
+        parameters['mets_scaling_sizes'] = mets_scaling_sizes
+    work_path = Path(args.work_dir) if args.work_dir else None
+    if args.startup_only or args.mets_scaling_only:
+        parameters = {key: parameters[key] for key in ('startup', 'mets_scaling_sizes') if key in parameters}
+        stages = {}
+        if args.startup_only:
+            stages.update(measure_startup(args.startup_repeat, work_path))
+        if args.mets_scaling_only:
+            stages.update(measure_mets_scaling(mets_scaling_sizes, args.repeat, work_path))
+        report = {
+            'version': REPORT_VERSION,
+            'created': datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'xml_backend': xml_backend.BACKEND,
+            'parameters': parameters,
+            'repeat': args.startup_repeat if args.startup_only else args.repeat,
+            'per_stage_rss': False,
+            'stages': stages,
+            'total_seconds': sum(stage['wall_seconds'] for stage in stages.values()),
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+    else:
+        report = run_benchmark(parameters, args.repeat, Path(args.sip) if args.sip else None, work_path)
+        if args.startup:
+            report['stages'].update(measure_startup(args.startup_repeat, work_path))
+        if args.mets_scaling:
+            report['stages'].update(measure_mets_scaling(mets_scaling_sizes, args.repeat, work_path))
+
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline['parameters'] != report['parameters']:
+            print("Warning: baseline was run with different parameters", file=sys.stderr)
+    print_report(report, baseline)
+
+    scaling_problems = check_mets_scaling(report['stages'])
+    for rewriter, elements, ratio in scaling_problems:
+        print("NON-LINEAR %s: %.1f times the time per element at %d elements" % (rewriter, ratio, elements), file=sys.stderr)
+    if scaling_problems:
+        return 1
+
+    if baseline is not None:
+        regressions = compare_reports(baseline, report, args.threshold)
+        for stage, metric, previous, current in regressions:
+            print("REGRESSION %s %s: %.3f -> %.3f" % (stage, metric, previous, current), file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,82 +1,124 @@
+from concurrent.futures import ThreadPoolExecutor
+import argparse
 import mimetypes
-import xml.etree.ElementTree as ET
 import logging
 import sys
 from pathlib import Path
-from pyunpack import Archive
-#import os
+import os
 import shutil
-
-from sip_to_eark_aip import extract_namespaces, get_checksum, new_uuid, date_time_now
-
-
-def update_root_mets(rep_path:Path):
-    root_path = rep_path.parents[1]
+import threading
+import zipfile
+
+from fixity import get_checksum
+from fixity_cache import CACHE_FILENAME, FixityCache
+import fixity
+import io_scheduler
+import metrics
+import repack
+from sip_to_eark_aip import AIPError, configure_logging, extract_namespaces, new_uuid, date_time_now
+import xml_backend
+import zip_preflight
+
+
+# ElementTree's namespace registry is global - preservation METS of concurrent reps are parsed and written one at a time
+XML_LOCK = threading.Lock()
+# {zip path: sha256} of preservation zips repacked from 7z in this run
+REPACKED_CHECKSUMS = {}
+# ZIP_CHECK - 'directory' (default) checks each preservation zip's central directory, 'crc' also the CRC of every member, 'off' skips the check
+ZIP_CHECK_MODES = ('directory', 'crc', 'off')
+# {zip path: zip_preflight.check_zip result}
+ZIP_CHECKS = {}
+
+
+def update_root_mets(rep_path:Path) -> dict:
+    rep_path = Path(rep_path)
+    return update_root_mets_for_reps(rep_path.parents[1], [rep_path])
+
+
+def update_root_mets_for_reps(root_path:Path, rep_paths:list, rep_mets_checksums:dict=None) -> dict:
+    # Add every rep's fileGrp and structMap div to the root METS in one parse and a single write
+    # rep_mets_checksums - {rep METS path: {'sha256': ...}} already computed by the caller, as update_mets takes them
+    # Returns the root METS path and the reps added to it
     root_mets = (root_path / 'METS.xml')
     if not root_mets.exists() or not root_mets.is_file():
-        fatal_error("Root METS.xml file not found")
+        raise AIPError("Root METS.xml file not found")
     namespaces = extract_namespaces(root_mets)
-    tree = ET.parse(root_mets)
+    tree = xml_backend.parse(root_mets)
     mets_element = tree.getroot()
 
     # File Section
     fileSec_element = mets_element.find('{%s}fileSec' % namespaces[''])
 
     # Remove any file group with the same USE attribute - for re-running script
+    rep_uses = {str(rep_path.relative_to(root_path)) for rep_path in rep_paths}
     marked_for_remove = []
     for fileGrp_element in fileSec_element.findall('{%s}fileGrp' % namespaces['']):
-        if fileGrp_element.get('USE') == (rep_path.relative_to(root_path)):
+        if fileGrp_element.get('USE') in rep_uses:
             marked_for_remove.append(fileGrp_element)
     for fileGrp in marked_for_remove:
         fileSec_element.remove(fileGrp)
 
-    rep_mets_path = (rep_path / 'METS.xml')
-
-    # New File Group
-    fileGrp_id = new_uuid()
-    fileGrp_element = ET.SubElement(fileSec_element, '{%s}fileGrp' % namespaces[''], attrib={
-        'ID': fileGrp_id,
-        'USE': str(rep_path.relative_to(root_path))
-    })
-    file_id = new_uuid('ID')
-    # Fix potential depreciated mimetype
-    file_mimetype = str(mimetypes.guess_type(rep_mets_path)[0])
-    if file_mimetype == "application/x-zip-compressed": 
-        file_mimetype = "application/zip"
-    file_element = ET.SubElement(fileGrp_element, '{%s}file' % namespaces[''], attrib={
-        'ID': file_id,
-        'MIMETYPE': file_mimetype,
-        'SIZE': str(rep_mets_path.stat().st_size),
-        'CREATED': date_time_now(),
-        'CHECKSUM': get_checksum(rep_mets_path),
-        'CHECKSUMTYPE': 'SHA-256'
-    })
-    ET.SubElement(file_element, '{%s}FLocat' % namespaces[''], attrib={
-        '{%s}type' % namespaces['xlink']: 'simple',
-        '{%s}href' % namespaces['xlink']: str(rep_mets_path.relative_to(root_path)),
-        '{%s}LOCTYPE' % namespaces['']: 'URL',
-    })
-
     # Struct Map
     structmap_element = mets_element.find('{%s}structMap' % namespaces[''])
     structmap_element.set('ID', new_uuid())
 
+    # Remove the divs of those file groups too
     root_div_element = structmap_element.find('{%s}div' % namespaces[''])
-    # New Div
-    div_element = ET.SubElement(root_div_element, '{%s}div' % namespaces[''], attrib={
-        'ID': new_uuid(),
-        'LABEL': str(rep_path.relative_to(root_path))
-    })
-    ET.SubElement(div_element, '{%s}mptr' % namespaces[''], attrib={
-        '{%s}type' % namespaces['xlink']: 'simple',
-        '{%s}href' % namespaces['xlink']: str(rep_mets_path.relative_to(root_path)),
-        '{%s}title' % namespaces['xlink']: fileGrp_id,
-        '{%s}LOCTYPE' % namespaces['']: 'URL',
-    })
-    ET.indent(tree, space='    ', level=0)
-    tree.write(root_mets, encoding='utf-8', xml_declaration=True)
-
-def create_preservation_mets(rep_path:Path):
+    for div_element in root_div_element.findall('{%s}div' % namespaces['']):
+        if div_element.get('LABEL') in rep_uses:
+            root_div_element.remove(div_element)
+
+    for rep_path in rep_paths:
+        rep_mets_path = (rep_path / 'METS.xml')
+
+        # New File Group
+        fileGrp_id = new_uuid()
+        fileGrp_element = xml_backend.SubElement(fileSec_element, '{%s}fileGrp' % namespaces[''], attrib={
+            'ID': fileGrp_id,
+            'USE': str(rep_path.relative_to(root_path))
+        })
+        file_id = new_uuid('ID')
+        # Fix potential depreciated mimetype
+        file_mimetype = str(mimetypes.guess_type(rep_mets_path)[0])
+        if file_mimetype == "application/x-zip-compressed": 
+            file_mimetype = "application/zip"
+        checksum = rep_mets_checksums.get(rep_mets_path, {}).get('sha256') if rep_mets_checksums is not None else None
+        file_element = xml_backend.SubElement(fileGrp_element, '{%s}file' % namespaces[''], attrib={
+            'ID': file_id,
+            'MIMETYPE': file_mimetype,
+            'SIZE': str(rep_mets_path.stat().st_size),
+            'CREATED': date_time_now(),
+            'CHECKSUM': checksum or get_checksum(rep_mets_path),
+            'CHECKSUMTYPE': 'SHA-256'
+        })
+        xml_backend.SubElement(file_element, '{%s}FLocat' % namespaces[''], attrib={
+            '{%s}type' % namespaces['xlink']: 'simple',
+            '{%s}href' % namespaces['xlink']: str(rep_mets_path.relative_to(root_path)),
+            'LOCTYPE': 'URL',
+        })
+
+        # New Div
+        div_element = xml_backend.SubElement(root_div_element, '{%s}div' % namespaces[''], attrib={
+            'ID': new_uuid(),
+            'LABEL': str(rep_path.relative_to(root_path))
+        })
+        xml_backend.SubElement(div_element, '{%s}mptr' % namespaces[''], attrib={
+            '{%s}type' % namespaces['xlink']: 'simple',
+            '{%s}href' % namespaces['xlink']: str(rep_mets_path.relative_to(root_path)),
+            '{%s}title' % namespaces['xlink']: fileGrp_id,
+            'LOCTYPE': 'URL',
+        })
+
+    # Written beside the root METS and renamed over it, so the root METS is either fully updated or untouched
+    temp_mets = root_mets.with_name(root_mets.name + '.tmp')
+    xml_backend.write(tree, temp_mets)
+    os.replace(temp_mets, root_mets)
+    return {'mets': root_mets, 'reps': list(rep_paths)}
+
+
+def create_preservation_mets(rep_path:Path, preservation_file_checksum:str=None) -> dict:
+    # Returns the written METS and the preservation file entry it describes
+    rep_path = Path(rep_path)
 
     # Use non-preservation rep mets as a template
     np_rep_mets_path = (rep_path.parent / rep_path.stem.replace('-preservation', '') / 'METS.xml')
@@ -87,7 +129,7 @@ def create_preservation_mets(rep_path:Path):
     namespaces = extract_namespaces(np_rep_mets_path)
 
     # Parse mets
-    tree = ET.parse(np_rep_mets_path) 
+    tree = xml_backend.parse(np_rep_mets_path) 
 
     # Mets Element
     mets_element = tree.getroot()
@@ -116,7 +158,7 @@ def create_preservation_mets(rep_path:Path):
         fileSec_element.remove(fileGrp_element)
 
     # Create new FileGroup and File Elements
-    fileGrp_element = ET.SubElement(fileSec_element, '{%s}fileGrp' % namespaces[''], attrib={
+    fileGrp_element = xml_backend.SubElement(fileSec_element, '{%s}fileGrp' % namespaces[''], attrib={
         'ID': new_uuid(),
         'USE': 'data'
     })
@@ -125,18 +167,20 @@ def create_preservation_mets(rep_path:Path):
     file_mimetype = str(mimetypes.guess_type(preservation_file_path)[0])
     if file_mimetype == "application/x-zip-compressed": 
         file_mimetype = "application/zip"
-    file_element = ET.SubElement(fileGrp_element, '{%s}file' % namespaces[''], attrib={
+    preservation_file_size = preservation_file_path.stat().st_size
+    preservation_file_checksum = preservation_file_checksum or REPACKED_CHECKSUMS.get(preservation_file_path) or get_checksum(preservation_file_path)
+    file_element = xml_backend.SubElement(fileGrp_element, '{%s}file' % namespaces[''], attrib={
         'ID': file_id,
         'MIMETYPE': file_mimetype,
-        'SIZE': str(preservation_file_path.stat().st_size),
+        'SIZE': str(preservation_file_size),
         'CREATED': date_time_now(),
-        'CHECKSUM': get_checksum(preservation_file_path),
+        'CHECKSUM': preservation_file_checksum,
         'CHECKSUMTYPE': 'SHA-256'
     })
-    ET.SubElement(file_element, '{%s}FLocat' % namespaces[''], attrib={
+    xml_backend.SubElement(file_element, '{%s}FLocat' % namespaces[''], attrib={
         '{%s}type' % namespaces['xlink']: 'simple',
         '{%s}href' % namespaces['xlink']: str(preservation_file_path.relative_to(rep_path)),
-        '{%s}LOCTYPE' % namespaces['']: 'URL',
+        'LOCTYPE': 'URL',
     })
 
     # Struct Map
@@ -152,16 +196,73 @@ def create_preservation_mets(rep_path:Path):
         root_div_element.remove(sub_div_element)
 
     # Add data sub div
-    sub_div_element = ET.SubElement(root_div_element, '{%s}div' % namespaces[''], attrib={
+    sub_div_element = xml_backend.SubElement(root_div_element, '{%s}div' % namespaces[''], attrib={
         'LABEL': 'data',
         'ID': new_uuid()
     })
-    ET.SubElement(sub_div_element, '{%s}fptr' % namespaces[''], attrib={
+    xml_backend.SubElement(sub_div_element, '{%s}fptr' % namespaces[''], attrib={
         'FILEID': file_id
     })
 
-    ET.indent(tree, space='    ', level=0)
-    tree.write((rep_path / 'METS.xml'), encoding='utf-8', xml_declaration=True)
+    xml_backend.write(tree, (rep_path / 'METS.xml'))
+    return {
+        'rep': rep_path,
+        'mets': (rep_path / 'METS.xml'),
+        'preservation_file': preservation_file_path,
+        'size': preservation_file_size,
+        'checksum': preservation_file_checksum,
+        'mimetype': file_mimetype,
+        'zip_check': ZIP_CHECKS.get(preservation_file_path),
+    }
+
+
+def build_preservation_rep(rep_path:Path) -> dict:
+    # One rep of the AIP-level mode: validate (incl. 7z conversion), hash and write its METS
+    # Returns create_preservation_mets' result with the rep METS checksum for the root METS
+    validate_input_directory(rep_path)
+    preservation_file_path = [Path(f) for f in (rep_path / 'data').iterdir()][0]
+    preservation_file_checksum = REPACKED_CHECKSUMS.get(preservation_file_path) or get_checksum(preservation_file_path)
+    with XML_LOCK:
+        result = create_preservation_mets(rep_path, preservation_file_checksum)
+    result['mets_checksum'] = get_checksum(result['mets'])
+    return result
+
+
+def find_preservation_reps(aip_path:Path) -> list[Path]:
+    # Every *-preservation rep with something in its data directory, in name order
+    rep_paths = []
+    for rep_path in sorted((aip_path / 'representations').glob('*-preservation')):
+        if not rep_path.is_dir():
+            continue
+        data_path = (rep_path / 'data')
+        if data_path.is_dir() and not any(data_path.iterdir()):
+            logging.info("Skipping '%s': no preservation file" % rep_path)
+            continue
+        rep_paths.append(rep_path)
+    return rep_paths
+
+
+def create_aip_preservation_mets(aip_path:Path, workers:int=None) -> dict:
+    # Build the METS of all preservation reps concurrently, then update the root METS once
+    # Returns the root METS and each rep's create_preservation_mets result, raises AIPError
+    aip_path = Path(aip_path)
+    if not aip_path.is_dir():
+        raise AIPError(str(aip_path) + " is not a directory")
+    if not (aip_path / 'representations').is_dir():
+        raise AIPError("AIP doesn't contain representations directory")
+    rep_paths = find_preservation_reps(aip_path)
+    if not rep_paths:
+        raise AIPError("No preservation reps with a preservation file found in " + str(aip_path))
+    logging.info("Preservation reps: %s" % ', '.join(rep_path.name for rep_path in rep_paths))
+
+    # Nothing touches the root METS until every rep has succeeded
+    with metrics.stage('create_preservation_mets'):
+        with ThreadPoolExecutor(max_workers=workers or fixity.HASH_WORKERS) as executor:
+            reps = list(executor.map(build_preservation_rep, rep_paths))
+    with metrics.stage('update_root_mets'):
+        result = update_root_mets_for_reps(aip_path, rep_paths, {rep['mets']: {'sha256': rep['mets_checksum']} for rep in reps})
+    result['reps'] = reps
+    return result
 
 
 def fatal_error(error:str):
@@ -171,8 +272,27 @@ def fatal_error(error:str):
 
 
 def convert_7z_to_zip(file_path: Path):
-    # Get the path and filename of the input 7z file
-    
+    # Repack the 7z into a zip of the same name - streamed member by member when a 7-Zip program is available
+    # REPACK_COMPRESSION selects 'deflate' (default) or 'store', REPACK_WORKERS the threads compressing large members
+    zip_path = file_path.with_suffix('.zip')
+    if repack.find_7z() is not None:
+        compression = os.environ.get('REPACK_COMPRESSION', 'deflate')
+        if compression not in ('deflate', 'store'):
+            raise AIPError("REPACK_COMPRESSION should be 'deflate' or 'store'")
+        try:
+            workers = int(os.environ.get('REPACK_WORKERS', '1'))
+        except ValueError:
+            raise AIPError("REPACK_WORKERS should be a number")
+        try:
+            # The zip is hashed while it is written, so it isn't read again for its METS entry
+            REPACKED_CHECKSUMS[zip_path] = repack.repack_7z_to_zip(file_path, zip_path, compress=compression == 'deflate', workers=max(1, workers))
+        except RuntimeError as e:
+            raise AIPError(str(e))
+        file_path.unlink()
+        return
+
+    # Only needed without a 7-Zip program, so it isn't imported at start-up
+    from pyunpack import Archive
     unarchived_dir = (file_path.parent / file_path.stem)
     unarchived_dir.mkdir()
     
@@ -185,24 +305,26 @@ def convert_7z_to_zip(file_path: Path):
     file_path.unlink()
         
 
-def validate_input_directory(rep_path:Path):
+def validate_input_directory(rep_path:Path) -> Path:
+    # Raises AIPError if rep_path isn't a preservation rep with a single, intact zip (a 7z is repacked first)
+    rep_path = Path(rep_path)
     # Rep must exists
     if not rep_path.exists():
-        fatal_error(str(rep_path) + " not found")
+        raise AIPError(str(rep_path) + " not found")
 
     # Rep must be a directory
     if not rep_path.is_dir():
-        fatal_error(str(rep_path) + " is not a directory")
+        raise AIPError(str(rep_path) + " is not a directory")
     
     # Rep must contain data directory
     data_path = (rep_path / 'data')
     if not data_path.is_dir():
-        fatal_error("Rep doesn't contain data directory")
+        raise AIPError("Rep doesn't contain data directory")
 
     # Ensure data directory contains a single file with .zip extension
     preservation_files = [Path(f) for f in data_path.iterdir()]
     if len(preservation_files) != 1:
-        fatal_error('Preservation representaion data directory should contain a single zip file')
+        raise AIPError('Preservation representaion data directory should contain a single zip file')
     
     # Convert 7z to zip
     if preservation_files[0].suffix == '.7z':
@@ -210,26 +332,94 @@ def validate_input_directory(rep_path:Path):
         convert_7z_to_zip(preservation_files[0])
         
     if len(preservation_files) != 1:
-        fatal_error('Preservation representaion data directory should contain a single zip file - error in 7z zip conversion')
+        raise AIPError('Preservation representaion data directory should contain a single zip file - error in 7z zip conversion')
         
-    if [Path(f) for f in (rep_path / 'data').iterdir()][0].suffix != '.zip':
-        fatal_error('Preservation file should be a zip')
+    preservation_file_path = [Path(f) for f in (rep_path / 'data').iterdir()][0]
+    if preservation_file_path.suffix != '.zip':
+        raise AIPError('Preservation file should be a zip')
+
+    check_preservation_zip(preservation_file_path)
     
     return rep_path
 
 
-def main(argv):
-    Path("logs").mkdir(exist_ok=True)
-    logging.basicConfig(level=logging.DEBUG, filemode='a', filename='logs/sip_to_eark_aip.log', format='%(asctime)s %(levelname)s: %(funcName)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+def check_preservation_zip(zip_path:Path):
+    # Catch corrupt or truncated zips before they are hashed into METS
+    mode = os.environ.get('ZIP_CHECK', 'directory')
+    if mode not in ZIP_CHECK_MODES:
+        raise AIPError("ZIP_CHECK should be one of " + ', '.join(ZIP_CHECK_MODES))
+    if mode == 'off':
+        return
+    # Members of a repacked 7z had their CRCs checked while they were written
+    verify_crc = mode == 'crc' and zip_path not in REPACKED_CHECKSUMS
+    try:
+        result = zip_preflight.check_zip(zip_path, verify_crc)
+    except (zipfile.BadZipFile, EOFError, OSError) as e:
+        raise AIPError("Preservation zip '%s' is damaged: %s" % (zip_path, e))
+    ZIP_CHECKS[zip_path] = result
+    logging.info("Preservation zip '%s': %d members, %d bytes uncompressed%s%s" % (
+        zip_path, result['members'], result['uncompressed_size'], ', ZIP64' if result['zip64'] else '', ', CRCs checked' if result['crc_checked'] else ''))
+    metrics.add('preservation_zips_checked')
+    metrics.add('preservation_zip_members', result['members'])
+    metrics.add('preservation_zip_uncompressed_bytes', result['uncompressed_size'])
 
-    if len(argv) != 1:
-        logging.error("Incorrect script call format")
-        sys.exit("Command should have the form:\npython create_preservation_mets.py <Rep Directory>")
-    
-    rep_path = validate_input_directory(Path(argv[0]))
-    logging.info(rep_path)
-    create_preservation_mets(rep_path)
-    update_root_mets(rep_path)
+
+def main(argv):
+    configure_logging()
+
+    parser = argparse.ArgumentParser(prog='create_preservation_mets.py', description="Create the METS of a preservation rep and add the rep to the AIP's root METS")
+    parser.add_argument('path', help="Preservation rep directory, or the AIP directory with --aip")
+    parser.add_argument('--aip', action='store_true', help="Process every preservation rep of the AIP with a single root METS update")
+    args = parser.parse_args(argv)
+
+    # IO_LIMIT, IO_MAX_LARGE, ... schedule the hashing and repacking I/O, see io_scheduler
+    io_scheduler.configure_from_environment()
+
+    # METRICS_JSON / METRICS_TEXTFILE switch on per-stage metrics
+    if args.aip:
+        metrics.enable_from_environment('create_preservation_mets', aip=args.path)
+    else:
+        metrics.enable_from_environment('create_preservation_mets', rep=args.path)
+    try:
+        return create_from_arguments(args)
+    except AIPError as e:
+        fatal_error(str(e))
+    finally:
+        metrics.disable()
+
+
+def create_from_arguments(args:argparse.Namespace) -> dict:
+    # The command line run after its arguments are parsed - a single rep or a whole AIP
+    if args.aip:
+        aip_path = Path(args.path)
+        if not aip_path.is_dir():
+            raise AIPError(str(aip_path) + " is not a directory")
+        cache_default = aip_path.resolve().parent
+    else:
+        with metrics.stage('validate_input_directory'):
+            rep_path = validate_input_directory(Path(args.path))
+        logging.info(rep_path)
+        cache_default = rep_path.resolve().parents[2]
+
+    # Checksum cache - defaults to the AIP's parent directory, FIXITY_CACHE overrides the location, 'off' disables it
+    cache_location = os.environ.get('FIXITY_CACHE', str(cache_default / CACHE_FILENAME))
+    cache = None if cache_location == 'off' else FixityCache(Path(cache_location))
+    fixity.use_cache(cache)
+    try:
+        if args.aip:
+            return create_aip_preservation_mets(aip_path)
+        with metrics.stage('create_preservation_mets'):
+            result = create_preservation_mets(rep_path)
+        with metrics.stage('update_root_mets'):
+            result['root_mets'] = update_root_mets(rep_path)['mets']
+        return result
+    finally:
+        if cache is not None:
+            fixity.use_cache(None)
+            cache.close()
+            logging.info("Fixity cache '%s': %d hits, %d misses" % (cache.cache_path, cache.hits, cache.misses))
+            metrics.add('fixity_cache_hits', cache.hits)
+            metrics.add('fixity_cache_misses', cache.misses)
 
 
 if __name__ == '__main__':
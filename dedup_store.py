@@ -0,0 +1,274 @@
+from pathlib import Path
+import argparse
+import errno
+import json
+import os
+import sqlite3
+import stat
+import sys
+import threading
+import time
+import uuid
+
+from aip_container import CONTAINER_FORMATS
+import metrics
+
+
+STORE_DIRECTORY = '.dedup-store'
+INDEX_FILENAME = 'index.sqlite'
+# Environment variable overriding the store location, by default <output directory>/.dedup-store
+STORE_ENVIRONMENT_VARIABLE = 'DEDUP_STORE'
+# Temporary files older than this are left over from crashed runs
+STALE_TEMP_SECONDS = 24 * 60 * 60
+# Where AIPs are built in an output directory before they are published: the ingest daemon's and each
+# multi-node worker's work directory (.work and .work/<node>), and .<AIP>.staging directories in any of them
+WORK_DIRECTORY = '.work'
+STAGING_SUFFIX = '.staging'
+PARTIAL_SUFFIX = '.partial'
+
+
+def is_payload_path(relative_path:Path) -> bool:
+    # representations/<rep>/data/... relative to the AIP - the only files that are deduplicated
+    parts = relative_path.parts
+    return len(parts) > 3 and parts[0] == 'representations' and parts[2] == 'data'
+
+
+def store_location(output_path:Path) -> Path:
+    return Path(os.environ.get(STORE_ENVIRONMENT_VARIABLE) or (output_path / STORE_DIRECTORY))
+
+
+def aip_names_in(output_path:Path) -> set:
+    # Names of the AIPs finished or being built in an output directory - AIP directories, ZIP/TAR containers
+    # (complete or partial) and staging directories, in the output directory and its work directories
+    output_path = Path(output_path)
+    directories = [output_path]
+    work_path = (output_path / WORK_DIRECTORY)
+    if work_path.is_dir():
+        directories += [work_path] + [p for p in work_path.iterdir() if p.is_dir()]
+    aip_names = set()
+    for directory in directories:
+        if not directory.is_dir():
+            continue
+        for name in os.listdir(directory):
+            if name.startswith('.') and name.endswith(STAGING_SUFFIX):
+                name = name[1:-len(STAGING_SUFFIX)]
+            name = name.removesuffix(PARTIAL_SUFFIX)
+            for container_format in CONTAINER_FORMATS:
+                name = name.removesuffix('.' + container_format)
+            aip_names.add(name)
+    return aip_names
+
+
+class DedupStore:
+    # Content-addressed store of payload files shared by the AIPs of an output directory
+    # Objects are named by their SHA-256 and hard linked into every AIP that contains them, so they are read-only.
+    # The index counts the references of each AIP. Whether an object can be deleted is decided by its
+    # link count, so an AIP deleted without being released never loses data.
+
+    def __init__(self, store_path:Path):
+        self.store_path = Path(store_path)
+        self.objects_path = (self.store_path / 'objects')
+        self.temp_path = (self.store_path / 'tmp')
+        self.objects_path.mkdir(parents=True, exist_ok=True)
+        self.temp_path.mkdir(exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(str(self.store_path / INDEX_FILENAME), timeout=60, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('''
+            CREATE TABLE IF NOT EXISTS objects (
+                sha256 TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL
+            )''')
+        self._connection.execute('''
+            CREATE TABLE IF NOT EXISTS refs (
+                aip TEXT NOT NULL,
+                sha256 TEXT NOT NULL,
+                files INTEGER NOT NULL,
+                PRIMARY KEY (aip, sha256)
+            )''')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS refs_sha256 ON refs (sha256)')
+        self._connection.commit()
+        # Index updates of this run, written in one transaction by flush
+        self._new_objects = {}
+        self._new_refs = {}
+        # Payload files and bytes of this run, and how many of them were already in the store
+        self.files = 0
+        self.files_linked = 0
+        self.bytes = 0
+        self.bytes_saved = 0
+
+    def object_path(self, checksum:str) -> Path:
+        return (self.objects_path / checksum[:2] / checksum[2:4] / checksum)
+
+    def new_temp_path(self) -> Path:
+        # Same filesystem as the objects, so publishing one is a link
+        return (self.temp_path / uuid.uuid4().hex)
+
+    def _record(self, checksum:str, size:int, aip_name:str, linked:bool):
+        with self._lock:
+            key = (aip_name, checksum)
+            self._new_refs[key] = self._new_refs.get(key, 0) + 1
+            self.files += 1
+            self.bytes += size
+            if linked:
+                self.files_linked += 1
+                self.bytes_saved += size
+        metrics.add('dedup_files')
+        metrics.add('dedup_bytes', size)
+        if linked:
+            metrics.add('dedup_files_linked')
+            metrics.add('dedup_bytes_saved', size)
+
+    def link(self, checksum:str, destination:Path, aip_name:str) -> bool:
+        # Hard link an object already in the store to destination, False if there is none (or it can't take more links)
+        object_path = self.object_path(checksum)
+        try:
+            os.link(object_path, destination)
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            if e.errno != errno.EMLINK:
+                raise
+            return False
+        self._record(checksum, os.stat(destination).st_size, aip_name, linked=True)
+        return True
+
+    def add(self, temp_path:Path, checksum:str, destination:Path, aip_name:str):
+        # Publish a freshly copied file as the object for checksum and link it to destination
+        # If another process published the same content first, its object is used and the copy dropped
+        size = temp_path.stat().st_size
+        os.chmod(temp_path, stat.S_IMODE(temp_path.stat().st_mode) & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+        object_path = self.object_path(checksum)
+        object_path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(temp_path, object_path)
+        except FileExistsError:
+            if self.link(checksum, destination, aip_name):
+                temp_path.unlink()
+                return
+        except OSError as e:
+            if e.errno != errno.EMLINK:
+                raise
+        else:
+            with self._lock:
+                self._new_objects[checksum] = size
+        # Linked to the destination before the temporary name goes, so the object never has a single link while in use
+        os.link(temp_path, destination)
+        temp_path.unlink()
+        self._record(checksum, size, aip_name, linked=False)
+
+    def flush(self):
+        with self._lock:
+            new_objects, self._new_objects = self._new_objects, {}
+            new_refs, self._new_refs = self._new_refs, {}
+            if not new_objects and not new_refs:
+                return
+            now = time.time()
+            with self._connection:
+                self._connection.executemany('INSERT OR IGNORE INTO objects VALUES (?, ?, ?)',
+                                             [(checksum, size, now) for checksum, size in new_objects.items()])
+                self._connection.executemany(
+                    'INSERT INTO refs VALUES (?, ?, ?) ON CONFLICT (aip, sha256) DO UPDATE SET files = files + excluded.files',
+                    [(aip_name, checksum, files) for (aip_name, checksum), files in new_refs.items()])
+
+    def run_summary(self) -> dict:
+        return {
+            'files': self.files,
+            'files_linked': self.files_linked,
+            'bytes': self.bytes,
+            'bytes_saved': self.bytes_saved,
+            'dedup_ratio': round(self.bytes / (self.bytes - self.bytes_saved), 3) if self.bytes > self.bytes_saved else None,
+        }
+
+    def release(self, aip_name:str) -> int:
+        # Drop the references of a deleted AIP, its objects are reclaimed by the next collect_garbage
+        with self._lock, self._connection:
+            return self._connection.execute('DELETE FROM refs WHERE aip=?', (aip_name,)).rowcount
+
+    def prune_references(self, output_paths:list) -> int:
+        # Release every AIP no longer in one of output_paths - an AIP still being built or packaged keeps its references
+        with self._lock:
+            aip_names = [row[0] for row in self._connection.execute('SELECT DISTINCT aip FROM refs')]
+        present = set().union(*(aip_names_in(output_path) for output_path in output_paths))
+        missing = [aip_name for aip_name in aip_names if aip_name not in present]
+        for aip_name in missing:
+            self.release(aip_name)
+        return len(missing)
+
+    def collect_garbage(self, output_paths:list=None) -> dict:
+        # Delete objects no AIP links to any more (link count 1) and temporary files left by crashed runs
+        # output_paths - where the AIPs live (default: the directory holding the store), for pruning references
+        released = self.prune_references(output_paths or [self.store_path.parent])
+        reclaimed_objects, reclaimed_bytes = 0, 0
+        for directory, directory_names, file_names in os.walk(self.objects_path):
+            for file_name in file_names:
+                object_path = Path(directory, file_name)
+                object_stat = object_path.stat()
+                if object_stat.st_nlink > 1:
+                    continue
+                object_path.unlink()
+                with self._lock, self._connection:
+                    self._connection.execute('DELETE FROM objects WHERE sha256=?', (file_name,))
+                    self._connection.execute('DELETE FROM refs WHERE sha256=?', (file_name,))
+                reclaimed_objects += 1
+                reclaimed_bytes += object_stat.st_size
+        for temp_path in self.temp_path.iterdir():
+            if time.time() - temp_path.stat().st_mtime > STALE_TEMP_SECONDS:
+                temp_path.unlink()
+        return {'released_aips': released, 'objects': reclaimed_objects, 'bytes': reclaimed_bytes}
+
+    def stats(self) -> dict:
+        # Stored bytes against the bytes the AIPs would take without the store
+        with self._lock:
+            objects, stored_bytes = self._connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM objects').fetchone()
+            references, referenced_bytes = self._connection.execute(
+                'SELECT COALESCE(SUM(refs.files), 0), COALESCE(SUM(refs.files * objects.size), 0) FROM refs JOIN objects USING (sha256)').fetchone()
+            aips = self._connection.execute('SELECT COUNT(DISTINCT aip) FROM refs').fetchone()[0]
+        return {
+            'store': str(self.store_path),
+            'aips': aips,
+            'objects': objects,
+            'stored_bytes': stored_bytes,
+            'references': references,
+            'referenced_bytes': referenced_bytes,
+            'bytes_saved': referenced_bytes - stored_bytes,
+            'dedup_ratio': round(referenced_bytes / stored_bytes, 3) if stored_bytes else None,
+        }
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._connection.close()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='dedup_store.py', description="Inspect and reclaim a deduplicating payload store")
+    parser.add_argument('command', choices=('stats', 'gc', 'release'), help="stats: report the dedup ratio, gc: delete unreferenced objects, release: drop an AIP's references")
+    parser.add_argument('store', help="The store directory, or the output directory holding %s" % STORE_DIRECTORY)
+    parser.add_argument('aips', nargs='*', help="AIP names to release")
+    parser.add_argument('--output', action='append', default=None, help="gc: directory the AIPs are in (default: the directory holding the store), can be repeated")
+    args = parser.parse_args(argv)
+
+    store_path = Path(args.store)
+    if (store_path / STORE_DIRECTORY).is_dir():
+        store_path = (store_path / STORE_DIRECTORY)
+    if not (store_path / INDEX_FILENAME).is_file():
+        sys.exit("Fatal Error: No dedup store found at " + str(store_path))
+
+    store = DedupStore(store_path)
+    try:
+        if args.command == 'release':
+            result = {aip_name: store.release(aip_name) for aip_name in args.aips}
+        elif args.command == 'gc':
+            result = store.collect_garbage(args.output)
+        else:
+            result = store.stats()
+    finally:
+        store.close()
+    print(json.dumps(result, indent=4))
+    return result
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,36 @@
+# Python API of the E-ARK AIP scripts - the functions behind the command lines, without their side effects
+# Nothing here configures logging, creates logs/ or exits: failures raise AIPError and results are returned as dicts
+#
+#   import eark_aip
+#   result = eark_aip.transform_sip_to_aip(Path('sip'), Path('output'))
+#   eark_aip.create_aip_preservation_mets(result['path'])
+
+from create_preservation_mets import (
+    build_preservation_rep,
+    create_aip_preservation_mets,
+    create_preservation_mets,
+    update_root_mets,
+    update_root_mets_for_reps,
+    validate_input_directory,
+)
+from sip_to_eark_aip import (
+    SOFTWARE_NAME,
+    SOFTWARE_VERSION,
+    AIPError,
+    transform_sip_to_aip,
+    validate_input_directories,
+)
+
+__all__ = [
+    'AIPError',
+    'SOFTWARE_NAME',
+    'SOFTWARE_VERSION',
+    'build_preservation_rep',
+    'create_aip_preservation_mets',
+    'create_preservation_mets',
+    'transform_sip_to_aip',
+    'update_root_mets',
+    'update_root_mets_for_reps',
+    'validate_input_directories',
+    'validate_input_directory',
+]
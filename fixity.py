@@ -0,0 +1,112 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import hashlib
+import mmap
+import os
+import time
+
+import io_scheduler
+import metrics
+
+
+# Read buffer size - large reads keep the number of interpreter round trips per GB low
+BUFFER_SIZE = 8 * 1024 * 1024
+# Files at least this large are hashed through a memory map instead of read() calls
+MMAP_THRESHOLD = 64 * 1024 * 1024
+# Worker threads for hashing independent files - hashlib releases the GIL while hashing
+HASH_WORKERS = min(8, os.cpu_count() or 1)
+
+# hashlib algorithm names and their METS CHECKSUMTYPE values
+CHECKSUM_TYPES = {
+    'sha256': 'SHA-256',
+    'sha512': 'SHA-512',
+    'md5': 'MD5',
+    'sha1': 'SHA-1',
+}
+
+# Optional persistent checksum cache (fixity_cache.FixityCache), see use_cache
+CACHE = None
+
+
+def use_cache(cache):
+    # Route all checksum lookups through a FixityCache, or None to disable caching
+    global CACHE
+    CACHE = cache
+
+
+def _update_all(hashers:list, data):
+    for hasher in hashers:
+        hasher.update(data)
+
+
+def _hash_file(file:Path, algorithms:tuple, buffer_size:int=None, use_mmap:bool=None) -> dict:
+    # Compute every requested algorithm in a single pass over the file
+    start = time.perf_counter() if metrics.COLLECTOR is not None else None
+    buffer_size = buffer_size or BUFFER_SIZE
+    hashers = [hashlib.new(algorithm) for algorithm in algorithms]
+    with open(file, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if use_mmap is None:
+            use_mmap = size >= MMAP_THRESHOLD
+        with io_scheduler.large_operation(size):
+            io_scheduler.advise_sequential(f.fileno(), size)
+            if use_mmap and size > 0:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    view = memoryview(mapped)
+                    try:
+                        for offset in range(0, size, buffer_size):
+                            # Charged before the pages are faulted in by hashing them
+                            io_scheduler.read(min(buffer_size, size - offset))
+                            _update_all(hashers, view[offset:offset + buffer_size])
+                    finally:
+                        view.release()
+            else:
+                # Small files get a small buffer - zeroing a full-size buffer would cost more than hashing them
+                buffer = bytearray(max(1, min(buffer_size, size + 1)))
+                view = memoryview(buffer)
+                for read in iter(lambda: f.readinto(buffer), 0):
+                    io_scheduler.read(read)
+                    _update_all(hashers, view[:read])
+            io_scheduler.advise_done(f.fileno(), size)
+    if start is not None:
+        metrics.add('files_hashed')
+        metrics.add('bytes_hashed', size)
+        metrics.add('hash_seconds', time.perf_counter() - start)
+    return {algorithm: hasher.hexdigest() for algorithm, hasher in zip(algorithms, hashers)}
+
+
+def get_checksums(file:Path, algorithms:tuple=('sha256',), buffer_size:int=None, use_mmap:bool=None) -> dict:
+    cache = CACHE
+    if cache is None:
+        return _hash_file(file, algorithms, buffer_size, use_mmap)
+
+    stat = os.stat(file)
+    checksums = {}
+    for algorithm in algorithms:
+        checksum = cache.get(stat, algorithm)
+        if checksum is None:
+            break
+        checksums[algorithm] = checksum
+    else:
+        return checksums
+
+    checksums = _hash_file(file, algorithms, buffer_size, use_mmap)
+    # Only store the result if the file didn't change while it was being read
+    after = os.stat(file)
+    if (after.st_ino, after.st_size, after.st_mtime_ns) == (stat.st_ino, stat.st_size, stat.st_mtime_ns):
+        cache.put(file, stat, checksums)
+    return checksums
+
+
+def get_checksum(file:Path, algorithm:str='sha256') -> str:
+    return get_checksums(file, (algorithm,))[algorithm]
+
+
+def get_checksums_concurrently(files:list, algorithms:tuple=('sha256',), workers:int=None) -> dict:
+    # Hash independent files on a thread pool, returns {file: {algorithm: hexdigest}}
+    files = list(files)
+    if len(files) <= 1:
+        return {file: get_checksums(file, algorithms) for file in files}
+    with ThreadPoolExecutor(max_workers=min(workers or HASH_WORKERS, len(files))) as executor:
+        results = executor.map(lambda file: get_checksums(file, algorithms), files)
+        return dict(zip(files, results))
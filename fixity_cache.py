@@ -0,0 +1,97 @@
+from pathlib import Path
+import os
+import sqlite3
+import threading
+import time
+
+
+CACHE_FILENAME = '.fixity-cache.sqlite'
+# Evict entries not used for this long, and the least recently used beyond MAX_ENTRIES
+MAX_AGE_SECONDS = 90 * 24 * 60 * 60
+MAX_ENTRIES = 1_000_000
+# Files modified this recently may still change within the same mtime tick, so their checksums aren't stored
+RACY_WINDOW_NS = 2 * 1_000_000_000
+
+
+class FixityCache:
+    # Persistent checksum cache keyed on (device, inode, size, mtime_ns, algorithm)
+    # Any change to a file's size or mtime produces a different key, so stale checksums are never returned
+
+    def __init__(self, cache_path:Path, max_age_seconds:int=MAX_AGE_SECONDS, max_entries:int=MAX_ENTRIES):
+        self.cache_path = Path(cache_path)
+        self.max_age_seconds = max_age_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # {key: time} of the hits since the last write - last_used is only written by evict, in one transaction,
+        # so hits don't serialise the hashing threads on a commit each
+        self._used = {}
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(str(self.cache_path), timeout=30, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('''
+            CREATE TABLE IF NOT EXISTS checksums (
+                device INTEGER NOT NULL,
+                inode INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                algorithm TEXT NOT NULL,
+                checksum TEXT NOT NULL,
+                path TEXT NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (device, inode, size, mtime_ns, algorithm)
+            )''')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS checksums_last_used ON checksums (last_used)')
+        self._connection.commit()
+
+    def get(self, stat:os.stat_result, algorithm:str):
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT checksum FROM checksums WHERE device=? AND inode=? AND size=? AND mtime_ns=? AND algorithm=?',
+                (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, algorithm)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._used[(stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, algorithm)] = time.time()
+            return row[0]
+
+    def put(self, file:Path, stat:os.stat_result, checksums:dict):
+        if time.time_ns() - stat.st_mtime_ns < RACY_WINDOW_NS:
+            return
+        now = time.time()
+        with self._lock:
+            # Drop entries for earlier versions of the same inode
+            self._connection.execute(
+                'DELETE FROM checksums WHERE device=? AND inode=? AND (size!=? OR mtime_ns!=?)',
+                (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns))
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [(stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns, algorithm, checksum, str(file), now)
+                 for algorithm, checksum in checksums.items()])
+            self._connection.commit()
+
+    def _write_last_used(self):
+        # Called holding the lock, commits with the caller
+        if self._used:
+            self._connection.executemany(
+                'UPDATE checksums SET last_used=? WHERE device=? AND inode=? AND size=? AND mtime_ns=? AND algorithm=?',
+                [(last_used,) + key for key, last_used in self._used.items()])
+            self._used = {}
+
+    def evict(self):
+        with self._lock:
+            self._write_last_used()
+            self._connection.execute('DELETE FROM checksums WHERE last_used < ?', (time.time() - self.max_age_seconds,))
+            self._connection.execute(
+                'DELETE FROM checksums WHERE rowid IN (SELECT rowid FROM checksums ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,))
+            self._connection.commit()
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def close(self):
+        self.evict()
+        self._connection.close()
@@ -0,0 +1,144 @@
+from pathlib import Path
+import argparse
+import hashlib
+import random
+import sys
+
+
+METS_NAMESPACES = ('xmlns:mets="http://www.loc.gov/METS/" '
+                   'xmlns:csip="https://DILCIS.eu/XML/METS/CSIPExtensionMETS" '
+                   'xmlns:xlink="http://www.w3.org/1999/xlink" '
+                   'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"')
+SCHEMA_LOCATION = ('http://www.loc.gov/METS/ http://www.loc.gov/standards/mets/mets.xsd '
+                   'https://dilcis.eu/XML/METS/CSIPExtensionMETS https://earkcsip.dilcis.eu/schema/DILCISExtensionMETS.xsd '
+                   'https://dilcis.eu/XML/METS/SIPExtensionMETS https://earksip.dilcis.eu/schema/DILCISExtensionSIPMETS.xsd')
+# Payload is cut from a block of random bytes so large SIPs can be generated quickly
+BLOCK_SIZE = 1024 * 1024
+
+
+def parse_size_distribution(distribution:str):
+    # fixed:SIZE, uniform:MIN:MAX or lognormal:MEDIAN:SIGMA (sizes in bytes)
+    kind, *values = distribution.split(':')
+    values = [float(value) for value in values]
+    if kind == 'fixed' and len(values) == 1:
+        return lambda rng: int(values[0])
+    if kind == 'uniform' and len(values) == 2:
+        return lambda rng: rng.randint(int(values[0]), int(values[1]))
+    if kind == 'lognormal' and len(values) == 2:
+        return lambda rng: int(rng.lognormvariate(0, values[1]) * values[0])
+    raise ValueError("Unknown size distribution '%s'" % distribution)
+
+
+def write_payload(path:Path, size:int, block:bytes, rng:random.Random) -> str:
+    sha256_hash = hashlib.sha256()
+    offset = rng.randrange(len(block))
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining:
+            chunk = (block[offset:] + block[:offset])[:remaining]
+            f.write(chunk)
+            sha256_hash.update(chunk)
+            remaining -= len(chunk)
+    return sha256_hash.hexdigest()
+
+
+def mets_document(objid:str, file_entries:list, extra_file_groups:str='', extra_divs:str='', dmd:bool=False) -> str:
+    files = ''.join(
+        '\n      <mets:file ID="ID-%s" MIMETYPE="application/octet-stream" SIZE="%d" CREATED="2020-01-01T00:00:00" CHECKSUM="%s" CHECKSUMTYPE="SHA-256">'
+        '\n        <mets:FLocat xlink:type="simple" xlink:href="%s" LOCTYPE="URL"/>'
+        '\n      </mets:file>' % (file_id, size, checksum, href)
+        for file_id, href, size, checksum in file_entries)
+    dmd_sec = ('\n  <mets:dmdSec ID="dmd-%s" CREATED="2020-01-01T00:00:00">'
+               '\n    <mets:mdRef LOCTYPE="URL" MDTYPE="DC" xlink:type="simple" xlink:href="metadata/descriptive/DC.xml"/>'
+               '\n  </mets:dmdSec>' % objid) if dmd else ''
+    dmd_div = '\n      <mets:div ID="div-metadata-%s" LABEL="Metadata" DMDID="dmd-%s"/>' % (objid, objid) if dmd else ''
+    return '''<?xml version="1.0" encoding="UTF-8"?>
+<mets:mets %s OBJID="%s" TYPE="Other" PROFILE="https://earksip.dilcis.eu/profile/E-ARK-SIP.xml" csip:CONTENTINFORMATIONTYPE="MIXED" xsi:schemaLocation="%s">
+  <mets:metsHdr CREATEDATE="2020-01-01T00:00:00" RECORDSTATUS="NEW" csip:OAISPACKAGETYPE="SIP">
+    <mets:agent ROLE="CREATOR" TYPE="OTHER" OTHERTYPE="SOFTWARE">
+      <mets:name>generate_sip.py</mets:name>
+    </mets:agent>
+    <mets:agent ROLE="CREATOR" TYPE="INDIVIDUAL">
+      <mets:name>Synthetic Submitter</mets:name>
+    </mets:agent>
+    <mets:metsDocumentID>%s-METS.xml</mets:metsDocumentID>
+  </mets:metsHdr>%s
+  <mets:amdSec ID="amd-%s"/>
+  <mets:fileSec ID="fileSec-%s">
+    <mets:fileGrp ID="fileGrp-data-%s" USE="Data">%s
+    </mets:fileGrp>%s
+  </mets:fileSec>
+  <mets:structMap ID="structMap-%s" TYPE="PHYSICAL" LABEL="CSIP">
+    <mets:div ID="div-root-%s" LABEL="%s">%s
+      <mets:div ID="div-data-%s" LABEL="Data">
+        <mets:fptr FILEID="fileGrp-data-%s"/>
+      </mets:div>%s
+    </mets:div>
+  </mets:structMap>
+</mets:mets>
+''' % (METS_NAMESPACES, objid, SCHEMA_LOCATION, objid, dmd_sec, objid, objid, objid, files, extra_file_groups,
+       objid, objid, objid, dmd_div, objid, objid, extra_divs)
+
+
+def generate_sip(output_path:Path, sip_name:str, reps:int=2, files_per_rep:int=10, size_distribution:str='fixed:65536',
+                 extra_mets_entries:int=0, dc:bool=True, seed:int=0) -> Path:
+    # Build a synthetic E-ARK SIP: root METS, optional DC.xml and reps with data files and METS
+    # extra_mets_entries adds file entries without payload to grow the rep METS
+    rng = random.Random(seed)
+    file_size = parse_size_distribution(size_distribution)
+    block = rng.randbytes(BLOCK_SIZE)
+    sip_path = (Path(output_path) / sip_name)
+
+    if dc:
+        dc_path = (sip_path / 'metadata' / 'descriptive' / 'DC.xml')
+        dc_path.parent.mkdir(parents=True, exist_ok=True)
+        dc_path.write_text('<?xml version="1.0" encoding="UTF-8"?>\n'
+                           '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">\n'
+                           '  <dc:identifier>%s</dc:identifier>\n'
+                           '  <dc:title>Synthetic SIP %s</dc:title>\n'
+                           '</metadata>\n' % (sip_name, sip_name), encoding='utf-8')
+
+    rep_groups, rep_divs = [], []
+    for rep_number in range(1, reps + 1):
+        rep_name = 'rep%d' % rep_number
+        data_path = (sip_path / 'representations' / rep_name / 'data')
+        data_path.mkdir(parents=True, exist_ok=True)
+        file_entries = []
+        for file_number in range(files_per_rep):
+            file_name = 'file%06d.bin' % file_number
+            size = max(0, file_size(rng))
+            checksum = write_payload((data_path / file_name), size, block, rng)
+            file_entries.append(('%s-%d' % (rep_name, file_number), 'data/' + file_name, size, checksum))
+        for entry_number in range(extra_mets_entries):
+            file_entries.append(('%s-extra-%d' % (rep_name, entry_number), 'data/extra%06d.bin' % entry_number, 0, hashlib.sha256(b'').hexdigest()))
+        (sip_path / 'representations' / rep_name / 'METS.xml').write_text(mets_document(rep_name, file_entries), encoding='utf-8')
+
+        rep_groups.append('\n    <mets:fileGrp ID="fileGrp-%s" USE="Representations/%s">'
+                          '\n      <mets:file ID="ID-mets-%s" MIMETYPE="application/xml">'
+                          '\n        <mets:FLocat xlink:type="simple" xlink:href="representations/%s/METS.xml" LOCTYPE="URL"/>'
+                          '\n      </mets:file>'
+                          '\n    </mets:fileGrp>' % (rep_name, rep_name, rep_name, rep_name))
+        rep_divs.append('\n      <mets:div ID="div-%s" LABEL="Representations/%s">'
+                        '\n        <mets:mptr xlink:type="simple" xlink:href="representations/%s/METS.xml" xlink:title="fileGrp-%s" LOCTYPE="URL"/>'
+                        '\n      </mets:div>' % (rep_name, rep_name, rep_name, rep_name))
+
+    (sip_path / 'METS.xml').write_text(mets_document(sip_name, [], ''.join(rep_groups), ''.join(rep_divs), dmd=dc), encoding='utf-8')
+    return sip_path
+
+
+def main(argv) -> Path:
+    parser = argparse.ArgumentParser(prog='generate_sip.py', description="Generate a synthetic E-ARK SIP")
+    parser.add_argument('output', help="Directory to create the SIP in")
+    parser.add_argument('--name', default='synthetic-sip', help="SIP directory name")
+    parser.add_argument('--reps', type=int, default=2, help="Number of representations")
+    parser.add_argument('--files', type=int, default=10, help="Data files per representation")
+    parser.add_argument('--file-size', default='fixed:65536', help="fixed:SIZE, uniform:MIN:MAX or lognormal:MEDIAN:SIGMA in bytes")
+    parser.add_argument('--mets-entries', type=int, default=0, help="Extra file entries per rep METS, to grow the METS")
+    parser.add_argument('--no-dc', action='store_true', help="Don't create metadata/descriptive/DC.xml")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed")
+    args = parser.parse_args(argv)
+    return generate_sip(Path(args.output), args.name, args.reps, args.files, args.file_size, args.mets_entries, not args.no_dc, args.seed)
+
+
+if __name__ == '__main__':
+    print(main(sys.argv[1:]))
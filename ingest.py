@@ -0,0 +1,316 @@
+from pathlib import Path
+import errno
+import hashlib
+import logging
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from fixity import get_checksum
+import io_scheduler
+import metrics
+
+
+INGEST_STRATEGIES = ('copy', 'hardlink', 'reflink', 'move', 'auto', 'dedup')
+
+# Files the pipeline rewrites in place - these always get a private copy so the SIP is never modified
+REWRITTEN_FILES = ('METS.xml', 'DC.xml')
+
+# Linux FICLONE ioctl (btrfs, XFS with reflink=1, ...)
+FICLONE = 0x40049409
+
+# Errors meaning "not possible here" rather than a real I/O failure
+_UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF}
+
+
+def _clone_range(src_fd:int, dst_fd:int, size:int):
+    # In-kernel copy, which btrfs/XFS/NFS4.2 turn into a clone or server-side copy
+    # Copied a chunk at a time, so a scheduled copy stays within its I/O budget
+    copied = 0
+    while copied < size:
+        count = os.copy_file_range(src_fd, dst_fd, min(size - copied, io_scheduler.CHUNK_SIZE))
+        if count == 0:
+            break
+        io_scheduler.read(count)
+        io_scheduler.write(count)
+        copied += count
+    if copied != size:
+        raise OSError(errno.EIO, "Short copy_file_range copy")
+
+
+def reflink_file(src:str, dst:str) -> str:
+    # Clone with FICLONE, then copy_file_range, then a plain copy
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            if fcntl is None:
+                raise OSError(errno.ENOSYS, "fcntl not available")
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED_ERRNOS:
+                raise
+            size = os.fstat(fsrc.fileno()).st_size
+            with io_scheduler.large_operation(size):
+                try:
+                    if not hasattr(os, 'copy_file_range'):
+                        raise OSError(errno.ENOSYS, "copy_file_range not available")
+                    _clone_range(fsrc.fileno(), fdst.fileno(), size)
+                except OSError as e:
+                    if e.errno not in _UNSUPPORTED_ERRNOS:
+                        raise
+                    fsrc.seek(0)
+                    fdst.seek(0)
+                    fdst.truncate()
+                    io_scheduler.copy_stream(fsrc, fdst, size)
+    shutil.copystat(src, dst)
+    return dst
+
+
+def hardlink_file(src:str, dst:str) -> str:
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno not in _UNSUPPORTED_ERRNOS:
+            raise
+        io_scheduler.copy_file(src, dst)
+    return dst
+
+
+def copy_and_hash(src:str, dst:str) -> str:
+    # Plain copy that returns the SHA-256 of the copied bytes
+    hasher = hashlib.sha256()
+    size = os.stat(src).st_size
+    with io_scheduler.large_operation(size), open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        buffer = bytearray(min(8 * 1024 * 1024, size + 1))
+        view = memoryview(buffer)
+        io_scheduler.advise_sequential(fsrc.fileno(), size)
+        for read in iter(lambda: fsrc.readinto(buffer), 0):
+            io_scheduler.read(read)
+            io_scheduler.write(read)
+            hasher.update(view[:read])
+            fdst.write(view[:read])
+        fdst.flush()
+        io_scheduler.advise_done(fsrc.fileno(), size)
+        io_scheduler.advise_done(fdst.fileno(), size)
+    shutil.copystat(src, dst)
+    return hasher.hexdigest()
+
+
+def _protect_rewritten(copy_function):
+    # Wrap a copy function so that files the pipeline rewrites are always really copied
+    def copy(src, dst):
+        if Path(src).name in REWRITTEN_FILES:
+            return io_scheduler.copy_file(src, dst)
+        return copy_function(src, dst)
+    return copy
+
+
+def _deduplicated(store, aip_path:Path, copy_function):
+    # Wrap a copy function so payload files are hard linked to the store object of their content (a dedup_store.DedupStore)
+    # Each file is read once, copied into the store's temporary directory while it is hashed - the copy
+    # becomes a new object, or is dropped if the store already has the content
+    from dedup_store import is_payload_path
+
+    def copy(src, dst):
+        if Path(src).name in REWRITTEN_FILES or not is_payload_path(Path(dst).relative_to(aip_path)):
+            return copy_function(src, dst)
+        temp_path = store.new_temp_path()
+        checksum = copy_and_hash(src, temp_path)
+        if store.link(checksum, Path(dst), aip_path.name):
+            temp_path.unlink()
+        else:
+            store.add(temp_path, checksum, Path(dst), aip_path.name)
+        return dst
+    return copy
+
+
+def _counted(copy_function):
+    # Wrap a copy function to count copied files and bytes for metrics
+    def copy(src, dst):
+        result = copy_function(src, dst)
+        metrics.add('files_copied')
+        metrics.add('bytes_copied', os.stat(dst).st_size)
+        return result
+    return copy
+
+
+def _probe(sip_file:Path, output_path:Path, copy_function) -> bool:
+    # Try a strategy on one real SIP file without touching the SIP
+    # Imported here and for dedup ingests only, so that importing ingest stays cheap
+    import tempfile
+    output_path.mkdir(parents=True, exist_ok=True)
+    probe_dir = Path(tempfile.mkdtemp(prefix='.ingest-probe-', dir=output_path))
+    try:
+        probe_file = (probe_dir / 'probe')
+        if copy_function is hardlink_file:
+            os.link(sip_file, probe_file)
+        else:
+            with open(sip_file, 'rb') as fsrc, open(probe_file, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        return True
+    except (OSError, AttributeError):
+        return False
+    finally:
+        shutil.rmtree(probe_dir, ignore_errors=True)
+
+
+def detect_ingest_strategy(sip_path:Path, output_path:Path, sip_inventory=None) -> str:
+    # Pick the cheapest non-destructive strategy the filesystem supports: reflink, hardlink, then copy
+    if sip_inventory is not None:
+        sip_file = next(((sip_path / relative_path) for relative_path, size, mtime in sip_inventory.files() if size > 0), None)
+    else:
+        sip_file = next((p for p in sip_path.rglob('*') if p.is_file() and p.stat().st_size > 0), None)
+    if sip_file is None:
+        return 'copy'
+    if fcntl is not None and _probe(sip_file, output_path, reflink_file):
+        return 'reflink'
+    if _probe(sip_file, output_path, hardlink_file):
+        return 'hardlink'
+    return 'copy'
+
+
+def aip_relative_path(relative_path:Path, is_dir:bool=False) -> Path:
+    # Top level directories keep only the stem of their name, as the original copytree ingest did
+    parts = list(relative_path.parts)
+    if parts and (len(parts) > 1 or is_dir):
+        parts[0] = Path(parts[0]).stem
+    return Path(*parts)
+
+
+def _walk_sip(sip_path:Path, sip_inventory=None):
+    # (relative directory, subdirectory names, file names) in name order - from the SIPInventory if there is one
+    if sip_inventory is not None:
+        yield from sip_inventory.walk()
+        return
+    for directory, directory_names, file_names in os.walk(sip_path, followlinks=True):
+        directory_names.sort()
+        yield Path(directory).relative_to(sip_path), directory_names, sorted(file_names)
+
+
+def _fsync_file(path:Path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _journaled_copy_intact(destination:Path, record:dict) -> bool:
+    # A file the journal recorded is only skipped on resume if it still matches the record -
+    # its checksum when the copy was hashed, otherwise its size and modification time
+    try:
+        stat = destination.stat()
+    except FileNotFoundError:
+        return False
+    if stat.st_size != record['size']:
+        return False
+    if record.get('sha256') is not None:
+        return get_checksum(destination) == record['sha256']
+    return stat.st_mtime_ns == record.get('mtime_ns')
+
+
+def _ingest_journaled(sip_path:Path, aip_path:Path, copy_function, journal, sip_inventory=None):
+    # File by file ingest that records every finished file, so a resumed run skips them
+    for relative_directory, directory_names, file_names in _walk_sip(sip_path, sip_inventory):
+        (aip_path / aip_relative_path(relative_directory, is_dir=True)).mkdir(parents=True, exist_ok=True)
+        for file_name in file_names:
+            relative_path = (relative_directory / file_name)
+            source = (sip_path / relative_path)
+            destination = (aip_path / aip_relative_path(relative_path))
+            record = journal.copied_file(relative_path.as_posix())
+            if record is not None and _journaled_copy_intact(destination, record):
+                continue
+            checksum = None
+            if copy_function is io_scheduler.copy_file:
+                checksum = copy_and_hash(source, destination)
+            else:
+                if destination.exists():
+                    destination.unlink()
+                copy_function(source, destination)
+            # The copy must be on disk before the journal says it is
+            _fsync_file(destination)
+            stat = destination.stat()
+            size = stat.st_size
+            journal.record_file(relative_path.as_posix(), size, checksum, stat.st_mtime_ns)
+            metrics.add('files_copied')
+            metrics.add('bytes_copied', size)
+
+
+def ingest_sip(sip_path:Path, aip_path:Path, strategy:str='copy', journal=None, sip_inventory=None, output_path:Path=None) -> str:
+    # Bring all directories and files from the SIP into the AIP using the selected strategy
+    # sip_inventory - the SIP's inventory.SIPInventory, so the SIP isn't listed again
+    # output_path - the output directory, when the AIP is built somewhere else in it (default: the AIP's parent)
+    if output_path is None:
+        output_path = aip_path.parent
+    if strategy not in INGEST_STRATEGIES:
+        raise ValueError("Unknown ingest strategy '%s'" % strategy)
+    if strategy == 'auto':
+        strategy = detect_ingest_strategy(sip_path, output_path, sip_inventory)
+    logging.info("Ingesting '%s' with strategy '%s'" % (sip_path, strategy))
+
+    if strategy == 'move':
+        # Consumes the SIP - renames are free on the same filesystem, shutil.move copies otherwise
+        # A resumed move only finds what is left in the SIP
+        if not sip_path.is_dir():
+            return strategy
+        if sip_inventory is not None:
+            directory_names, file_names = sip_inventory.entries()
+            items = [((sip_path / name), Path(name).stem) for name in directory_names] + [((sip_path / name), name) for name in file_names]
+        else:
+            items = [(file_folder, file_folder.stem if file_folder.is_dir() else file_folder.name) for file_folder in sip_path.iterdir()]
+        for file_folder, destination_name in items:
+            shutil.move(str(file_folder), str(aip_path / destination_name))
+            metrics.add('items_moved')
+        sip_path.rmdir()
+        return strategy
+
+    if strategy == 'dedup':
+        from dedup_store import DedupStore, store_location
+        store = DedupStore(store_location(output_path))
+        try:
+            _copy_sip(sip_path, aip_path, _deduplicated(store, aip_path, io_scheduler.copy_file), journal, sip_inventory)
+        finally:
+            store.close()
+        summary = store.run_summary()
+        logging.info("Dedup store '%s': %d of %d payload files already stored, %d of %d bytes saved" % (
+            store.store_path, summary['files_linked'], summary['files'], summary['bytes_saved'], summary['bytes']))
+        return strategy
+
+    copy_function = {
+        'copy': io_scheduler.copy_file,
+        'hardlink': _protect_rewritten(hardlink_file),
+        'reflink': reflink_file,
+    }[strategy]
+    _copy_sip(sip_path, aip_path, copy_function, journal, sip_inventory)
+    return strategy
+
+
+def _copy_sip(sip_path:Path, aip_path:Path, copy_function, journal=None, sip_inventory=None):
+    if journal is not None:
+        _ingest_journaled(sip_path, aip_path, copy_function, journal, sip_inventory)
+        return
+    if metrics.COLLECTOR is not None:
+        copy_function = _counted(copy_function)
+    if sip_inventory is not None:
+        for relative_directory, directory_names, file_names in sip_inventory.walk():
+            aip_directory = (aip_path / aip_relative_path(relative_directory, is_dir=True))
+            aip_directory.mkdir(parents=True, exist_ok=True)
+            for file_name in file_names:
+                copy_function(str(sip_path / relative_directory / file_name), str(aip_directory / file_name))
+        return
+    for file_folder in sip_path.iterdir():
+        if file_folder.is_dir():
+            shutil.copytree(file_folder, (aip_path / file_folder.stem), copy_function=copy_function)
+        else:
+            copy_function(file_folder, (aip_path / file_folder.name))
+
+
+def break_link(path:Path):
+    # Give a hard-linked file its own inode before it is rewritten in place
+    if path.is_file() and path.stat().st_nlink > 1:
+        temp_path = path.with_name(path.name + '.unlink-tmp')
+        io_scheduler.copy_file(path, temp_path)
+        os.replace(temp_path, path)
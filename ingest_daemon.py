@@ -0,0 +1,380 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Pool
+from pathlib import Path
+import argparse
+import json
+import logging
+import os
+import queue
+import shutil
+import signal
+import sqlite3
+import sys
+import threading
+import time
+
+from aip_container import CONTAINER_FORMATS
+from batch_sip_to_eark_aip import convert_sip, init_worker
+import dedup_store
+from ingest import INGEST_STRATEGIES
+from inventory import scan_files
+import io_scheduler
+import metrics
+from sip_to_eark_aip import configure_logging, new_uuid, staging_directory
+import trash
+
+
+QUEUE_FILENAME = '.ingest-queue.sqlite'
+# Inbox subdirectories that converted and failed SIPs are moved to, and the outbox subdirectory AIPs are built in
+PROCESSED_DIRECTORY = '.processed'
+FAILED_DIRECTORY = '.failed'
+WORK_DIRECTORY = '.work'
+# Completions counted for the throughput in the status
+THROUGHPUT_WINDOW_SECONDS = 15 * 60
+
+
+class WorkQueue:
+    # Persistent SIP queue - jobs survive restarts, jobs left running by a crash are queued again on start-up
+    # Only the daemon's main thread writes, the status endpoint reads through the same lock
+
+    def __init__(self, queue_path:Path):
+        self.queue_path = Path(queue_path)
+        self._lock = threading.Lock()
+        self.queue_path.parent.mkdir(parents=True, exist_ok=True)
+        self._connection = sqlite3.connect(str(self.queue_path), timeout=30, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                sip TEXT NOT NULL,
+                aip TEXT NOT NULL,
+                status TEXT NOT NULL,
+                enqueued REAL NOT NULL,
+                started REAL,
+                finished REAL,
+                bytes INTEGER NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT
+            )''')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)')
+        self._connection.commit()
+
+    def requeue_running(self) -> int:
+        with self._lock:
+            count = self._connection.execute("UPDATE jobs SET status='queued', started=NULL WHERE status='running'").rowcount
+            self._connection.commit()
+        return count
+
+    def enqueue(self, sip_path:Path, size:int) -> str:
+        # AIP names are assigned on enqueue, so failed conversions can still be traced to their output
+        aip_name = new_uuid()
+        with self._lock:
+            self._connection.execute("INSERT INTO jobs (sip, aip, status, enqueued, bytes) VALUES (?, ?, 'queued', ?, ?)",
+                                     (str(sip_path), aip_name, time.time(), size))
+            self._connection.commit()
+        return aip_name
+
+    def pending_sips(self) -> set:
+        with self._lock:
+            return {row[0] for row in self._connection.execute("SELECT sip FROM jobs WHERE status IN ('queued', 'running')")}
+
+    def claim(self) -> tuple:
+        # Oldest queued job as (id, sip, aip), marked running
+        with self._lock:
+            row = self._connection.execute("SELECT id, sip, aip FROM jobs WHERE status='queued' ORDER BY id LIMIT 1").fetchone()
+            if row is None:
+                return None
+            self._connection.execute("UPDATE jobs SET status='running', started=?, attempts=attempts+1 WHERE id=?", (time.time(), row[0]))
+            self._connection.commit()
+        return row
+
+    def finish(self, job_id:int, status:str, error:str=None):
+        with self._lock:
+            self._connection.execute("UPDATE jobs SET status=?, finished=?, error=? WHERE id=?", (status, time.time(), error, job_id))
+            self._connection.commit()
+
+    def counts(self) -> dict:
+        with self._lock:
+            counts = dict(self._connection.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status'))
+        return {status: counts.get(status, 0) for status in ('queued', 'running', 'converted', 'failed')}
+
+    def throughput(self, window_seconds:int=THROUGHPUT_WINDOW_SECONDS) -> dict:
+        since = time.time() - window_seconds
+        with self._lock:
+            converted, total_bytes, total_seconds = self._connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(bytes), 0), COALESCE(SUM(finished - started), 0) FROM jobs WHERE status='converted' AND finished >= ?",
+                (since,)).fetchone()
+        return {
+            'window_seconds': window_seconds,
+            'converted': converted,
+            'sips_per_minute': round(converted * 60 / window_seconds, 3),
+            'bytes_per_second': round(total_bytes / window_seconds),
+            'mean_conversion_seconds': round(total_seconds / converted, 3) if converted else None,
+        }
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def sip_signature(sip_path:Path) -> tuple:
+    # (file count, total size, newest mtime) - changes while a SIP is still being written into the inbox
+    # Entries the conversion can't take are reported when the SIP is validated
+    files = scan_files(sip_path, strict=False)
+    return len(files), sum(size for path, size, mtime in files), max((mtime for path, size, mtime in files), default=0)
+
+
+class InboxWatcher:
+    # Finds complete SIP directories in the inbox
+    # With a marker suffix a SIP is complete once '<SIP directory><suffix>' exists beside it,
+    # otherwise once its signature hasn't changed for stable_seconds
+
+    def __init__(self, inbox_path:Path, stable_seconds:float=30, marker_suffix:str=None):
+        self.inbox_path = inbox_path
+        self.stable_seconds = stable_seconds
+        self.marker_suffix = marker_suffix
+        # {SIP path: (signature, time first seen with it)}
+        self.candidates = {}
+
+    def marker_path(self, sip_path:Path) -> Path:
+        return sip_path.with_name(sip_path.name + self.marker_suffix)
+
+    def complete_sips(self, ignore:set) -> list[tuple[Path, int]]:
+        # (SIP path, payload bytes) of every complete SIP not in ignore, in name order
+        complete = []
+        now = time.time()
+        seen = set()
+        for sip_path in sorted(p for p in self.inbox_path.iterdir() if p.is_dir() and not p.name.startswith('.')):
+            if str(sip_path) in ignore:
+                continue
+            seen.add(sip_path)
+            if self.marker_suffix is not None:
+                if self.marker_path(sip_path).exists():
+                    complete.append((sip_path, sip_signature(sip_path)[1]))
+                continue
+            signature = sip_signature(sip_path)
+            previous, since = self.candidates.get(sip_path, (None, now))
+            if signature != previous:
+                self.candidates[sip_path] = (signature, now)
+                continue
+            # A daemon restarted after the SIP was written doesn't need to wait a second period
+            if now - since >= self.stable_seconds or now - signature[2] >= self.stable_seconds:
+                complete.append((sip_path, signature[1]))
+                del self.candidates[sip_path]
+        for sip_path in set(self.candidates) - seen:
+            del self.candidates[sip_path]
+        return complete
+
+
+def discard_aip(work_path:Path, aip_name:str):
+    # Move whatever a conversion left in a work directory - AIP, container or staging directory - to its trash
+    for aip_path in list(work_path.glob(aip_name + '*')) + [staging_directory(work_path, aip_name).parent]:
+        if aip_path.exists():
+            trash.discard(aip_path, work_path)
+
+
+def ignore_interrupts():
+    # Pool workers leave SIGINT/SIGTERM to the daemon, which lets running conversions finish
+    init_worker()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+
+class IngestDaemon:
+    # Resident converter: watch the inbox, queue complete SIPs and convert them on a bounded pool of worker processes
+    # Workers stay up between SIPs, so conversions don't pay for interpreter start-up and imports
+
+    def __init__(self, inbox_path:Path, outbox_path:Path, work_queue:WorkQueue, watcher:InboxWatcher, workers:int=None,
+                 max_queued:int=None, poll_seconds:float=5, max_sips_per_worker:int=None, transform_options:dict=None):
+        self.inbox_path = inbox_path
+        self.outbox_path = outbox_path
+        self.work_path = (outbox_path / WORK_DIRECTORY)
+        self.work_queue = work_queue
+        self.watcher = watcher
+        self.workers = workers or os.cpu_count() or 1
+        self.max_queued = max_queued
+        self.poll_seconds = poll_seconds
+        self.max_sips_per_worker = max_sips_per_worker
+        self.transform_options = transform_options or {}
+        self.results = queue.Queue()
+        # {job id: {'sip', 'aip', 'started'}} of conversions running in the pool
+        self.in_flight = {}
+        self.started = time.time()
+        self.stopping = threading.Event()
+
+    def scan_inbox(self):
+        # Backpressure - SIPs stay in the inbox while the queue is full
+        counts = self.work_queue.counts()
+        if self.max_queued is not None and counts['queued'] >= self.max_queued:
+            logging.debug("Queue full (%d SIPs), not scanning the inbox" % counts['queued'])
+            return
+        for sip_path, size in self.watcher.complete_sips(self.work_queue.pending_sips()):
+            aip_name = self.work_queue.enqueue(sip_path, size)
+            logging.info("Queued '%s' as '%s'" % (sip_path, aip_name))
+            counts['queued'] += 1
+            if self.max_queued is not None and counts['queued'] >= self.max_queued:
+                break
+
+    def dispatch(self, pool):
+        while len(self.in_flight) < self.workers and not self.stopping.is_set():
+            job = self.work_queue.claim()
+            if job is None:
+                return
+            job_id, sip, aip_name = job
+            self.in_flight[job_id] = {'sip': sip, 'aip': aip_name, 'started': time.time()}
+            pool.apply_async(convert_sip, ((Path(sip), self.work_path, aip_name, self.transform_options),),
+                             callback=lambda result, job_id=job_id: self.results.put((job_id, result)),
+                             error_callback=lambda e, job_id=job_id: self.results.put((job_id, {'status': 'failed', 'error': str(e)})))
+
+    def publish(self, job_id:int, result:dict):
+        # Move the AIP from the work directory to the outbox and the SIP out of the inbox
+        job = self.in_flight.pop(job_id)
+        sip_path, aip_name = Path(job['sip']), job['aip']
+        if result['status'] == 'converted':
+            for aip_path in self.work_path.glob(aip_name + '*'):
+                os.replace(aip_path, (self.outbox_path / aip_path.name))
+            self.work_queue.finish(job_id, 'converted')
+            logging.info("Converted '%s' -> '%s' in %.1fs" % (sip_path, aip_name, result['duration_seconds']))
+            done_path = (self.inbox_path / PROCESSED_DIRECTORY / aip_name)
+        else:
+            discard_aip(self.work_path, aip_name)
+            self.work_queue.finish(job_id, 'failed', result['error'])
+            logging.error("Conversion of '%s' failed: %s" % (sip_path, result['error']))
+            done_path = (self.inbox_path / FAILED_DIRECTORY / aip_name)
+        # A moved SIP has been consumed by the conversion
+        if sip_path.exists():
+            done_path.mkdir(parents=True, exist_ok=True)
+            shutil.move(str(sip_path), str(done_path / sip_path.name))
+        if self.watcher.marker_suffix is not None and self.watcher.marker_path(sip_path).exists():
+            self.watcher.marker_path(sip_path).unlink()
+
+    def status(self) -> dict:
+        now = time.time()
+        return {
+            'uptime_seconds': round(now - self.started),
+            'workers': self.workers,
+            'stopping': self.stopping.is_set(),
+            'jobs': self.work_queue.counts(),
+            'in_flight': [{'sip': job['sip'], 'aip': job['aip'], 'seconds': round(now - job['started'], 1)} for job in list(self.in_flight.values())],
+            'throughput': self.work_queue.throughput(),
+            # Live I/O counters of all workers, when I/O is scheduled
+            'io': io_scheduler.SCHEDULER.stats() if io_scheduler.SCHEDULER is not None else None,
+        }
+
+    def run(self):
+        self.work_path.mkdir(parents=True, exist_ok=True)
+        requeued = self.work_queue.requeue_running()
+        if requeued:
+            logging.info("Queued %d interrupted conversions again" % requeued)
+        next_scan = 0
+        with Pool(processes=self.workers, initializer=ignore_interrupts, maxtasksperchild=self.max_sips_per_worker) as pool:
+            while not self.stopping.is_set() or self.in_flight:
+                if not self.stopping.is_set() and time.monotonic() >= next_scan:
+                    self.scan_inbox()
+                    next_scan = time.monotonic() + self.poll_seconds
+                self.dispatch(pool)
+                try:
+                    job_id, result = self.results.get(timeout=min(self.poll_seconds, 1))
+                except queue.Empty:
+                    continue
+                self.publish(job_id, result)
+            # Workers ignore SIGTERM, so they are shut down rather than terminated
+            pool.close()
+            pool.join()
+        logging.info("Ingest daemon stopped")
+
+    def stop(self, *args):
+        if not self.stopping.is_set():
+            logging.info("Stopping - waiting for %d running conversions" % len(self.in_flight))
+        self.stopping.set()
+
+
+def serve_status(daemon:IngestDaemon, port:int) -> ThreadingHTTPServer:
+    # GET /status on localhost returns the daemon's status as JSON
+    class StatusHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip('/') not in ('', '/status'):
+                self.send_error(404)
+                return
+            body = json.dumps(daemon.status(), indent=4).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug("status: " + format % args)
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), StatusHandler)
+    threading.Thread(target=server.serve_forever, name='status', daemon=True).start()
+    logging.info("Status on http://127.0.0.1:%d/status" % server.server_address[1])
+    return server
+
+
+def main(argv):
+    configure_logging()
+
+    parser = argparse.ArgumentParser(prog='ingest_daemon.py', description="Convert SIPs dropped into an inbox directory to E-ARK AIPs in an outbox directory")
+    parser.add_argument('inbox', help="Directory watched for SIP directories")
+    parser.add_argument('outbox', help="Directory finished AIPs are moved to")
+    parser.add_argument('--workers', type=int, default=None, help="Number of worker processes (default: CPU count)")
+    parser.add_argument('--max-sips-per-worker', type=int, default=None, help="Replace a worker process after it has converted this many SIPs")
+    parser.add_argument('--max-queued', type=int, default=None, help="Stop queueing SIPs from the inbox while this many are waiting")
+    parser.add_argument('--queue', default=None, help="SQLite queue file (default: <outbox>/%s)" % QUEUE_FILENAME)
+    parser.add_argument('--poll-seconds', type=float, default=5, help="Seconds between inbox scans (default: 5)")
+    parser.add_argument('--stable-seconds', type=float, default=30, help="A SIP is complete once unchanged for this long (default: 30)")
+    parser.add_argument('--marker', default=None, help="A SIP is complete once '<SIP directory><MARKER>' exists, e.g. .ready")
+    parser.add_argument('--status-port', type=int, default=None, help="Serve the status as JSON on http://127.0.0.1:<port>/status")
+    parser.add_argument('--ingest', choices=INGEST_STRATEGIES, default='copy', help="How SIP files are brought into the AIPs (default: copy)")
+    parser.add_argument('--container', choices=CONTAINER_FORMATS, default=None, help="Write each AIP as a single ZIP or TAR file")
+    parser.add_argument('--store', action='store_true', help="Store ZIP members without compression")
+    parser.add_argument('--no-zip64', action='store_true', help="Refuse to write ZIP64 extensions")
+    parser.add_argument('--inventory', action='store_true', help="List every payload file with a fresh size and checksum in the rep METS")
+    parser.add_argument('--metrics-json', default=None, help="Append per-stage metrics of every SIP as JSON lines to this file")
+    parser.add_argument('--metrics-textfile', default=None, help="Write per-stage metrics of the last converted SIP to this Prometheus textfile")
+    io_scheduler.add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    inbox_path, outbox_path = Path(args.inbox).resolve(), Path(args.outbox).resolve()
+    if not inbox_path.is_dir():
+        logging.error("Inbox must be a directory")
+        sys.exit("Fatal Error: Inbox must be a directory")
+    outbox_path.mkdir(parents=True, exist_ok=True)
+
+    # Workers pick the metrics outputs up from their inherited environment
+    if args.metrics_json:
+        os.environ[metrics.JSON_ENVIRONMENT_VARIABLE] = str(Path(args.metrics_json).resolve())
+    if args.metrics_textfile:
+        os.environ[metrics.TEXTFILE_ENVIRONMENT_VARIABLE] = str(Path(args.metrics_textfile).resolve())
+
+    # The I/O budgets are shared by all workers, through state files in the outbox
+    io_scheduler.apply_arguments(args, (outbox_path / io_scheduler.SCHEDULER_DIRECTORY))
+
+    # AIPs are built in the work directory, but their dedup store belongs to the outbox
+    os.environ.setdefault(dedup_store.STORE_ENVIRONMENT_VARIABLE, str(outbox_path / dedup_store.STORE_DIRECTORY))
+
+    transform_options = {
+        'ingest_strategy': args.ingest,
+        'container_format': args.container,
+        'compress': not args.store,
+        'zip64': not args.no_zip64,
+        'payload_inventory': args.inventory,
+    }
+    work_queue = WorkQueue(Path(args.queue) if args.queue else (outbox_path / QUEUE_FILENAME))
+    watcher = InboxWatcher(inbox_path, args.stable_seconds, args.marker)
+    daemon = IngestDaemon(inbox_path, outbox_path, work_queue, watcher, args.workers, args.max_queued,
+                          args.poll_seconds, args.max_sips_per_worker, transform_options)
+    signal.signal(signal.SIGINT, daemon.stop)
+    signal.signal(signal.SIGTERM, daemon.stop)
+    server = serve_status(daemon, args.status_port) if args.status_port is not None else None
+    try:
+        daemon.run()
+    finally:
+        if server is not None:
+            server.shutdown()
+        work_queue.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
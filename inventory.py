@@ -0,0 +1,166 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+from pathlib import Path
+import mimetypes
+import os
+
+import fixity
+
+
+# Directory scans in flight - os.scandir releases the GIL, so slow (network) filesystems are listed in parallel
+SCAN_WORKERS = 16
+
+
+class UnsupportedEntryError(ValueError):
+    # An entry that is neither a file nor a directory, or a directory link back up the tree
+    pass
+
+
+def _scan_directory(path:str, strict:bool=True) -> tuple[str, list, list]:
+    # One os.scandir call: (path, subdirectory names, [(file name, size, mtime)]) in directory order
+    # Symbolic links are followed, as the copytree ingest did - anything else that isn't a file or directory
+    # (broken links, sockets, FIFOs, devices) raises UnsupportedEntryError rather than being left out
+    # strict=False skips those entries instead, for scans that only count and size files
+    directories, files = [], []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                if entry.is_symlink():
+                    target = os.path.realpath(entry.path)
+                    real_path = os.path.realpath(path)
+                    if real_path == target or real_path.startswith(target.rstrip(os.sep) + os.sep):
+                        if strict:
+                            raise UnsupportedEntryError("'%s' links to a directory containing it" % entry.path)
+                        continue
+                directories.append(entry.name)
+            elif entry.is_file():
+                stat = entry.stat()
+                files.append((entry.name, stat.st_size, stat.st_mtime))
+            elif strict:
+                raise UnsupportedEntryError("'%s' is neither a file nor a directory" % entry.path)
+    return path, directories, files
+
+
+def scan_tree(root_path:Path, workers:int=None, strict:bool=True) -> dict:
+    # {directory path: (subdirectory names, files)} of every directory below root_path, listed one directory per task on a thread pool
+    tree = {}
+    if not root_path.is_dir():
+        return tree
+    with ThreadPoolExecutor(max_workers=workers or SCAN_WORKERS) as executor:
+        pending = {executor.submit(_scan_directory, str(root_path), strict)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, directories, files = future.result()
+                tree[path] = (directories, files)
+                pending.update(executor.submit(_scan_directory, os.path.join(path, name), strict) for name in directories)
+    return tree
+
+
+def scan_files(root_path:Path, workers:int=None, strict:bool=True) -> list:
+    # (path, size, mtime) of every file below root_path
+    return [(os.path.join(path, name), size, mtime)
+            for path, (directories, files) in scan_tree(root_path, workers, strict).items()
+            for name, size, mtime in files]
+
+
+class SIPInventory:
+    # Every directory and file of a SIP with sizes and mtimes, from a single parallel scan
+    # Built once at validation and queried by the later stages instead of the filesystem
+    # Directory entries keep their os.scandir order, as iterdir() would list them
+
+    def __init__(self, sip_path:Path, tree:dict):
+        self.sip_path = sip_path
+        # {relative directory: (subdirectory names, {file name: (size, mtime)})} - the SIP itself is Path('.')
+        self.directories = {}
+        for path, (directories, files) in tree.items():
+            self.directories[Path(os.path.relpath(path, sip_path))] = (directories, {name: (size, mtime) for name, size, mtime in files})
+
+    @classmethod
+    def scan(cls, sip_path:Path, workers:int=None):
+        return cls(sip_path, scan_tree(sip_path, workers))
+
+    def is_dir(self, relative_path:Path) -> bool:
+        return Path(relative_path) in self.directories
+
+    def is_file(self, relative_path:Path) -> bool:
+        relative_path = Path(relative_path)
+        directory = self.directories.get(relative_path.parent)
+        return directory is not None and relative_path.name in directory[1]
+
+    def stat(self, relative_path:Path) -> tuple[int, float]:
+        # (size, mtime) of a file
+        relative_path = Path(relative_path)
+        return self.directories[relative_path.parent][1][relative_path.name]
+
+    def entries(self, relative_path:Path=Path('.')) -> tuple[list, list]:
+        # (subdirectory names, file names) of a directory
+        directories, files = self.directories.get(Path(relative_path), ([], {}))
+        return directories, list(files)
+
+    def walk(self, relative_path:Path=Path('.')):
+        # (relative directory, subdirectory names, file names) top down in name order, like a sorted os.walk
+        directories, files = self.directories[Path(relative_path)]
+        yield Path(relative_path), sorted(directories), sorted(files)
+        for name in sorted(directories):
+            yield from self.walk(Path(relative_path) / name)
+
+    def files(self, relative_path:Path=Path('.')):
+        # (relative path, size, mtime) of every file below a directory
+        for directory, directory_names, file_names in self.walk(relative_path):
+            file_stats = self.directories[directory][1]
+            for file_name in file_names:
+                yield (directory / file_name), *file_stats[file_name]
+
+    def rep_names(self) -> list:
+        # Representation directories in SIP order
+        return list(self.entries('representations')[0])
+
+    def payload(self, rep_name:str) -> list:
+        # (path relative to the rep, size, mtime) of every file in a representation's data directory
+        rep_path = Path('representations', rep_name)
+        if not self.is_dir(rep_path / 'data'):
+            return []
+        return [(relative_path.relative_to(rep_path), size, mtime) for relative_path, size, mtime in self.files(rep_path / 'data')]
+
+
+def inventory_entry(href:str, size:int, checksum:str, mtime:float) -> tuple:
+    # (href, size, sha256, created) of one payload file, href relative to the rep directory
+    return href, size, checksum, datetime.fromtimestamp(mtime).strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def sort_inventory(entries:list) -> list:
+    return sorted(entries, key=lambda entry: entry[0])
+
+
+def build_inventory(rep_path:Path, workers:int=None, files:list=None) -> list:
+    # Sorted inventory of every file in the rep's data directory, hashed on the fixity thread pool
+    # files - (path, size, mtime) of the data directory if already known, e.g. from the SIPInventory
+    if files is None:
+        files = scan_files((rep_path / 'data'))
+    checksums = fixity.get_checksums_concurrently([path for path, size, mtime in files], workers=workers)
+    return sort_inventory(
+        inventory_entry(Path(os.path.relpath(path, rep_path)).as_posix(), size, checksums[path]['sha256'], mtime)
+        for path, size, mtime in files)
+
+
+def file_attributes(file_id:str, entry:tuple) -> dict:
+    # mets:file attributes of an inventory entry, in the order update_mets writes them
+    href, size, checksum, created = entry
+    file_mimetype = str(mimetypes.guess_type(href)[0])
+    # Fix potential depreciated mimetype
+    if file_mimetype == "application/x-zip-compressed":
+        file_mimetype = "application/zip"
+    return {
+        'ID': file_id,
+        'MIMETYPE': file_mimetype,
+        'SIZE': str(size),
+        'CREATED': created,
+        'CHECKSUM': checksum,
+        'CHECKSUMTYPE': 'SHA-256'
+    }
+
+
+def is_data_fileGrp(use:str) -> bool:
+    # The rep METS fileGrp(s) an inventory replaces
+    return use is not None and use.lower().startswith('data')
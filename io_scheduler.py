@@ -0,0 +1,348 @@
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+import json
+import os
+import shutil
+import struct
+import sys
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import metrics
+
+
+# Environment variables configuring the scheduler - the command line options of the scripts set them for their workers
+LIMIT_ENVIRONMENT_VARIABLE = 'IO_LIMIT'
+READ_LIMIT_ENVIRONMENT_VARIABLE = 'IO_READ_LIMIT'
+WRITE_LIMIT_ENVIRONMENT_VARIABLE = 'IO_WRITE_LIMIT'
+MAX_LARGE_ENVIRONMENT_VARIABLE = 'IO_MAX_LARGE'
+LARGE_THRESHOLD_ENVIRONMENT_VARIABLE = 'IO_LARGE_THRESHOLD'
+FADVISE_ENVIRONMENT_VARIABLE = 'IO_FADVISE'
+# Directory whose state files share the budgets between every process pointing at it
+DIRECTORY_ENVIRONMENT_VARIABLE = 'IO_SCHEDULER_DIR'
+SCHEDULER_DIRECTORY = '.io-scheduler'
+
+# Files at least this large count as large operations and get posix_fadvise hints
+LARGE_FILE_THRESHOLD = 64 * 1024 * 1024
+# Copy buffer, and the largest piece one request takes from a bucket
+CHUNK_SIZE = 8 * 1024 * 1024
+# Bucket capacity - an idle budget saves up at most this many seconds of transfer
+BURST_SECONDS = 1.0
+# How often a process waiting for a shared large operation slot looks again
+SLOT_POLL_SECONDS = 0.05
+# Cumulative counters, kept in the shared directory when there is one
+COUNTERS = ('read_bytes', 'write_bytes', 'read_throttled_seconds', 'write_throttled_seconds', 'large_operations', 'large_wait_seconds')
+
+# Active IOScheduler, None when I/O is not scheduled - every hook checks this first
+SCHEDULER = None
+_UNSCHEDULED = nullcontext()
+
+
+def parse_rate(value:str) -> int:
+    # Bytes (per second), with an optional K, M or G (binary) suffix - None or '' for no limit
+    if value is None or str(value).strip() == '':
+        return None
+    value = str(value).strip().upper().rstrip('B')
+    multiplier = 1
+    if value and value[-1] in 'KMG':
+        multiplier = 1024 ** ('KMG'.index(value[-1]) + 1)
+        value = value[:-1]
+    rate = int(float(value) * multiplier)
+    if rate <= 0:
+        raise ValueError("I/O limits must be positive")
+    return rate
+
+
+class _LocalRecord:
+    # A few numbers shared by the threads of this process
+    def __init__(self, count:int):
+        self.values = [0.0] * count
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def locked(self):
+        with self.lock:
+            yield self.values
+
+
+class _SharedRecord:
+    # A few numbers in a file shared by every process using the scheduler directory, updated under flock
+    def __init__(self, path:Path, count:int):
+        self.format = '<%dd' % count
+        self.count = count
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+        # flock is per open file, so the threads of one process also need a lock of their own
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def locked(self):
+        with self.lock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                data = os.pread(self.fd, struct.calcsize(self.format), 0)
+                values = list(struct.unpack(self.format, data)) if len(data) == struct.calcsize(self.format) else [0.0] * self.count
+                yield values
+                os.pwrite(self.fd, struct.pack(self.format, *values), 0)
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+
+class TokenBucket:
+    # Bytes per second budget - a request takes its bytes up front and sleeps off any debt,
+    # so concurrent users queue behind each other and share the rate
+
+    def __init__(self, rate:int, record):
+        self.rate = rate
+        self.capacity = rate * BURST_SECONDS
+        # [tokens, time of the last request]
+        self.record = record
+
+    def consume(self, size:int) -> float:
+        with self.record.locked() as state:
+            now = time.time()
+            tokens = min(self.capacity, state[0] + (now - state[1]) * self.rate) if state[1] else self.capacity
+            tokens -= size
+            state[0], state[1] = tokens, now
+        wait = -tokens / self.rate if tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class _LocalSlots:
+    def __init__(self, count:int):
+        self.semaphore = threading.BoundedSemaphore(count)
+
+    @contextmanager
+    def acquire(self):
+        with self.semaphore:
+            yield
+
+
+class _SharedSlots:
+    # One lock file per slot, a slot is held by whoever holds the flock on its file
+    def __init__(self, count:int, directory:Path):
+        self.paths = [(directory / ('large-%d.lock' % slot)) for slot in range(count)]
+
+    @contextmanager
+    def acquire(self):
+        while True:
+            for path in self.paths:
+                fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    os.close(fd)
+                    continue
+                try:
+                    yield
+                finally:
+                    os.close(fd)
+                return
+            time.sleep(SLOT_POLL_SECONDS)
+
+
+class IOScheduler:
+    # Global bytes/sec budget plus separate read and write budgets, and a cap on concurrent large-file operations
+    # With a shared directory the budgets, slots and counters are shared by every process pointing at it
+    # (all workers of a batch or the ingest daemon), otherwise they apply to this process
+
+    def __init__(self, limit:int=None, read_limit:int=None, write_limit:int=None, max_large:int=None,
+                 large_threshold:int=LARGE_FILE_THRESHOLD, fadvise:bool=False, directory:Path=None):
+        if directory is not None and fcntl is None:
+            raise OSError("A shared I/O scheduler directory needs fcntl")
+        self.limit = limit
+        self.read_limit = read_limit
+        self.write_limit = write_limit
+        self.max_large = max_large
+        self.large_threshold = large_threshold
+        self.fadvise = fadvise and hasattr(os, 'posix_fadvise')
+        self.directory = Path(directory) if directory is not None else None
+        if self.directory is not None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            record = lambda name, count: _SharedRecord((self.directory / name), count)
+        else:
+            record = lambda name, count: _LocalRecord(count)
+        total = [TokenBucket(limit, record('total.bucket', 2))] if limit else []
+        self.buckets = {
+            'read': ([TokenBucket(read_limit, record('read.bucket', 2))] if read_limit else []) + total,
+            'write': ([TokenBucket(write_limit, record('write.bucket', 2))] if write_limit else []) + total,
+        }
+        self.slots = None
+        if max_large:
+            self.slots = _SharedSlots(max_large, self.directory) if self.directory is not None else _LocalSlots(max_large)
+        self.counters = record('counters', len(COUNTERS))
+
+    def _count(self, **values):
+        with self.counters.locked() as counters:
+            for name, value in values.items():
+                counters[COUNTERS.index(name)] += value
+
+    def _transfer(self, kind:str, size:int):
+        waited = 0.0
+        for bucket in self.buckets[kind]:
+            for offset in range(0, size, CHUNK_SIZE):
+                waited += bucket.consume(min(CHUNK_SIZE, size - offset))
+        self._count(**{kind + '_bytes': size, kind + '_throttled_seconds': waited})
+        if waited:
+            metrics.add('io_%s_throttled_seconds' % kind, waited)
+
+    def read(self, size:int):
+        self._transfer('read', size)
+
+    def write(self, size:int):
+        self._transfer('write', size)
+
+    @contextmanager
+    def large_operation(self, size:int):
+        if self.slots is None or size < self.large_threshold:
+            yield
+            return
+        start = time.perf_counter()
+        with self.slots.acquire():
+            waited = time.perf_counter() - start
+            self._count(large_operations=1, large_wait_seconds=waited)
+            metrics.add('io_large_operations')
+            metrics.add('io_large_wait_seconds', waited)
+            yield
+
+    def stats(self) -> dict:
+        # Counters of this process, or of every process sharing the directory
+        with self.counters.locked() as counters:
+            values = dict(zip(COUNTERS, counters))
+        return {
+            'limit': self.limit,
+            'read_limit': self.read_limit,
+            'write_limit': self.write_limit,
+            'max_large': self.max_large,
+            'shared_directory': str(self.directory) if self.directory is not None else None,
+            **{name: round(value, 3) if name.endswith('_seconds') else int(value) for name, value in values.items()},
+        }
+
+
+def use_scheduler(scheduler:IOScheduler):
+    # Route copies, hashes and repacks through an IOScheduler, or None to stop scheduling
+    global SCHEDULER
+    SCHEDULER = scheduler
+
+
+def configure_from_environment() -> IOScheduler:
+    # Schedule I/O if any of the IO_* variables is set
+    limits = {
+        'limit': parse_rate(os.environ.get(LIMIT_ENVIRONMENT_VARIABLE)),
+        'read_limit': parse_rate(os.environ.get(READ_LIMIT_ENVIRONMENT_VARIABLE)),
+        'write_limit': parse_rate(os.environ.get(WRITE_LIMIT_ENVIRONMENT_VARIABLE)),
+        'max_large': int(os.environ.get(MAX_LARGE_ENVIRONMENT_VARIABLE) or 0) or None,
+    }
+    fadvise = os.environ.get(FADVISE_ENVIRONMENT_VARIABLE, '') not in ('', '0')
+    if not any(limits.values()) and not fadvise:
+        use_scheduler(None)
+        return None
+    large_threshold = parse_rate(os.environ.get(LARGE_THRESHOLD_ENVIRONMENT_VARIABLE)) or LARGE_FILE_THRESHOLD
+    directory = os.environ.get(DIRECTORY_ENVIRONMENT_VARIABLE) or None
+    use_scheduler(IOScheduler(large_threshold=large_threshold, fadvise=fadvise, directory=directory, **limits))
+    return SCHEDULER
+
+
+def add_arguments(parser):
+    parser.add_argument('--io-limit', default=None, help="Cap reads plus writes at this many bytes/sec, e.g. 200M")
+    parser.add_argument('--io-read-limit', default=None, help="Cap reads at this many bytes/sec")
+    parser.add_argument('--io-write-limit', default=None, help="Cap writes at this many bytes/sec")
+    parser.add_argument('--io-max-large', type=int, default=None, help="Run at most this many large-file copies, hashes and repacks at once")
+    parser.add_argument('--io-fadvise', action='store_true', help="Read and write large files without filling the page cache (posix_fadvise)")
+
+
+def apply_arguments(args, shared_directory:Path=None) -> IOScheduler:
+    # Export the --io-* options for worker processes and configure this process
+    # shared_directory - where the workers share their budgets, unless IO_SCHEDULER_DIR names one already
+    for value, variable in [(args.io_limit, LIMIT_ENVIRONMENT_VARIABLE), (args.io_read_limit, READ_LIMIT_ENVIRONMENT_VARIABLE),
+                            (args.io_write_limit, WRITE_LIMIT_ENVIRONMENT_VARIABLE), (args.io_max_large, MAX_LARGE_ENVIRONMENT_VARIABLE)]:
+        if value is not None:
+            os.environ[variable] = str(value)
+    if args.io_fadvise:
+        os.environ[FADVISE_ENVIRONMENT_VARIABLE] = '1'
+    if shared_directory is not None and fcntl is not None:
+        os.environ.setdefault(DIRECTORY_ENVIRONMENT_VARIABLE, str(Path(shared_directory).resolve()))
+    return configure_from_environment()
+
+
+def read(size:int):
+    scheduler = SCHEDULER
+    if scheduler is not None:
+        scheduler.read(size)
+
+
+def write(size:int):
+    scheduler = SCHEDULER
+    if scheduler is not None:
+        scheduler.write(size)
+
+
+def large_operation(size:int):
+    if SCHEDULER is None:
+        return _UNSCHEDULED
+    return SCHEDULER.large_operation(size)
+
+
+def _advise(fd:int, size:int, advice:str):
+    scheduler = SCHEDULER
+    if scheduler is not None and scheduler.fadvise and size >= scheduler.large_threshold:
+        try:
+            os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+        except OSError:
+            pass
+
+
+def advise_sequential(fd:int, size:int):
+    # Large files only - read ahead aggressively
+    _advise(fd, size, 'POSIX_FADV_SEQUENTIAL')
+
+
+def advise_done(fd:int, size:int):
+    # Large files only - drop the file from the page cache once it has been read or written
+    # Pages of a written file that haven't reached the disk yet stay cached
+    _advise(fd, size, 'POSIX_FADV_DONTNEED')
+
+
+def copy_stream(fsrc, fdst, size:int):
+    # Copy an open file in CHUNK_SIZE pieces, each read and written within budget
+    buffer = bytearray(max(1, min(CHUNK_SIZE, size + 1)))
+    view = memoryview(buffer)
+    advise_sequential(fsrc.fileno(), size)
+    for count in iter(lambda: fsrc.readinto(buffer), 0):
+        read(count)
+        write(count)
+        fdst.write(view[:count])
+    fdst.flush()
+    advise_done(fsrc.fileno(), size)
+    advise_done(fdst.fileno(), size)
+
+
+def copy_file(src, dst):
+    # shutil.copy2 through the scheduler - without one, shutil.copy2 itself (with its sendfile fast path)
+    if SCHEDULER is None:
+        return shutil.copy2(src, dst)
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    size = os.stat(src).st_size
+    with large_operation(size), open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        copy_stream(fsrc, fdst, size)
+    shutil.copystat(src, dst)
+    return dst
+
+
+def main(argv):
+    # python io_scheduler.py <shared directory> - print the live counters of every process sharing it
+    if len(argv) != 1 or not Path(argv[0]).is_dir():
+        sys.exit("Command should have the form:\npython io_scheduler.py <I/O scheduler directory>")
+    stats = IOScheduler(directory=Path(argv[0])).stats()
+    print(json.dumps({name: stats[name] for name in ('shared_directory',) + COUNTERS}, indent=4))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,137 @@
+from datetime import datetime
+from pathlib import Path
+import json
+import os
+
+
+JOURNAL_SUFFIX = '.journal'
+# The journal is fsync'd at every stage boundary and after this many file records
+FSYNC_INTERVAL = 256
+
+
+class TransformationJournal:
+    # Append-only JSON lines journal of one SIP to AIP transformation, kept next to the AIP
+    # Records which stages finished, which files were copied (with size and checksum) and the
+    # representation rename plan, so an interrupted run can be resumed or rolled back.
+    # A torn last line from a crash is ignored when the journal is read back.
+
+    def __init__(self, journal_path:Path):
+        self.path = Path(journal_path)
+        self.header = None
+        self.stages_started = set()
+        self.stages_done = set()
+        self.files = {}
+        self.items_done = set()
+        self.values = {}
+        self.completed = False
+        if self.path.exists():
+            self._load()
+        # Stages started by an earlier run but never finished
+        self.resumed_stages = self.stages_started - self.stages_done
+        self._file = open(self.path, 'a', encoding='utf-8')
+        self._unsynced = 0
+
+    def _load(self):
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                self._apply(record)
+
+    def _apply(self, record:dict):
+        event = record['event']
+        if event == 'start':
+            self.header = record
+        elif event == 'stage-start':
+            self.stages_started.add(record['stage'])
+        elif event == 'stage-done':
+            self.stages_done.add(record['stage'])
+        elif event == 'file':
+            self.files[record['path']] = record
+        elif event == 'item':
+            self.items_done.add((record['kind'], record['name']))
+        elif event == 'value':
+            self.values[record['name']] = record['value']
+        elif event == 'complete':
+            self.completed = True
+
+    def _write(self, record:dict, sync:bool=True):
+        record['time'] = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+        self._unsynced += 1
+        if sync or self._unsynced >= FSYNC_INTERVAL:
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+        self._apply(record)
+
+    @classmethod
+    def create(cls, output_path:Path, sip_path:Path, aip_name:str, options:dict):
+        journal = cls(journal_path(output_path, aip_name))
+        journal._write({'event': 'start', 'sip': str(Path(sip_path).resolve()), 'aip': aip_name, 'options': options})
+        return journal
+
+    @property
+    def aip_name(self) -> str:
+        return self.header['aip']
+
+    @property
+    def options(self) -> dict:
+        return self.header['options']
+
+    def stage_done(self, stage:str) -> bool:
+        return stage in self.stages_done
+
+    def start_stage(self, stage:str):
+        self._write({'event': 'stage-start', 'stage': stage})
+
+    def finish_stage(self, stage:str):
+        self._write({'event': 'stage-done', 'stage': stage})
+
+    def copied_file(self, relative_path:str) -> dict:
+        return self.files.get(relative_path)
+
+    def record_file(self, relative_path:str, size:int, checksum:str=None, mtime_ns:int=None):
+        self._write({'event': 'file', 'path': relative_path, 'size': size, 'sha256': checksum, 'mtime_ns': mtime_ns}, sync=False)
+
+    def item_done(self, kind:str, name:str) -> bool:
+        return (kind, name) in self.items_done
+
+    def record_item(self, kind:str, name:str):
+        self._write({'event': 'item', 'kind': kind, 'name': name})
+
+    def get_value(self, name:str):
+        return self.values.get(name)
+
+    def set_value(self, name:str, value):
+        self._write({'event': 'value', 'name': name, 'value': value})
+
+    def complete(self):
+        # A finished transformation needs no journal
+        self._write({'event': 'complete'})
+        self.close()
+        self.path.unlink()
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+
+def journal_path(output_path:Path, aip_name:str) -> Path:
+    return (Path(output_path) / (aip_name + JOURNAL_SUFFIX))
+
+
+def find_unfinished_journals(output_path:Path, sip_path:Path) -> list:
+    # Journals in the output directory of interrupted transformations of this SIP
+    sip = str(Path(sip_path).resolve())
+    journals = []
+    if not Path(output_path).is_dir():
+        return journals
+    for path in sorted(Path(output_path).glob('*' + JOURNAL_SUFFIX)):
+        journal = TransformationJournal(path)
+        journal.close()
+        if journal.header is not None and journal.header['sip'] == sip and not journal.completed:
+            journals.append(journal)
+    return journals
@@ -0,0 +1,332 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from xml.sax.saxutils import XMLGenerator, escape
+from xml.sax.xmlreader import AttributesImpl
+import logging
+import mmap
+import os
+import re
+import shutil
+import xml.parsers.expat
+import xml.sax
+
+import fixity
+import metrics
+import xml_backend
+
+
+# Worker threads rewriting independent metadata files
+METADATA_WORKERS = min(8, os.cpu_count() or 1)
+# Character data buffered before it is written out while streaming XML
+TEXT_BUFFER_CHARS = 1024 * 1024
+# Plain text metadata rewritten with a byte level replace
+TEXT_SUFFIXES = ('.txt', '.csv', '.tsv', '.json')
+# Only whole values are replaced - the SIP name between two of these (or the start and end of the file),
+# give or take spaces. Lines, tab, CSV and JSON separators and quotes, and tag brackets for XML rewritten as text
+VALUE_DELIMITERS = b'\n\r\t,;"\''
+XML_VALUE_DELIMITERS = VALUE_DELIMITERS + b'<>'
+# Bytes of a single value held before it is written out unreplaced - far longer than any SIP name
+MAX_VALUE_BYTES = 2 * fixity.BUFFER_SIZE
+
+
+def is_metadata_path(relative_path:Path) -> bool:
+    # metadata/... or representations/<rep>/metadata/... relative to the AIP
+    parts = relative_path.parts
+    return ((len(parts) > 1 and parts[0] == 'metadata')
+            or (len(parts) > 3 and parts[0] == 'representations' and parts[2] == 'metadata'))
+
+
+def _rewrite_values(source:Path, destination:Path, old:bytes, new:bytes, delimiters:bytes) -> int:
+    # Byte level replace of whole values, one buffer at a time
+    delimiter = b'[' + re.escape(delimiters) + b']'
+    pattern = re.compile(b'(' + delimiter + b' *)' + re.escape(old) + b'(?= *' + delimiter + b')')
+    replacements = 0
+
+    def replace(data:bytes) -> bytes:
+        nonlocal replacements
+        data, count = pattern.subn(lambda match: match.group(1) + new, data)
+        replacements += count
+        return data
+
+    with open(source, 'rb') as fsrc, open(destination, 'wb') as fdst:
+        # The start of the file counts as a delimiter - the newline standing in for it is never written
+        pending, start = b'\n', 1
+        for chunk in iter(lambda: fsrc.read(fixity.BUFFER_SIZE), b''):
+            data = pending + chunk
+            cut = max(data.rfind(delimiters[i:i + 1]) for i in range(len(delimiters)))
+            if cut > 0:
+                # Everything up to the last delimiter is final, the delimiter itself starts the next buffer
+                fdst.write(replace(data[:cut + 1])[start:-1])
+                pending, start = data[cut:], 0
+            elif len(data) > MAX_VALUE_BYTES and data[1:].strip(b' ') != old:
+                # No delimiter after the first byte, so nothing here is a whole value
+                fdst.write(data[start:])
+                pending, start = b'', 0
+            else:
+                pending = data
+        fdst.write(replace(pending + b'\n')[start:-1])
+    return replacements
+
+
+def rewrite_text(source:Path, destination:Path, sip_name:str, aip_name:str) -> int:
+    # Lines and fields that are the UTF-8 encoded name
+    return _rewrite_values(source, destination, sip_name.encode('utf-8'), aip_name.encode('utf-8'), VALUE_DELIMITERS)
+
+
+def rewrite_xml_text(source:Path, destination:Path, sip_name:str, aip_name:str) -> int:
+    # Text and attribute values that are the XML escaped name, for documents the SAX rewrite can't reproduce
+    return _rewrite_values(source, destination, escape(sip_name, {'"': '&quot;'}).encode('utf-8'),
+                           escape(aip_name, {'"': '&quot;'}).encode('utf-8'), XML_VALUE_DELIMITERS)
+
+
+class _RewritingXMLGenerator(XMLGenerator):
+    # SAX handler that writes the document back out with the SIP name replaced where it is a whole text run,
+    # attribute value or comment, give or take surrounding whitespace - values merely containing it are kept.
+    # Only the current text run (at most TEXT_BUFFER_CHARS) is held in memory.
+    # Qualified names and xmlns attributes are echoed as parsed, so prefixes are kept.
+
+    def __init__(self, out, sip_name:str, aip_name:str):
+        super().__init__(out, encoding='utf-8', short_empty_elements=True)
+        self.sip_name = sip_name
+        self.aip_name = aip_name
+        self.replacements = 0
+        self._text = []
+        self._text_size = 0
+        # Set once the current text run outgrew the buffer - it is written out as is
+        self._text_overflowed = False
+        self._in_cdata = False
+
+    def _replace(self, value:str) -> str:
+        if value.strip() != self.sip_name:
+            return value
+        self.replacements += 1
+        return value.replace(self.sip_name, self.aip_name)
+
+    def _write_text(self, text:str):
+        if self._in_cdata:
+            self._finish_pending_start_element()
+            self._write(text)
+        else:
+            super().characters(text)
+
+    def _flush_text(self, final:bool=True):
+        # expat can split a text run over several characters() calls, so runs are joined before replacing
+        # A run longer than the buffer can't be the name, so it is written out as it arrives
+        text = ''.join(self._text)
+        self._text = []
+        self._text_size = 0
+        if final and not self._text_overflowed:
+            text = self._replace(text)
+        self._text_overflowed = not final
+        if text:
+            self._write_text(text)
+
+    def characters(self, content):
+        self._text.append(content)
+        self._text_size += len(content)
+        if self._text_size > TEXT_BUFFER_CHARS:
+            self._flush_text(final=False)
+
+    def ignorableWhitespace(self, content):
+        self.characters(content)
+
+    def startElement(self, name, attrs):
+        self._flush_text()
+        super().startElement(name, AttributesImpl({key: self._replace(value) for key, value in attrs.items()}))
+
+    def endElement(self, name):
+        self._flush_text()
+        super().endElement(name)
+
+    def processingInstruction(self, target, data):
+        self._flush_text()
+        super().processingInstruction(target, data)
+
+    def skippedEntity(self, name):
+        # Entities declared in an external DTD that wasn't loaded are written back as references
+        self._flush_text()
+        self._finish_pending_start_element()
+        self._write('&%s;' % name)
+
+    def endDocument(self):
+        self._flush_text()
+        self._write('\n')
+        super().endDocument()
+
+    # Lexical events (xml.sax.handler.LexicalHandler)
+
+    def comment(self, content):
+        self._flush_text()
+        self._finish_pending_start_element()
+        self._write('<!--%s-->' % self._replace(content))
+
+    def startDTD(self, name, public_id, system_id):
+        # Documents with an internal subset are rewritten as text (see rewrite_xml), so there is none to write
+        if public_id:
+            self._write('<!DOCTYPE %s PUBLIC "%s" "%s">\n' % (name, public_id, system_id))
+        elif system_id:
+            self._write('<!DOCTYPE %s SYSTEM "%s">\n' % (name, system_id))
+        else:
+            self._write('<!DOCTYPE %s>\n' % name)
+
+    def endDTD(self):
+        pass
+
+    def startCDATA(self):
+        self._flush_text()
+        self._finish_pending_start_element()
+        self._write('<![CDATA[')
+        self._in_cdata = True
+
+    def endCDATA(self):
+        self._flush_text()
+        self._in_cdata = False
+        self._write(']]>')
+
+    def startEntity(self, name):
+        pass
+
+    def endEntity(self, name):
+        pass
+
+
+class _PrologEnd(Exception):
+    pass
+
+
+def has_internal_subset(path:Path) -> bool:
+    # Whether the document type declaration has an internal subset - only the prolog is parsed
+    internal_subset = []
+
+    def start_doctype(name, system_id, public_id, has_internal_subset):
+        internal_subset.append(bool(has_internal_subset))
+        raise _PrologEnd()
+
+    def start_element(name, attributes):
+        raise _PrologEnd()
+
+    parser = xml.parsers.expat.ParserCreate()
+    parser.StartDoctypeDeclHandler = start_doctype
+    parser.StartElementHandler = start_element
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b''):
+                parser.Parse(chunk, False)
+            parser.Parse(b'', True)
+    except (_PrologEnd, xml.parsers.expat.ExpatError):
+        pass
+    return any(internal_subset)
+
+
+def rewrite_xml(source:Path, destination:Path, sip_name:str, aip_name:str) -> int:
+    # Stream the document through expat, so memory stays bounded however large it is (EAD, PREMIS, ...)
+    # expat doesn't report an internal subset, and writes the attributes it defaults out in full -
+    # such documents, and those expat can't parse, are rewritten as text instead
+    if has_internal_subset(source):
+        logging.info("'%s' has an internal DTD subset, replacing '%s' as text" % (source, sip_name))
+        return rewrite_xml_text(source, destination, sip_name, aip_name)
+    parser = xml.sax.make_parser()
+    parser.setFeature(xml.sax.handler.feature_namespaces, False)
+    parser.setFeature(xml.sax.handler.feature_external_ges, False)
+    try:
+        with open(destination, 'wb') as fdst:
+            handler = _RewritingXMLGenerator(fdst, sip_name, aip_name)
+            parser.setContentHandler(handler)
+            parser.setProperty(xml.sax.handler.property_lexical_handler, handler)
+            parser.parse(str(source))
+    except xml.sax.SAXParseException as e:
+        logging.warning("Can't parse '%s' as XML (%s), replacing '%s' as text" % (source, e, sip_name))
+        return rewrite_xml_text(source, destination, sip_name, aip_name)
+    return handler.replacements
+
+
+def rewrite_dc(source:Path, destination:Path, sip_name:str, aip_name:str) -> int:
+    # Descriptive DC.xml - the SIP name is replaced in the text of the DC elements only
+    dc_tree = xml_backend.parse(source)
+    replacements = 0
+    for child in dc_tree.getroot():
+        if sip_name in str(child.text):
+            replacements += child.text.count(sip_name)
+            child.text = child.text.replace(sip_name, aip_name)
+    if replacements:
+        xml_backend.write(dc_tree, destination, indent=False)
+    return replacements
+
+
+def _is_descriptive_dc(relative_path:Path) -> bool:
+    return relative_path.parts == ('metadata', 'descriptive', 'DC.xml')
+
+
+# (match, handler) pairs tried in order - match takes the path relative to the AIP,
+# handler(source, destination, sip_name, aip_name) writes destination and returns the number of replacements
+METADATA_HANDLERS = [
+    (_is_descriptive_dc, rewrite_dc),
+    (lambda relative_path: relative_path.suffix.lower() == '.xml', rewrite_xml),
+    (lambda relative_path: relative_path.suffix.lower() in TEXT_SUFFIXES, rewrite_text),
+]
+
+
+def register_handler(match, handler):
+    # Handle more metadata formats - handlers registered later take precedence
+    METADATA_HANDLERS.insert(0, (match, handler))
+
+
+def find_handler(relative_path:Path):
+    for match, handler in METADATA_HANDLERS:
+        if match(relative_path):
+            return handler
+    return None
+
+
+def mentions(path:Path, sip_name:str) -> bool:
+    # Cheap check whether a file refers to the SIP name at all, as UTF-8 text or XML escaped
+    # Files that don't are neither parsed nor rewritten, so hard links and reflinks stay shared
+    needles = {sip_name.encode('utf-8'), escape(sip_name, {'"': '&quot;'}).encode('utf-8')}
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return False
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return any(mapped.find(needle) != -1 for needle in needles)
+
+
+def rewrite_file(relative_path:Path, source:Path, destination:Path, sip_name:str, aip_name:str) -> int:
+    # Rewrite one metadata file into destination, which may be source itself
+    # Returns the number of replacements - 0 means destination wasn't written
+    handler = find_handler(relative_path)
+    if handler is None or not mentions(source, sip_name):
+        metrics.add('metadata_files_skipped')
+        return 0
+    # Written under a temporary name and renamed, which also gives a hard-linked file its own inode
+    temp_path = destination.with_name(destination.name + '.rewrite-tmp')
+    try:
+        replacements = handler(source, temp_path, sip_name, aip_name)
+        if not replacements:
+            metrics.add('metadata_files_skipped')
+            return 0
+        shutil.copystat(source, temp_path)
+        os.replace(temp_path, destination)
+    finally:
+        if temp_path.exists():
+            temp_path.unlink()
+    metrics.add('metadata_files_rewritten')
+    metrics.add('metadata_bytes_rewritten', os.stat(destination).st_size)
+    return replacements
+
+
+def rewrite_metadata(jobs:list, sip_name:str, aip_name:str, journal=None, workers:int=None) -> dict:
+    # Rewrite (relative path, source, destination) jobs concurrently, returns {relative path: replacements}
+    # journal - skip files a previous run finished and record the ones finished now
+    if journal is not None:
+        jobs = [job for job in jobs if not journal.item_done('metadata', job[0].as_posix())]
+    results = {}
+    if not jobs:
+        return results
+    with ThreadPoolExecutor(max_workers=min(workers or METADATA_WORKERS, len(jobs))) as executor:
+        futures = {executor.submit(rewrite_file, relative_path, source, destination, sip_name, aip_name): relative_path
+                   for relative_path, source, destination in jobs}
+        for future in as_completed(futures):
+            relative_path = futures[future]
+            results[relative_path] = future.result()
+            if journal is not None:
+                journal.record_item('metadata', relative_path.as_posix())
+    return results
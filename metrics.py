@@ -0,0 +1,158 @@
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from pathlib import Path
+import json
+import logging
+import os
+import threading
+import time
+
+
+# Environment variables that switch metrics on for scripts run without the command line options
+JSON_ENVIRONMENT_VARIABLE = 'METRICS_JSON'
+TEXTFILE_ENVIRONMENT_VARIABLE = 'METRICS_TEXTFILE'
+PROMETHEUS_PREFIX = 'sip_to_eark_aip'
+
+# Active MetricsCollector, None when metrics are disabled - every hook checks this first
+COLLECTOR = None
+_DISABLED_STAGE = nullcontext()
+
+
+def _process_io() -> dict:
+    # Bytes passed through read/write system calls by the whole process (Linux only)
+    # Reflinks and copy_file_range are counted, memory mapped reads are not
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines())
+        return {'read_bytes': int(fields['rchar']), 'written_bytes': int(fields['wchar'])}
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+class MetricsCollector:
+    # Per-stage wall time, CPU time, I/O bytes and counters for one run of a script
+    # Counters (files copied, bytes hashed, ...) are added by the pipeline through metrics.add
+
+    def __init__(self, script:str, json_path:Path=None, textfile_path:Path=None, labels:dict=None):
+        self.script = script
+        self.json_path = Path(json_path) if json_path else None
+        self.textfile_path = Path(textfile_path) if textfile_path else None
+        self.labels = labels or {}
+        self.counters = {}
+        self.stages = []
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def add(self, name:str, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def stage(self, name:str):
+        with self.lock:
+            counters_start = dict(self.counters)
+        io_start = _process_io()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        status = 'failed'
+        try:
+            yield
+            status = 'done'
+        finally:
+            record = {
+                'event': 'stage',
+                'script': self.script,
+                **self.labels,
+                'stage': name,
+                'status': status,
+                'time': datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+                'wall_seconds': round(time.perf_counter() - wall_start, 6),
+                'cpu_seconds': round(time.process_time() - cpu_start, 6),
+            }
+            io_end = _process_io()
+            if io_start is not None and io_end is not None:
+                record.update({key: io_end[key] - io_start[key] for key in io_end})
+            with self.lock:
+                counters = {key: value - counters_start.get(key, 0) for key, value in self.counters.items() if value != counters_start.get(key, 0)}
+            record.update({key: round(value, 6) if isinstance(value, float) else value for key, value in counters.items()})
+            if counters.get('hash_seconds'):
+                # Per hashing thread - hash_seconds adds up the time of concurrent hashes
+                record['hash_bytes_per_second'] = round(counters['bytes_hashed'] / counters['hash_seconds'])
+            self.stages.append(record)
+            self.emit(record)
+
+    def emit(self, record:dict):
+        line = json.dumps(record)
+        logging.info("metrics %s" % line)
+        if self.json_path is not None:
+            with open(self.json_path, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+
+    def close(self):
+        record = {
+            'event': 'run',
+            'script': self.script,
+            **self.labels,
+            'time': datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+            'wall_seconds': round(time.perf_counter() - self.started, 6),
+            **{key: round(value, 6) if isinstance(value, float) else value for key, value in self.counters.items()},
+        }
+        self.emit(record)
+        if self.textfile_path is not None:
+            self.write_textfile()
+
+    def write_textfile(self):
+        # Prometheus node_exporter textfile collector format, replaced atomically so a scrape never sees half a file
+        # The file describes the last run - give each script its own file
+        values = {}
+        for record in self.stages:
+            labels = 'script="%s",stage="%s"' % (self.script, record['stage'])
+            for key, value in record.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    values.setdefault(key, []).append((labels, value))
+        lines = []
+        for key, samples in sorted(values.items()):
+            metric = '%s_stage_%s' % (PROMETHEUS_PREFIX, key)
+            lines.append('# TYPE %s gauge' % metric)
+            lines.extend('%s{%s} %s' % (metric, labels, value) for labels, value in samples)
+        metric = '%s_last_run_timestamp_seconds' % PROMETHEUS_PREFIX
+        lines.append('# TYPE %s gauge' % metric)
+        lines.append('%s{script="%s"} %d' % (metric, self.script, time.time()))
+
+        temp_path = self.textfile_path.with_name(self.textfile_path.name + '.%d.tmp' % os.getpid())
+        temp_path.write_text('\n'.join(lines) + '\n', encoding='utf-8')
+        os.replace(temp_path, self.textfile_path)
+
+
+def enable(script:str, json_path:Path=None, textfile_path:Path=None, **labels) -> MetricsCollector:
+    global COLLECTOR
+    COLLECTOR = MetricsCollector(script, json_path, textfile_path, labels)
+    return COLLECTOR
+
+
+def enable_from_environment(script:str, **labels) -> MetricsCollector:
+    # Enable metrics if METRICS_JSON or METRICS_TEXTFILE name an output file
+    json_path = os.environ.get(JSON_ENVIRONMENT_VARIABLE)
+    textfile_path = os.environ.get(TEXTFILE_ENVIRONMENT_VARIABLE)
+    if not json_path and not textfile_path:
+        return None
+    return enable(script, json_path, textfile_path, **labels)
+
+
+def disable():
+    # Write the run summary and the textfile, then stop collecting
+    global COLLECTOR
+    collector, COLLECTOR = COLLECTOR, None
+    if collector is not None:
+        collector.close()
+
+
+def add(name:str, value=1):
+    if COLLECTOR is not None:
+        COLLECTOR.add(name, value)
+
+
+def stage(name:str):
+    if COLLECTOR is None:
+        return _DISABLED_STAGE
+    return COLLECTOR.stage(name)
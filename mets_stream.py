@@ -0,0 +1,483 @@
+from collections import deque
+from pathlib import Path
+import mimetypes
+import os
+import shutil
+import xml.etree.ElementTree as ET
+
+from fixity import get_checksums_concurrently
+from inventory import file_attributes, is_data_fileGrp
+from mets_ids import IDREF_ATTRIBUTES, remap_idrefs
+
+
+# METS files at least this large are rewritten by the streaming rewriter instead of the in-memory tree
+STREAMING_METS_THRESHOLD = 16 * 1024 * 1024
+# Bytes fed to the parser per read
+READ_SIZE = 1024 * 1024
+INDENT = '    '
+# Roles of the elements given new IDs - the indexing pass renews them, the rewrite pass writes the IDs out in the same order
+RENEWED_ROLES = frozenset(('dmdSec', 'amdSec', 'fileSec', 'fileGrp', 'file', 'structMap', 'rootDiv', 'div'))
+
+
+class _Node:
+    # State of one open element on the rewriter's stack
+    __slots__ = ('tag', 'qname', 'depth', 'role', 'skip', 'opened', 'has_children', 'text', 'pending_tail', 'index')
+
+    def __init__(self, tag:str, depth:int, role:str=None, skip:bool=False):
+        self.tag = tag
+        self.qname = None
+        self.depth = depth
+        self.role = role
+        self.skip = skip
+        # Start tag closed with '>'
+        self.opened = False
+        self.has_children = False
+        self.text = None
+        # Tail of the previous kept child, written once the next sibling or the end tag is known
+        self.pending_tail = None
+        # Number of children seen, used to find the first metsHdr/fileSec/structMap etc.
+        self.index = {}
+
+
+class StreamingMetsRewriter:
+    # Single-pass SIP to AIP METS rewrite driven by XMLParser target callbacks
+    # Mirrors sip_to_eark_aip.update_mets followed by ET.indent and ElementTree.write, so the output is
+    # byte-for-byte what the tree-based path produces with the ElementTree backend, but no element tree is ever built.
+    # Only the old-to-new ID map grows with the document. It is built by index_ids before the rewrite, so IDREFs
+    # are remapped when they point forwards too, as IDIndex.apply remaps them in the tree.
+
+    def __init__(self, mets_path:Path, body, new_uuid, date_time_now, software_name:str, software_version:str, rep_mets_checksums:dict=None, inventory:list=None):
+        self.mets_path = mets_path
+        self.rep_mets_checksums = rep_mets_checksums
+        self.inventory = inventory
+        self.inventory_fileGrp_id = new_uuid() if inventory is not None else None
+        self.inventory_referenced = False
+        self.body = body
+        self.new_uuid = new_uuid
+        self.date_time_now = date_time_now
+        self.software_name = software_name
+        self.software_version = software_version
+        self.namespaces = {}
+        self.id_updates = {}
+        # New IDs of the renewed elements, in document order
+        self.new_ids = deque()
+        self.stack = []
+        self.text_parts = []
+        self.last_closed = None
+        # Serialization state, as in ElementTree._namespaces
+        self.qnames = {}
+        self.serial_namespaces = {}
+        self.root_start = None
+        self.rep_entries = None
+
+    # Namespace and name handling
+
+    def start_ns(self, prefix:str, uri:str):
+        # Same capture and registration as extract_namespaces
+        key, value = str(prefix), str(uri)
+        if key == 'mets':
+            key = ''
+        elif key == 'sip':
+            key = 'aip'
+            value = value.replace('SIP', 'AIP')
+        self.namespaces[key] = value
+        ET.register_namespace(key, value)
+
+    def qname(self, name:str) -> str:
+        try:
+            return self.qnames[name]
+        except KeyError:
+            pass
+        if name[:1] == '{':
+            uri, local = name[1:].rsplit('}', 1)
+            prefix = self.serial_namespaces.get(uri)
+            if prefix is None:
+                prefix = ET._namespace_map.get(uri)
+                if prefix is None:
+                    prefix = 'ns%d' % len(self.serial_namespaces)
+                if prefix != 'xml':
+                    self.serial_namespaces[uri] = prefix
+            qname = '%s:%s' % (prefix, local) if prefix else local
+        else:
+            qname = name
+        self.qnames[name] = qname
+        return qname
+
+    def ns(self, local:str, key:str='') -> str:
+        return '{%s}%s' % (self.namespaces[key], local)
+
+    def is_mets(self, tag:str) -> bool:
+        return tag.startswith('{%s}' % self.namespaces[''])
+
+    # Output helpers
+
+    def start_tag(self, tag:str, attrib:dict) -> str:
+        parts = ['<' + self.qname(tag)]
+        for key, value in attrib.items():
+            parts.append(' %s="%s"' % (self.qname(key), ET._escape_attrib(value)))
+        return ''.join(parts)
+
+    def close_start_tag(self, node:_Node, ending:str):
+        if node.depth == 0:
+            self.root_start += ending
+        else:
+            self.body.write(ending)
+
+    def open_node(self, node:_Node):
+        # Close the start tag of a node that turned out to have children
+        self.close_start_tag(node, '>')
+        text = node.text
+        if not text or not text.strip():
+            text = '\n' + INDENT * (node.depth + 1)
+        self.body.write(ET._escape_cdata(text))
+        node.opened = True
+
+    def before_child(self, parent:_Node):
+        if not parent.opened:
+            self.open_node(parent)
+        else:
+            tail = parent.pending_tail
+            if not tail or not tail.strip():
+                tail = '\n' + INDENT * (parent.depth + 1)
+            self.body.write(ET._escape_cdata(tail))
+        parent.has_children = True
+        parent.pending_tail = None
+
+    def write_element(self, element:ET.Element, depth:int):
+        # Serialize a newly created element as ET.indent + ElementTree.write would
+        self.body.write(self.start_tag(element.tag, element.attrib))
+        if len(element):
+            text = element.text
+            if not text or not text.strip():
+                text = '\n' + INDENT * (depth + 1)
+            self.body.write('>' + ET._escape_cdata(text))
+            children = list(element)
+            for i, child in enumerate(children):
+                self.write_element(child, depth + 1)
+                tail = child.tail
+                if not tail or not tail.strip():
+                    tail = '\n' + INDENT * (depth + (1 if i < len(children) - 1 else 0))
+                self.body.write(ET._escape_cdata(tail))
+            self.body.write('</%s>' % self.qname(element.tag))
+        elif element.text:
+            self.body.write('>%s</%s>' % (ET._escape_cdata(element.text), self.qname(element.tag)))
+        else:
+            self.body.write(' />')
+
+    def append_children(self, parent:_Node, elements:list):
+        for element in elements:
+            self.before_child(parent)
+            self.write_element(element, parent.depth + 1)
+
+    def flush_data(self):
+        # Character data belongs to the open element (text) or to the element closed last (tail)
+        if not self.text_parts:
+            return
+        data = ''.join(self.text_parts)
+        self.text_parts = []
+        if self.last_closed is not None:
+            node = self.last_closed
+            if not node.skip and self.stack:
+                self.stack[-1].pending_tail = data
+        elif self.stack and not self.stack[-1].skip:
+            self.stack[-1].text = data
+
+    # Parser target interface
+
+    def data(self, data:str):
+        self.text_parts.append(data)
+
+    def start(self, tag:str, attrib:dict):
+        self.flush_data()
+        self.last_closed = None
+        depth = len(self.stack)
+        parent = self.stack[-1] if self.stack else None
+
+        if parent is not None and parent.skip:
+            self.stack.append(_Node(tag, depth, skip=True))
+            return
+
+        role = self.classify(parent, tag, attrib)
+        node = _Node(tag, depth, role, skip=(role == 'remove'))
+        self.stack.append(node)
+        if node.skip:
+            return
+
+        self.rewrite_attributes(node, attrib)
+        if parent is None:
+            # Root start tag is written last, once all namespaces used in the document are known
+            self.root_start = self.start_tag(tag, attrib)
+            node.qname = self.qname(tag)
+            return
+        self.before_child(parent)
+        self.body.write(self.start_tag(tag, attrib))
+        node.qname = self.qname(tag)
+
+    def end(self, tag:str):
+        self.flush_data()
+        node = self.stack.pop()
+        self.last_closed = node
+        if node.skip:
+            return
+
+        if node.role == 'metsHdr':
+            self.append_children(node, [self.software_agent()])
+        elif node.role == 'fileSec':
+            if self.inventory is not None:
+                self.append_inventory(node)
+            self.append_children(node, [entry[1] for entry in self.get_rep_entries()])
+        elif node.role == 'rootDiv':
+            if self.inventory is not None and not self.inventory_referenced:
+                self.append_children(node, [self.inventory_div()])
+            self.append_children(node, [entry[2]() for entry in self.get_rep_entries()])
+
+        if node.has_children:
+            tail = node.pending_tail
+            if not tail or not tail.strip():
+                tail = '\n' + INDENT * node.depth
+            self.body.write(ET._escape_cdata(tail) + '</%s>' % node.qname)
+        elif node.text:
+            self.close_start_tag(node, '>')
+            self.body.write(ET._escape_cdata(node.text) + '</%s>' % node.qname)
+        else:
+            self.close_start_tag(node, ' />')
+
+    def close(self):
+        self.flush_data()
+
+    # METS transformation - mirrors sip_to_eark_aip.update_mets
+
+    def classify(self, parent:_Node, tag:str, attrib:dict) -> str:
+        if parent is None:
+            return 'root'
+        count = parent.index.get(tag, 0)
+        parent.index[tag] = count + 1
+        role = parent.role
+        if role == 'root':
+            if tag == self.ns('metsHdr'):
+                return 'metsHdr' if count == 0 else None
+            if tag == self.ns('dmdSec'):
+                return 'dmdSec'
+            if tag == self.ns('amdSec'):
+                return 'amdSec'
+            if tag == self.ns('fileSec'):
+                return 'fileSec' if count == 0 else None
+            if tag == self.ns('structMap'):
+                return 'structMap' if count == 0 else None
+        elif role == 'metsHdr':
+            if tag == self.ns('metsDocumentID') and count == 0:
+                return 'remove'
+            if tag == self.ns('agent'):
+                try:
+                    if attrib['ROLE'] == 'CREATOR' and attrib['TYPE'] == 'OTHER' and attrib['OTHERTYPE'] == 'SOFTWARE':
+                        return 'remove'
+                    elif attrib['ROLE'] == 'CREATOR' and attrib['TYPE'] == 'INDIVIDUAL':
+                        return 'remove'
+                except KeyError:
+                    pass
+        elif role == 'fileSec':
+            if tag == self.ns('fileGrp'):
+                if attrib.get('USE').lower().startswith('representation'):
+                    return 'remove'
+                # Replaced by the inventory, which takes over its ID
+                if self.inventory is not None and is_data_fileGrp(attrib.get('USE')):
+                    self.id_updates[attrib.get('ID')] = self.inventory_fileGrp_id
+                    self.inventory_referenced = True
+                    return 'remove'
+                return 'fileGrp'
+        elif role == 'fileGrp':
+            if tag == self.ns('file'):
+                return 'file'
+        elif role == 'structMap':
+            if tag == self.ns('div') and count == 0:
+                return 'rootDiv'
+        elif role == 'rootDiv':
+            if tag == self.ns('div'):
+                if attrib.get('LABEL').lower().startswith('representations'):
+                    return 'remove'
+                return 'div'
+        return None
+
+    def index_ids(self, mets_path:Path):
+        # Indexing pass - renew the IDs of every element the rewrite gives a new ID, recording the old ones
+        parser = ET.XMLParser(target=_IDIndexer(self))
+        with open(mets_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(READ_SIZE), b''):
+                parser.feed(chunk)
+        parser.close()
+
+    def renew_id(self, role:str, old_id:str):
+        new_id = self.new_uuid('ID' if role == 'file' else 'uuid')
+        if old_id is not None:
+            self.id_updates[old_id] = new_id
+        self.new_ids.append(new_id)
+
+    def rewrite_attributes(self, node:_Node, attrib:dict):
+        role = node.role
+        if role in RENEWED_ROLES:
+            attrib['ID'] = self.new_ids.popleft()
+        if self.is_mets(node.tag):
+            for name in IDREF_ATTRIBUTES.intersection(attrib):
+                attrib[name] = remap_idrefs(name, attrib[name], self.id_updates, self.new_uuid)
+        if role == 'root':
+            xsi_schema_location = '{%s}schemaLocation' % self.namespaces['xsi']
+            attrib['OBJID'] = str(self.mets_path.parent.stem)
+            if "https://dilcis.eu/XML/METS/SIPExtensionMETS" in attrib.get(xsi_schema_location):
+                attrib[xsi_schema_location] = attrib.get(xsi_schema_location).replace("https://dilcis.eu/XML/METS/SIPExtensionMETS", "https://dilcis.eu/XML/METS/AIPExtensionMETS")
+        elif role == 'metsHdr':
+            attrib['LASTMODDATE'] = self.date_time_now()
+            attrib['RECORDSTATUS'] = "Revised"
+            attrib[self.ns('OAISPACKAGETYPE', 'csip')] = "AIP"
+        elif role == 'dmdSec':
+            attrib['CREATED'] = self.date_time_now()
+        elif role == 'rootDiv':
+            attrib['LABEL'] = self.mets_path.parent.stem
+
+    def software_agent(self) -> ET.Element:
+        agent = ET.Element(self.ns('agent'), attrib={'ROLE': 'CREATOR', 'TYPE': 'OTHER', 'OTHERTYPE': 'SOFTWARE'})
+        ET.SubElement(agent, self.ns('name')).text = self.software_name
+        ET.SubElement(agent, self.ns('note'), attrib={self.ns('NOTETYPE', 'csip'): 'SOFTWARE VERSION'}).text = self.software_version
+        return agent
+
+    def append_inventory(self, parent:_Node):
+        # Payload inventory fileGrp, written one file element at a time so it never exists as a whole tree
+        self.before_child(parent)
+        depth = parent.depth + 1
+        fileGrp_element = ET.Element(self.ns('fileGrp'), attrib={'ID': self.inventory_fileGrp_id, 'USE': 'Data'})
+        if not self.inventory:
+            self.write_element(fileGrp_element, depth)
+            return
+        self.body.write(self.start_tag(fileGrp_element.tag, fileGrp_element.attrib) + '>\n' + INDENT * (depth + 1))
+        last = len(self.inventory) - 1
+        for i, entry in enumerate(self.inventory):
+            file_element = ET.Element(self.ns('file'), attrib=file_attributes(self.new_uuid('ID'), entry))
+            ET.SubElement(file_element, self.ns('FLocat'), attrib={
+                self.ns('type', 'xlink'): 'simple',
+                self.ns('href', 'xlink'): entry[0],
+                'LOCTYPE': 'URL',
+            })
+            self.write_element(file_element, depth + 1)
+            self.body.write('\n' + INDENT * (depth + (1 if i < last else 0)))
+        self.body.write('</%s>' % self.qname(fileGrp_element.tag))
+
+    def inventory_div(self) -> ET.Element:
+        div_element = ET.Element(self.ns('div'), attrib={'ID': self.new_uuid(), 'LABEL': 'Data'})
+        ET.SubElement(div_element, self.ns('fptr'), attrib={'FILEID': self.inventory_fileGrp_id})
+        return div_element
+
+    def get_rep_entries(self) -> list:
+        # New fileGrp and structMap div for each non-preservation representation - (root mets only)
+        if self.rep_entries is not None:
+            return self.rep_entries
+        self.rep_entries = []
+        # Checksums passed in name the rep METS, otherwise the representations directory is listed
+        representations_path = (self.mets_path.parent / 'representations')
+        checksums = self.rep_mets_checksums
+        if checksums is not None:
+            rep_paths = [rep_mets_path.parent for rep_mets_path in checksums]
+        elif representations_path.is_dir():
+            rep_paths = [rep_path for rep_path in representations_path.iterdir() if not rep_path.stem.endswith('-preservation')]
+            checksums = get_checksums_concurrently([(rep_path / 'METS.xml') for rep_path in rep_paths])
+        else:
+            return self.rep_entries
+        for rep_path in rep_paths:
+            rep_mets_path = (rep_path / 'METS.xml')
+            fileGrp_id = self.new_uuid()
+            fileGrp_element = ET.Element(self.ns('fileGrp'), attrib={
+                'ID': fileGrp_id,
+                'USE': str(rep_path.relative_to(self.mets_path.parent))
+            })
+            file_mimetype = str(mimetypes.guess_type(rep_mets_path)[0])
+            # Fix potential depreciated mimetype
+            if file_mimetype == "application/x-zip-compressed":
+                file_mimetype = "application/zip"
+            file_element = ET.SubElement(fileGrp_element, self.ns('file'), attrib={
+                'ID': self.new_uuid('ID'),
+                'MIMETYPE': file_mimetype,
+                'SIZE': str(rep_mets_path.stat().st_size),
+                'CREATED': self.date_time_now(),
+                'CHECKSUM': checksums[rep_mets_path]['sha256'],
+                'CHECKSUMTYPE': 'SHA-256'
+            })
+            ET.SubElement(file_element, self.ns('FLocat'), attrib={
+                self.ns('type', 'xlink'): 'simple',
+                self.ns('href', 'xlink'): str(rep_mets_path.relative_to(self.mets_path.parent)),
+                'LOCTYPE': 'URL',
+            })
+            self.rep_entries.append((rep_path, fileGrp_element, self.rep_div_factory(rep_path, rep_mets_path, fileGrp_id)))
+        return self.rep_entries
+
+    def rep_div_factory(self, rep_path:Path, rep_mets_path:Path, fileGrp_id:str):
+        def rep_div() -> ET.Element:
+            div_element = ET.Element(self.ns('div'), attrib={
+                'ID': self.new_uuid(),
+                'LABEL': str(rep_path.relative_to(rep_path.parents[1]))
+            })
+            ET.SubElement(div_element, self.ns('mptr'), attrib={
+                self.ns('type', 'xlink'): 'simple',
+                self.ns('href', 'xlink'): str(rep_mets_path.relative_to(rep_path)),
+                self.ns('title', 'xlink'): fileGrp_id,
+                'LOCTYPE': 'URL',
+            })
+            return div_element
+        return rep_div
+
+    def xml_header(self) -> str:
+        # XML declaration and root start tag, with every namespace the document ended up using
+        declarations = ''.join(
+            ' xmlns%s="%s"' % ((':' + prefix) if prefix else '', ET._escape_attrib(uri))
+            for uri, prefix in sorted(self.serial_namespaces.items(), key=lambda item: item[1]))
+        # Namespace declarations go straight after the root tag name
+        tag_end = self.root_start.index(' ') if ' ' in self.root_start else len(self.root_start) - 1
+        return "<?xml version='1.0' encoding='utf-8'?>\n" + self.root_start[:tag_end] + declarations + self.root_start[tag_end:]
+
+
+class _IDIndexer:
+    # Parser target of the indexing pass - classifies elements as the rewrite pass will, without writing anything
+
+    def __init__(self, rewriter:StreamingMetsRewriter):
+        self.rewriter = rewriter
+        self.stack = []
+
+    def start_ns(self, prefix:str, uri:str):
+        self.rewriter.start_ns(prefix, uri)
+
+    def start(self, tag:str, attrib:dict):
+        parent = self.stack[-1] if self.stack else None
+        if parent is not None and parent.skip:
+            self.stack.append(_Node(tag, len(self.stack), skip=True))
+            return
+        role = self.rewriter.classify(parent, tag, attrib)
+        self.stack.append(_Node(tag, len(self.stack), role, skip=(role == 'remove')))
+        if role in RENEWED_ROLES:
+            self.rewriter.renew_id(role, attrib.get('ID'))
+
+    def end(self, tag:str):
+        self.stack.pop()
+
+
+def stream_update_mets(mets_path:Path, new_uuid, date_time_now, software_name:str, software_version:str, rep_mets_checksums:dict=None, inventory:list=None):
+    # Rewrite a METS file with bounded memory; the body is spooled to a temporary file because the
+    # root start tag can only be written once every namespace used by the document is known
+    mets_path = Path(mets_path)
+    body_path = mets_path.with_name(mets_path.name + '.body-tmp')
+    output_path = mets_path.with_name(mets_path.name + '.tmp')
+    try:
+        with open(body_path, 'w', encoding='utf-8', errors='xmlcharrefreplace') as body:
+            rewriter = StreamingMetsRewriter(mets_path, body, new_uuid, date_time_now, software_name, software_version, rep_mets_checksums, inventory)
+            rewriter.index_ids(mets_path)
+            parser = ET.XMLParser(target=rewriter)
+            with open(mets_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(READ_SIZE), b''):
+                    parser.feed(chunk)
+            parser.close()
+        with open(output_path, 'w', encoding='utf-8', errors='xmlcharrefreplace') as output:
+            output.write(rewriter.xml_header())
+            output.flush()
+            with open(body_path, 'rb') as body:
+                shutil.copyfileobj(body, output.buffer, READ_SIZE)
+        os.replace(output_path, mets_path)
+    finally:
+        for temp_path in (body_path, output_path):
+            if temp_path.exists():
+                temp_path.unlink()
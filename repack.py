@@ -0,0 +1,344 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+import hashlib
+import io
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import zipfile
+import zlib
+
+from aip_container import zip_date_time
+import fixity
+import io_scheduler
+import metrics
+from zip_preflight import END_RECORD, END_SIGNATURE, ZIP64_END_RECORD, ZIP64_END_SIGNATURE, ZIP64_LOCATOR, ZIP64_LOCATOR_SIGNATURE
+
+
+# 7-Zip command line programs, in order of preference - the same programs pyunpack (patool) drives
+SEVEN_ZIP_PROGRAMS = ('7z', '7za', '7zr')
+# Deflate blocks compressed concurrently when several compression workers are used
+PARALLEL_CHUNK_SIZE = 4 * 1024 * 1024
+# Members smaller than this are deflated on the calling thread
+PARALLEL_THRESHOLD = 2 * PARALLEL_CHUNK_SIZE
+# Deflate window - each parallel block is primed with this much of the block before it
+DEFLATE_WINDOW = 32 * 1024
+
+# Local file header, central directory header and data descriptors (APPNOTE 4.3.7 - 4.3.12), laid out as zipfile's
+LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+CENTRAL_HEADER = struct.Struct('<4s4B4HL2L5H2L')
+DATA_DESCRIPTOR = struct.Struct('<4s3L')
+ZIP64_DATA_DESCRIPTOR = struct.Struct('<4sL2Q')
+LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+CENTRAL_HEADER_SIGNATURE = b'PK\x01\x02'
+DATA_DESCRIPTOR_SIGNATURE = b'PK\x07\x08'
+# Versions needed to extract, flag bits and the Unix "made by" system, as zipfile writes them
+DEFAULT_VERSION = 20
+ZIP64_VERSION = 45
+UNIX_SYSTEM = 3
+DATA_DESCRIPTOR_FLAG = 0x08
+UTF8_FLAG = 0x800
+
+
+def find_7z() -> str:
+    for program in SEVEN_ZIP_PROGRAMS:
+        path = shutil.which(program)
+        if path is not None:
+            return path
+    return None
+
+
+class _HashingWriter:
+    # Write-only file wrapper that hashes the container as it is written
+    # It can't seek, so zipfile writes data descriptors instead of going back to patch local headers,
+    # and the bytes hashed are exactly the bytes of the finished file
+
+    def __init__(self, f, hasher):
+        self.f = f
+        self.hasher = hasher
+        self.position = 0
+
+    def write(self, data):
+        io_scheduler.write(len(data))
+        self.hasher.update(data)
+        self.f.write(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=0):
+        raise io.UnsupportedOperation("seek")
+
+    def flush(self):
+        self.f.flush()
+
+
+def _deflate_block(data:bytes, dictionary:bytes, level:int) -> bytes:
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    # Z_SYNC_FLUSH ends the block on a byte boundary without ending the stream
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class ParallelDeflater:
+    # Raw deflate compressor (compress/flush, like zlib's) that deflates PARALLEL_CHUNK_SIZE blocks on a thread pool
+    # Blocks are primed with the end of the previous block and sync-flushed, so their concatenation
+    # is one ordinary deflate stream (the technique pigz uses) - zlib releases the GIL while compressing
+
+    def __init__(self, executor:ThreadPoolExecutor, workers:int, level:int=zlib.Z_DEFAULT_COMPRESSION):
+        self.executor = executor
+        self.level = level
+        self.max_pending = workers * 2
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.dictionary = b''
+
+    def _submit(self, data:bytes):
+        self.pending.append(self.executor.submit(_deflate_block, data, self.dictionary, self.level))
+        self.dictionary = data[-DEFLATE_WINDOW:]
+
+    def compress(self, data) -> bytes:
+        self.buffer += data
+        while len(self.buffer) >= PARALLEL_CHUNK_SIZE:
+            self._submit(bytes(self.buffer[:PARALLEL_CHUNK_SIZE]))
+            del self.buffer[:PARALLEL_CHUNK_SIZE]
+        # Hand back finished blocks in order, waiting only when too many are in flight
+        output = []
+        while self.pending and (self.pending[0].done() or len(self.pending) > self.max_pending):
+            output.append(self.pending.popleft().result())
+        return b''.join(output)
+
+    def flush(self) -> bytes:
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer.clear()
+        output = [future.result() for future in self.pending]
+        self.pending.clear()
+        # An empty final block ends the stream
+        output.append(zlib.compressobj(self.level, zlib.DEFLATED, -15).flush())
+        return b''.join(output)
+
+
+def _dos_date_time(date_time:tuple) -> tuple:
+    year, month, day, hour, minute, second = date_time
+    return (hour << 11) | (minute << 5) | (second // 2), ((year - 1980) << 9) | (month << 5) | day
+
+
+class StreamingZipWriter:
+    # ZIP writer for a stream that can't seek - every member is followed by a data descriptor, as zipfile does
+    # on such streams. Unlike zipfile it takes any raw deflate compressor, so large members can be deflated
+    # on several threads (ParallelDeflater) with public APIs only.
+    # Members need ZIP64 extensions when they may reach zipfile.ZIP64_LIMIT, the archive when it has more than
+    # 0xFFFF entries or its central directory lies past the limit - with zip64 False these raise RuntimeError.
+
+    def __init__(self, f, zip64:bool=True):
+        self.f = f
+        self.zip64 = zip64
+        # Central directory fields of every member written
+        self.entries = []
+
+    def _needs_zip64(self, name:str):
+        if not self.zip64:
+            raise RuntimeError("'%s' needs ZIP64 extensions, which are switched off" % name)
+
+    def add_directory(self, name:str, date_time:tuple):
+        self._add(name.rstrip('/') + '/', date_time, zipfile.ZIP_STORED, (0o40755 << 16) | 0x10, [], 0, None)
+
+    def add_file(self, name:str, date_time:tuple, chunks, size:int, compressor=None) -> int:
+        # Write size bytes from the chunks iterable, through compressor (None stores them) - returns their CRC-32
+        return self._add(name, date_time, zipfile.ZIP_DEFLATED if compressor is not None else zipfile.ZIP_STORED,
+                         0o644 << 16, chunks, size, compressor)
+
+    def _add(self, name:str, date_time:tuple, method:int, external_attr:int, chunks, size:int, compressor) -> int:
+        try:
+            encoded, flags = name.encode('ascii'), 0
+        except UnicodeEncodeError:
+            encoded, flags = name.encode('utf-8'), UTF8_FLAG
+        is_dir = name.endswith('/')
+        # Deflate can grow incompressible data a little - zipfile allows 5%
+        zip64 = size * 1.05 > zipfile.ZIP64_LIMIT
+        if zip64:
+            self._needs_zip64(name)
+        dos_time, dos_date = _dos_date_time(date_time)
+        version = ZIP64_VERSION if zip64 else DEFAULT_VERSION
+        if not is_dir:
+            flags |= DATA_DESCRIPTOR_FLAG
+        # Sizes and CRC follow the data, in the data descriptor - ZIP64 sizes are announced with an empty extra field
+        extra = struct.pack('<2H2Q', 1, 16, 0, 0) if zip64 else b''
+        header_size = 0xFFFFFFFF if zip64 else 0
+        offset = self.f.tell()
+        self.f.write(LOCAL_HEADER.pack(LOCAL_HEADER_SIGNATURE, version, 0, flags, method, dos_time, dos_date,
+                                       0, header_size, header_size, len(encoded), len(extra)) + encoded + extra)
+        crc, file_size, compress_size = 0, 0, 0
+        for data in chunks:
+            crc = zlib.crc32(data, crc)
+            file_size += len(data)
+            if compressor is not None:
+                data = compressor.compress(data)
+            self.f.write(data)
+            compress_size += len(data)
+        if compressor is not None:
+            data = compressor.flush()
+            self.f.write(data)
+            compress_size += len(data)
+        if not is_dir:
+            if zip64:
+                self.f.write(ZIP64_DATA_DESCRIPTOR.pack(DATA_DESCRIPTOR_SIGNATURE, crc, compress_size, file_size))
+            elif max(file_size, compress_size) > zipfile.ZIP64_LIMIT:
+                raise RuntimeError("'%s' grew past the ZIP64 limit while it was written" % name)
+            else:
+                self.f.write(DATA_DESCRIPTOR.pack(DATA_DESCRIPTOR_SIGNATURE, crc, compress_size, file_size))
+        self.entries.append((encoded, version, flags, method, dos_time, dos_date, crc, compress_size, file_size, external_attr, offset))
+        return crc
+
+    def close(self):
+        # Central directory and end records - ZIP64 fields only where the 32-bit ones overflow
+        directory_offset = self.f.tell()
+        for encoded, version, flags, method, dos_time, dos_date, crc, compress_size, file_size, external_attr, offset in self.entries:
+            zip64_fields = [value for value in (file_size, compress_size, offset) if value > zipfile.ZIP64_LIMIT]
+            extra = struct.pack('<2H%dQ' % len(zip64_fields), 1, 8 * len(zip64_fields), *zip64_fields) if zip64_fields else b''
+            if zip64_fields:
+                self._needs_zip64(encoded.decode('utf-8'))
+                version = ZIP64_VERSION
+            file_size, compress_size, offset = [0xFFFFFFFF if value > zipfile.ZIP64_LIMIT else value for value in (file_size, compress_size, offset)]
+            self.f.write(CENTRAL_HEADER.pack(CENTRAL_HEADER_SIGNATURE, version, UNIX_SYSTEM, version, 0, flags, method, dos_time, dos_date,
+                                             crc, compress_size, file_size, len(encoded), len(extra), 0, 0, 0, external_attr, offset)
+                         + encoded + extra)
+        directory_size = self.f.tell() - directory_offset
+        entries = len(self.entries)
+        if entries >= 0xFFFF or directory_offset > zipfile.ZIP64_LIMIT or directory_size > zipfile.ZIP64_LIMIT:
+            self._needs_zip64('the central directory')
+            zip64_end_offset = self.f.tell()
+            self.f.write(ZIP64_END_RECORD.pack(ZIP64_END_SIGNATURE, ZIP64_END_RECORD.size - 12, ZIP64_VERSION, ZIP64_VERSION, 0, 0,
+                                               entries, entries, directory_size, directory_offset))
+            self.f.write(ZIP64_LOCATOR.pack(ZIP64_LOCATOR_SIGNATURE, 0, zip64_end_offset, 1))
+        self.f.write(END_RECORD.pack(END_SIGNATURE, 0, 0, min(entries, 0xFFFF), min(entries, 0xFFFF),
+                                     min(directory_size, 0xFFFFFFFF), min(directory_offset, 0xFFFFFFFF), 0))
+
+
+def list_7z_members(program:str, archive_path:Path) -> list[dict]:
+    # Members of a 7z archive in archive order, from the technical listing (7z l -slt)
+    result = subprocess.run([program, 'l', '-slt', '--', str(archive_path)], stdin=subprocess.DEVNULL,
+                            capture_output=True, env=dict(os.environ, LC_ALL='C.UTF-8'))
+    if result.returncode != 0:
+        raise RuntimeError("Listing '%s' failed: %s" % (archive_path, result.stderr.decode('utf-8', 'replace').strip()))
+    output = result.stdout.decode('utf-8', 'surrogateescape')
+    # Member records follow the archive's own properties, after a line of dashes
+    _, separator, records = output.partition('\n----------\n')
+    if not separator:
+        return []
+    members = []
+    for record in records.split('\n\n'):
+        fields = dict(line.split(' = ', 1) for line in record.splitlines() if ' = ' in line)
+        if 'Path' not in fields:
+            continue
+        if fields.get('Encrypted') == '+':
+            raise RuntimeError("'%s' contains encrypted members" % archive_path)
+        is_dir = fields.get('Folder') == '+' or fields.get('Attributes', '').startswith('D')
+        members.append({
+            'path': fields['Path'],
+            'is_dir': is_dir,
+            'size': 0 if is_dir else int(fields.get('Size') or 0),
+            'crc': int(fields['CRC'], 16) if fields.get('CRC') else None,
+            'modified': fields.get('Modified', ''),
+        })
+    return members
+
+
+def _zip_date_time(modified:str) -> tuple:
+    # 7z prints 'YYYY-MM-DD HH:MM:SS[.fraction]' - clamped to the range ZIP can store, like container members
+    try:
+        timestamp = datetime.strptime(modified[:19], "%Y-%m-%d %H:%M:%S").timestamp()
+    except (ValueError, OverflowError, OSError):
+        timestamp = datetime.now().timestamp()
+    return zip_date_time(timestamp)
+
+
+def _read_exactly(stream, view:memoryview, size:int):
+    # Yield size bytes of stream in buffer-sized views
+    remaining = size
+    while remaining:
+        read = stream.readinto(view[:min(remaining, len(view))])
+        if not read:
+            raise RuntimeError("7z output ended early")
+        remaining -= read
+        yield view[:read]
+
+
+def _charge_reads(chunks, read_ratio:float):
+    # Charge the archive bytes behind each decoded chunk to the I/O budget
+    for data in chunks:
+        io_scheduler.read(int(len(data) * read_ratio))
+        yield data
+
+
+def repack_7z_to_zip(archive_path:Path, zip_path:Path, compress:bool=True, zip64:bool=True, workers:int=1) -> str:
+    # Stream every member of a 7z archive straight into a ZIP, without extracting to disk
+    # The whole archive is decoded once (7z x -so writes members back to back, in listing order),
+    # split by the listed sizes and checked against the listed CRCs. Returns the SHA-256 of the ZIP.
+    # workers - threads deflating members of PARALLEL_THRESHOLD bytes and more
+    program = find_7z()
+    if program is None:
+        raise RuntimeError("No 7-Zip program (%s) found" % ', '.join(SEVEN_ZIP_PROGRAMS))
+    members = list_7z_members(program, archive_path)
+    # 7z reads the archive itself - it is throttled through the pipe, charging the archive bytes behind each decoded byte
+    archive_size = os.stat(archive_path).st_size
+    read_ratio = archive_size / max(1, sum(member['size'] for member in members))
+    hasher = hashlib.sha256()
+    buffer = bytearray(fixity.BUFFER_SIZE)
+    view = memoryview(buffer)
+    executor = ThreadPoolExecutor(max_workers=workers) if compress and workers > 1 else None
+
+    # Written under a temporary name and renamed once complete
+    partial_path = zip_path.with_name(zip_path.name + '.partial')
+    try:
+        with io_scheduler.large_operation(archive_size), tempfile.TemporaryFile() as stderr, open(partial_path, 'wb') as f:
+            process = subprocess.Popen([program, 'x', '-so', '--', str(archive_path)], stdin=subprocess.DEVNULL,
+                                       stdout=subprocess.PIPE, stderr=stderr, env=dict(os.environ, LC_ALL='C.UTF-8'))
+            try:
+                archive = StreamingZipWriter(_HashingWriter(f, hasher), zip64)
+                for member in members:
+                    name = member['path'].replace(os.sep, '/')
+                    date_time = _zip_date_time(member['modified'])
+                    if member['is_dir']:
+                        archive.add_directory(name, date_time)
+                        continue
+                    compressor = None
+                    if executor is not None and member['size'] >= PARALLEL_THRESHOLD:
+                        compressor = ParallelDeflater(executor, workers)
+                    elif compress:
+                        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+                    chunks = _read_exactly(process.stdout, view, member['size'])
+                    crc = archive.add_file(name, date_time, _charge_reads(chunks, read_ratio), member['size'], compressor)
+                    if member['crc'] is not None and crc != member['crc']:
+                        raise RuntimeError("CRC mismatch for '%s' in '%s'" % (member['path'], archive_path))
+                    metrics.add('files_repacked')
+                    metrics.add('bytes_repacked', member['size'])
+                archive.close()
+                if process.stdout.read(1):
+                    raise RuntimeError("7z output doesn't match the listing of '%s'" % archive_path)
+            finally:
+                process.stdout.close()
+                returncode = process.wait()
+            if returncode != 0:
+                stderr.seek(0)
+                raise RuntimeError("Extracting '%s' failed: %s" % (archive_path, stderr.read().decode('utf-8', 'replace').strip()))
+            f.flush()
+            io_scheduler.advise_done(f.fileno(), f.tell())
+        os.replace(partial_path, zip_path)
+    except BaseException:
+        if partial_path.exists():
+            partial_path.unlink()
+        raise
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return hasher.hexdigest()
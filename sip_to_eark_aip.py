@@ -1,59 +1,87 @@
 from datetime import datetime
 from pathlib import Path
-import hashlib
+import argparse
 import logging
 import mimetypes
+import os
 import shutil
-import xml.etree.ElementTree as ET
 import sys
-import uuid
+
+from aip_container import CONTAINER_FORMATS, ContainerWriter
+from fixity import get_checksums_concurrently
+from ingest import INGEST_STRATEGIES, aip_relative_path, break_link, ingest_sip
+import io_scheduler
+from inventory import SIPInventory, UnsupportedEntryError, build_inventory, file_attributes, inventory_entry, is_data_fileGrp, sort_inventory
+from journal import TransformationJournal, find_unfinished_journals
+from mets_ids import IDIndex, random_uuid
+from mets_stream import STREAMING_METS_THRESHOLD, stream_update_mets
+import metrics
+import trash
+import xml_backend
 
 
 SOFTWARE_NAME = "E-ARK AIP Creator"
 SOFTWARE_VERSION = "v0.2.0-dev"
+# Rough size of one payload inventory entry in a written METS, used to pick the streaming rewriter
+INVENTORY_ENTRY_BYTES = 400
+# Where the command line scripts log, relative to the working directory
+LOG_DIRECTORY = Path('logs')
+
+
+class AIPError(Exception):
+    # A SIP, AIP or rep the transformation can't process - the command line scripts report it through fatal_error
+    pass
 
 
 def date_time_now() -> str:
     return datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
 
 
-def update_root_mets(aip_path:Path):
-    update_mets((aip_path / 'METS.xml'))
+def update_root_mets(aip_path:Path, rep_mets_checksums:dict=None, rep_names:list=None):
+    # rep_names - the AIP's non-preservation reps, if known, so the representations directory isn't listed again
+    if rep_mets_checksums is None and rep_names is not None:
+        rep_mets_checksums = get_checksums_concurrently([(aip_path / 'representations' / rep_name / 'METS.xml') for rep_name in rep_names])
+    rewrite_mets((aip_path / 'METS.xml'), rep_mets_checksums)
 
 
-def get_checksum(file:Path) -> str:
-    sha256_hash = hashlib.sha256()
-    with open(file, "rb") as f:
-        for byte_block in iter(lambda: f.read(4096), b""):
-            sha256_hash.update(byte_block)
-        return sha256_hash.hexdigest()
+def rewrite_mets(mets_path:Path, rep_mets_checksums:dict=None, inventory:list=None):
+    # Large METS go through the bounded-memory streaming rewriter, which produces the same output as update_mets
+    # A large payload inventory makes a large METS too, however small the input
+    mets_size = mets_path.stat().st_size
+    metrics.add('mets_rewritten')
+    metrics.add('mets_bytes', mets_size)
+    if mets_size + len(inventory or ()) * INVENTORY_ENTRY_BYTES >= STREAMING_METS_THRESHOLD:
+        logging.info("Streaming rewrite of '%s'" % mets_path)
+        stream_update_mets(mets_path, new_uuid, date_time_now, SOFTWARE_NAME, SOFTWARE_VERSION, rep_mets_checksums, inventory)
+    else:
+        update_mets(mets_path, rep_mets_checksums, inventory)
 
 
 def extract_namespaces(mets_path:Path) -> dict:
     # Extract namespaces from mets files
     # Store and register namespaces
     namespaces = {}
-    for _, values, in ET.iterparse(mets_path, events=['start-ns']):
-        key, value = str(values[0]), str(values[1])
+    for prefix, uri in xml_backend.iter_namespaces(mets_path):
+        key, value = str(prefix), str(uri)
         if key == 'mets':
             key = ''
         elif key == 'sip':
             key = 'aip'
             value = value.replace('SIP', 'AIP')
         namespaces[key] = value
-        ET.register_namespace(key, value)
+        xml_backend.register_namespace(key, value)
     return namespaces
 
 
-def update_mets(mets_path:Path):
+def update_mets(mets_path:Path, rep_mets_checksums:dict=None, inventory:list=None):
+    # rep_mets_checksums - {rep METS path: {'sha256': ...}} already computed by the caller, e.g. while packaging
+    # inventory - sorted payload entries (inventory.build_inventory) that replace the rep's Data file groups
 
-    id_updates = {}
-    
     # Extract namespaces
     namespaces = extract_namespaces(mets_path)
 
     # Parse mets
-    tree = ET.parse(mets_path)
+    tree = xml_backend.parse(mets_path)
 
     # Mets Element
     mets_element = tree.getroot()
@@ -92,245 +120,471 @@ def update_mets(mets_path:Path):
         metsHdr_element.remove(agent)
 
     # Add Software Agent
-    new_agent = ET.SubElement(metsHdr_element, '{%s}agent' % namespaces[''], attrib={'ROLE': 'CREATOR', 'TYPE': 'OTHER', 'OTHERTYPE': 'SOFTWARE'})
-    ET.SubElement(new_agent, '{%s}name' % namespaces['']).text = SOFTWARE_NAME
-    ET.SubElement(new_agent, '{%s}note' % namespaces[''], attrib={'{%s}NOTETYPE' % namespaces['csip']: 'SOFTWARE VERSION'}).text = SOFTWARE_VERSION
+    new_agent = xml_backend.SubElement(metsHdr_element, '{%s}agent' % namespaces[''], attrib={'ROLE': 'CREATOR', 'TYPE': 'OTHER', 'OTHERTYPE': 'SOFTWARE'})
+    xml_backend.SubElement(new_agent, '{%s}name' % namespaces['']).text = SOFTWARE_NAME
+    xml_backend.SubElement(new_agent, '{%s}note' % namespaces[''], attrib={'{%s}NOTETYPE' % namespaces['csip']: 'SOFTWARE VERSION'}).text = SOFTWARE_VERSION
+
+    # Every IDREF(S) attribute, remapped in one pass once the sections below have renewed their IDs
+    id_index = IDIndex(mets_element, namespaces[''], new_uuid)
 
     # Mets Header - DMD Section
     # Update and Store ID
     for dmdSec in mets_element.findall('{%s}dmdSec' % namespaces['']):
-        id_updates[dmdSec.get('ID')] = new_uuid()
-        dmdSec.set('ID', id_updates[dmdSec.get('ID')])
+        id_index.renew(dmdSec)
         dmdSec.set('CREATED', date_time_now())
 
     # Mets Header - AMD Section
     # Update and Store ID
     for amdSec in mets_element.findall('{%s}amdSec' % namespaces['']):
-        id_updates[amdSec.get('ID')] = new_uuid()
-        amdSec.set('ID', id_updates[amdSec.get('ID')])
+        id_index.renew(amdSec)
 
     # File Section
-    # Update ID - Don't Store
+    # Update and Store ID
     fileSec_element = mets_element.find('{%s}fileSec' % namespaces[''])
-    fileSec_element.set('ID', new_uuid())
+    id_index.renew(fileSec_element)
 
     # File Section - File Groups
     # Remove Representation File Groups - (root mets)
+    # Remove Data File Groups replaced by the inventory, pointing their ID at the inventory's
     # Update and Store ID
+    inventory_fileGrp_id = new_uuid() if inventory is not None else None
+    inventory_referenced = False
     marked_for_remove = []
     for fileGrp_element in fileSec_element.findall('{%s}fileGrp' % namespaces['']):
         if fileGrp_element.get('USE').lower().startswith('representation'):
             marked_for_remove.append(fileGrp_element)
             continue
+        elif inventory is not None and is_data_fileGrp(fileGrp_element.get('USE')):
+            id_index.id_updates[fileGrp_element.get('ID')] = inventory_fileGrp_id
+            inventory_referenced = True
+            marked_for_remove.append(fileGrp_element)
+            continue
         else:
-            id_updates[fileGrp_element.get('ID')] = new_uuid()
-            fileGrp_element.set('ID', id_updates[fileGrp_element.get('ID')])
+            id_index.renew(fileGrp_element)
             # File Section - File Group - File
             # Update and Store ID
             for file_element in fileGrp_element.findall('{%s}file' % namespaces['']):
-                id_updates[file_element.get('ID')] = new_uuid('ID')
-                file_element.set('ID', id_updates[file_element.get('ID')])
+                id_index.renew(file_element, 'ID')
     for fileGrp in marked_for_remove:
         fileSec_element.remove(fileGrp)
 
+    # File Section - Payload inventory
+    if inventory is not None:
+        inventory_fileGrp_element = xml_backend.SubElement(fileSec_element, '{%s}fileGrp' % namespaces[''], attrib={'ID': inventory_fileGrp_id, 'USE': 'Data'})
+        for entry in inventory:
+            file_element = xml_backend.SubElement(inventory_fileGrp_element, '{%s}file' % namespaces[''], attrib=file_attributes(new_uuid('ID'), entry))
+            xml_backend.SubElement(file_element, '{%s}FLocat' % namespaces[''], attrib={
+                '{%s}type' % namespaces['xlink']: 'simple',
+                '{%s}href' % namespaces['xlink']: entry[0],
+                'LOCTYPE': 'URL',
+            })
+
     # Struct Map
-    # Update ID - Don't store
+    # Update and Store ID
     structmap_element = mets_element.find('{%s}structMap' % namespaces[''])
-    structmap_element.set('ID', new_uuid())
+    id_index.renew(structmap_element)
 
     # Struct Map - Div
     root_div_element = structmap_element.find('{%s}div' % namespaces[''])
     root_div_element.set('LABEL', mets_path.parent.stem)
-    root_div_element.set('ID', new_uuid())
+    id_index.renew(root_div_element)
 
     # Struct Map - Div - Div
     # Remove representations - (root mets)
-    # Update metadata DMDID
-    # Update IDs
+    # Update and Store IDs
     marked_for_remove = []
     for div_element in root_div_element.findall('{%s}div' % namespaces['']):
         if div_element.get('LABEL').lower().startswith('representations'):
             marked_for_remove.append(div_element)
             continue
-        if div_element.get('LABEL').lower().startswith('metadata'):
-            if div_element.get('DMDID') in id_updates:
-                div_element.set('DMDID', id_updates[div_element.get('DMDID')])
-        div_element.set('ID', new_uuid())
-
-        # Struct Map - Div - Div - FPTR
-        # Update ID to fileGrp ID
-        """
-        fptr_element = div_element.find('{%s}fptr' % namespaces[''])
-        if fptr_element is not None:
-            if fptr_element.get('FILEID') in id_updates:
-                fptr_element.set('FILEID', id_updates[fptr_element.get('FILEID')])
-            else:
-                fptr_element.set('FILEID', new_uuid())
-        """
-        for fptr_element in div_element.findall('{%s}fptr' % namespaces['']):
-            if fptr_element.get('FILEID') in id_updates:
-                fptr_element.set('FILEID', id_updates[fptr_element.get('FILEID')])
-            else:
-                fptr_element.set('FILEID', new_uuid())
-
-        # Struct Map - Div - Div - MPTR
-        # Update ID to file ID
-        """
-        mptr_element = div_element.find('{%s}mptr' % namespaces[''])
-        if mptr_element is not None:
-            if mptr_element.get('FILEID') in id_updates:
-                mptr_element.set('FILEID', id_updates[mptr_element.get('FILEID')])
-            else:
-                fptr_element.set('FILEID', new_uuid())
-        """
-        for mptr_element in div_element.findall('{%s}mptr' % namespaces['']):
-            if mptr_element.get('FILEID') in id_updates:
-                mptr_element.set('FILEID', id_updates[mptr_element.get('FILEID')])
-            else:
-                mptr_element.set('FILEID', new_uuid())
+        id_index.renew(div_element)
 
     for div in marked_for_remove:
         root_div_element.remove(div)
 
-    # Add File Groups and Struct Map Divs for new representations - (root mets only)
-    representations_path = (mets_path.parent / 'representations')
-    if representations_path.is_dir():
-        for rep_path in representations_path.iterdir():
-            rep_mets_path = (rep_path / 'METS.xml')
-            if rep_path.stem.endswith('-preservation'):
-                continue
-            # File Group
-            new_fileGrp_id = new_uuid()
-            new_fileGrp_element = ET.SubElement(fileSec_element, '{%s}fileGrp' % namespaces[''], attrib={
-                'ID': new_fileGrp_id,
-                'USE': str(rep_path.relative_to(mets_path.parent))
-            })
-            new_file_id = new_uuid('ID')
-            new_file_mimetype = str(mimetypes.guess_type(rep_mets_path)[0])
-            # Fix potential depreciated mimetype
-            if new_file_mimetype == "application/x-zip-compressed": 
-                new_file_mimetype = "application/zip"
-            new_file_element = ET.SubElement(new_fileGrp_element, '{%s}file' % namespaces[''], attrib={
-                'ID': new_file_id,
-                'MIMETYPE': new_file_mimetype,
-                'SIZE': str(rep_mets_path.stat().st_size),
-                'CREATED': date_time_now(),
-                'CHECKSUM': get_checksum(rep_mets_path),
-                'CHECKSUMTYPE': 'SHA-256'
-            })
-            ET.SubElement(new_file_element, '{%s}FLocat' % namespaces[''], attrib={
-                '{%s}type' % namespaces['xlink']: 'simple',
-                '{%s}href' % namespaces['xlink']: str(rep_mets_path.relative_to(mets_path.parent)),
-                '{%s}LOCTYPE' % namespaces['']: 'URL',
-            })
-            # Struct Map
-            new_div = ET.SubElement(root_div_element, '{%s}div' % namespaces[''], attrib={
-                'ID': new_uuid(),
-                'LABEL': str(rep_path.relative_to(rep_path.parents[1]))
-            })
-            ET.SubElement(new_div, '{%s}mptr' % namespaces[''], attrib={
-                '{%s}type' % namespaces['xlink']: 'simple',
-                '{%s}href' % namespaces['xlink']: str(rep_mets_path.relative_to(rep_path)),
-                '{%s}title' % namespaces['xlink']: new_fileGrp_id,
-                '{%s}LOCTYPE' % namespaces['']: 'URL',
-            })
-
-    ET.indent(tree, space='    ', level=0)
-    tree.write(mets_path, encoding='utf-8', xml_declaration=True)
+    # Point DMDID, ADMID, FILEID etc. of every element at the new IDs
+    id_index.apply()
 
+    # A METS without a Data file group gets a Data div for the inventory
+    if inventory is not None and not inventory_referenced:
+        inventory_div = xml_backend.SubElement(root_div_element, '{%s}div' % namespaces[''], attrib={'ID': new_uuid(), 'LABEL': 'Data'})
+        xml_backend.SubElement(inventory_div, '{%s}fptr' % namespaces[''], attrib={'FILEID': inventory_fileGrp_id})
 
-def update_rep_mets(aip_path:Path):
+    # Add File Groups and Struct Map Divs for new representations - (root mets only)
+    # Checksums passed in name the rep METS, otherwise the representations directory is listed
+    representations_path = (mets_path.parent / 'representations')
+    checksums = rep_mets_checksums
+    rep_paths = []
+    if checksums is not None:
+        rep_paths = [rep_mets_path.parent for rep_mets_path in checksums]
+    elif representations_path.is_dir():
+        rep_paths = [rep_path for rep_path in representations_path.iterdir() if not rep_path.stem.endswith('-preservation')]
+        # Hash all rep METS files concurrently up front
+        checksums = get_checksums_concurrently([(rep_path / 'METS.xml') for rep_path in rep_paths])
+    for rep_path in rep_paths:
+        rep_mets_path = (rep_path / 'METS.xml')
+        # File Group
+        new_fileGrp_id = new_uuid()
+        new_fileGrp_element = xml_backend.SubElement(fileSec_element, '{%s}fileGrp' % namespaces[''], attrib={
+            'ID': new_fileGrp_id,
+            'USE': str(rep_path.relative_to(mets_path.parent))
+        })
+        new_file_id = new_uuid('ID')
+        new_file_mimetype = str(mimetypes.guess_type(rep_mets_path)[0])
+        # Fix potential depreciated mimetype
+        if new_file_mimetype == "application/x-zip-compressed": 
+            new_file_mimetype = "application/zip"
+        new_file_element = xml_backend.SubElement(new_fileGrp_element, '{%s}file' % namespaces[''], attrib={
+            'ID': new_file_id,
+            'MIMETYPE': new_file_mimetype,
+            'SIZE': str(rep_mets_path.stat().st_size),
+            'CREATED': date_time_now(),
+            'CHECKSUM': checksums[rep_mets_path]['sha256'],
+            'CHECKSUMTYPE': 'SHA-256'
+        })
+        xml_backend.SubElement(new_file_element, '{%s}FLocat' % namespaces[''], attrib={
+            '{%s}type' % namespaces['xlink']: 'simple',
+            '{%s}href' % namespaces['xlink']: str(rep_mets_path.relative_to(mets_path.parent)),
+            'LOCTYPE': 'URL',
+        })
+        # Struct Map
+        new_div = xml_backend.SubElement(root_div_element, '{%s}div' % namespaces[''], attrib={
+            'ID': new_uuid(),
+            'LABEL': str(rep_path.relative_to(rep_path.parents[1]))
+        })
+        xml_backend.SubElement(new_div, '{%s}mptr' % namespaces[''], attrib={
+            '{%s}type' % namespaces['xlink']: 'simple',
+            '{%s}href' % namespaces['xlink']: str(rep_mets_path.relative_to(rep_path)),
+            '{%s}title' % namespaces['xlink']: new_fileGrp_id,
+            'LOCTYPE': 'URL',
+        })
+
+    break_link(mets_path)
+    xml_backend.write(tree, mets_path)
+
+
+def restore_from_sip(journal:TransformationJournal, sip_relative_path:Path, aip_file_path:Path):
+    # A METS rewrite interrupted part way may have left a torn file - start again from the SIP copy
+    sip_file_path = (Path(journal.header['sip']) / sip_relative_path)
+    if sip_file_path.is_file():
+        logging.info("Restoring '%s' from '%s'" % (aip_file_path, sip_file_path))
+        break_link(aip_file_path)
+        shutil.copy2(sip_file_path, aip_file_path)
+
+
+def update_rep_mets(aip_path:Path, journal:TransformationJournal=None, payload_inventory:bool=False, inventories:dict=None, sip_inventory:SIPInventory=None):
     # Update each non-preservation METS.xml
-    for rep_path in (aip_path / 'representations').iterdir():
+    # payload_inventory - replace each rep's Data file groups with a fresh inventory of its data directory
+    # inventories - {rep name: inventory} already built by the caller, e.g. while packaging
+    # sip_inventory - the SIP's scan, which names the reps and their payload files
+    sip_rep_names = {}
+    if journal is not None:
+        sip_rep_names = {new_rep_name: sip_rep_name for sip_rep_name, new_rep_name in (journal.get_value('rep_renames') or [])}
+    if sip_inventory is not None:
+        rep_renames = plan_rep_renames(aip_path, journal, sip_inventory)
+        sip_rep_names = {new_rep_name: sip_rep_name for sip_rep_name, new_rep_name in rep_renames}
+        rep_paths = [(aip_path / 'representations' / new_rep_name) for sip_rep_name, new_rep_name in rep_renames]
+    else:
         # Ignore preservation reps
-        if rep_path.stem.endswith('-preservation'):
-            continue
+        rep_paths = [rep_path for rep_path in (aip_path / 'representations').iterdir() if not rep_path.stem.endswith('-preservation')]
+    for rep_path in rep_paths:
         rep_mets_path = (rep_path / 'METS.xml')
-        update_mets(rep_mets_path)
+        if journal is not None:
+            if journal.item_done('rep_mets', rep_path.name):
+                continue
+            if 'update_rep_mets' in journal.resumed_stages and rep_path.name in sip_rep_names:
+                restore_from_sip(journal, Path('representations', sip_rep_names[rep_path.name], 'METS.xml'), rep_mets_path)
+        inventory = None
+        if inventories is not None:
+            inventory = inventories.get(rep_path.name, [])
+        elif payload_inventory:
+            files = None
+            if sip_inventory is not None:
+                # Payload files keep their SIP sizes and mtimes, only their contents are read again
+                files = [(str(rep_path / relative_path), size, mtime) for relative_path, size, mtime in sip_inventory.payload(sip_rep_names[rep_path.name])]
+            inventory = build_inventory(rep_path, files=files)
+            logging.info("Inventoried %d payload files in '%s'" % (len(inventory), rep_path))
+        rewrite_mets(rep_mets_path, inventory=inventory)
+        if journal is not None:
+            journal.record_item('rep_mets', rep_path.name)
     pass
 
 
-def transform_representations(aip_path:Path):
+def plan_rep_renames(aip_path:Path, journal:TransformationJournal=None, sip_inventory:SIPInventory=None) -> list:
+    # [SIP rep name, AIP rep name] for each representation directory, in SIP order
+    # A journaled plan wins, so a resumed run repeats exactly the same renames
+    rep_renames = journal.get_value('rep_renames') if journal is not None else None
+    if rep_renames is not None:
+        return rep_renames
+    if sip_inventory is not None:
+        rep_names = sip_inventory.rep_names()
+    else:
+        rep_names = [rep_path.name for rep_path in (aip_path / "representations").iterdir() if rep_path.is_dir()]
+    # Rename rep name with zero padded counter
+    return [[rep_name, 'rep'+str(rep_couter).zfill(2)] for rep_couter, rep_name in enumerate(rep_names, start=1)]
+
+
+def transform_representations(aip_path:Path, journal:TransformationJournal=None, sip_inventory:SIPInventory=None):
     # For each directory in representation, rename it rep0x and create rep0x-preservation
-    rep_couter = 0
-    for rep_path in (aip_path / "representations").iterdir():
+    # The rename plan is journaled first, so a resumed run repeats exactly the same renames
+    rep_renames = journal.get_value('rep_renames') if journal is not None else None
+    if rep_renames is None:
+        rep_renames = plan_rep_renames(aip_path, sip_inventory=sip_inventory)
+        if journal is not None:
+            journal.set_value('rep_renames', rep_renames)
+
+    for rep_name, new_rep_name in rep_renames:
+        rep_path = (aip_path / "representations" / rep_name)
+        new_rep_path = (rep_path.parent / new_rep_name)
         if rep_path.is_dir():
-            rep_couter += 1
-            # Rename rep name with zero padded counter
-            new_rep_name = 'rep'+str(rep_couter).zfill(2)
-            new_rep_path = (rep_path.parent / new_rep_name)
             rep_path.rename(new_rep_path)
 
-            # Create preservation rep incl. data directory
-            new_rep_preservation_name = new_rep_name + "-preservation"
-            new_rep_preservation_path = (rep_path.parent / new_rep_preservation_name / "data")
-            new_rep_preservation_path.mkdir(parents=True, exist_ok=False)
+        # Create preservation rep incl. data directory
+        new_rep_preservation_name = new_rep_name + "-preservation"
+        new_rep_preservation_path = (rep_path.parent / new_rep_preservation_name / "data")
+        new_rep_preservation_path.mkdir(parents=True, exist_ok=journal is not None)
 
 
-def copy_sip_to_aip(sip_path:Path, aip_path:Path):
-    # Copy all directories and files from sip to aip
-    for file_folder in sip_path.iterdir():
-        if file_folder.is_dir():
-            shutil.copytree(file_folder, (aip_path / file_folder.stem), copy_function=shutil.copy2)
-        else:
-            shutil.copy2(file_folder, (aip_path / file_folder.name))
+def copy_sip_to_aip(sip_path:Path, aip_path:Path, strategy:str='copy', journal:TransformationJournal=None, sip_inventory:SIPInventory=None, output_path:Path=None):
+    # Copy (or hardlink, reflink, move) all directories and files from sip to aip
+    ingest_sip(sip_path, aip_path, strategy, journal, sip_inventory, output_path)
+
 
+def staging_directory(output_path:Path, aip_name:str) -> Path:
+    # Where an AIP is built before it is published - hidden, in the output directory so publishing is a rename
+    # The AIP keeps its own name inside it, as METS OBJIDs and labels are taken from the directory name
+    return (output_path / ('.' + aip_name + '.staging') / aip_name)
 
-def overwrite_and_create_directory(directory:Path):
-    # Delete directory if it exists and (re)create it
-    if directory.is_dir():
+
+def overwrite_and_create_directory(directory:Path, output_path:Path):
+    # (Re)create an empty directory, an existing one is moved to the trash and deleted in the background
+    if directory.exists():
         logging.info("Overwriting '%s'" % directory)
-        shutil.rmtree(directory)
+        trash.discard(directory, output_path)
     directory.mkdir(parents=True, exist_ok=False)
 
 
-def update_metadata(aip_path:Path, sip_name:str):
-    # Update referencese to SIP name with new AIP name
-    # TODO Update different types of metadata
-
-    # Descriptive DC.xml
-    dc_metadata_path = (aip_path / 'metadata' / 'descriptive' / 'DC.xml')
-    if dc_metadata_path.is_file():
-        dc_tree = ET.parse(dc_metadata_path)
-        dc_root = dc_tree.getroot()
-        for child in dc_root:
-            if sip_name in str(child.text):
-                child.text = child.text.replace(sip_name, aip_path.stem)
-    
-        dc_tree.write(dc_metadata_path, encoding='utf-8', xml_declaration=True)
+def publish_aip_directory(staging_path:Path, aip_path:Path, output_path:Path):
+    # Rename a finished AIP from its staging directory into place, an AIP it replaces goes to the trash first
+    # Readers only ever see a complete AIP - or, while one replaces another, briefly none
+    # Not there when an interrupted run published the AIP without recording it
+    if staging_path.is_dir() or not aip_path.is_dir():
+        if aip_path.exists():
+            logging.info("Replacing '%s'" % aip_path)
+            trash.move_to_trash(aip_path, output_path)
+        os.rename(staging_path, aip_path)
+    if staging_path.parent.is_dir():
+        staging_path.parent.rmdir()
+    trash.start_reaper(output_path)
+
+
+def find_metadata_files(aip_path:Path, sip_inventory:SIPInventory=None) -> list:
+    # Paths relative to the AIP of every file in metadata/ and representations/<rep>/metadata/
+    from metadata_rewrite import is_metadata_path
+    if sip_inventory is not None:
+        metadata_directories = [Path('metadata')] + [Path('representations', rep_name, 'metadata') for rep_name in sip_inventory.rep_names()]
+        return [aip_relative_path(relative_path)
+                for metadata_directory in metadata_directories if sip_inventory.is_dir(metadata_directory)
+                for relative_path, size, mtime in sip_inventory.files(metadata_directory)]
+    metadata_directories = [(aip_path / 'metadata')] + sorted((aip_path / 'representations').glob('*/metadata'))
+    return [path.relative_to(aip_path)
+            for metadata_directory in metadata_directories if metadata_directory.is_dir()
+            for path in sorted(metadata_directory.rglob('*')) if path.is_file() and is_metadata_path(path.relative_to(aip_path))]
+
+
+def update_metadata(aip_path:Path, sip_name:str, journal:TransformationJournal=None, sip_inventory:SIPInventory=None):
+    # Update references to SIP name with new AIP name in every descriptive, preservation and other metadata file
+    # Runs on the copied AIP, before representations are renamed - see metadata_rewrite for the handlers
+    # metadata_rewrite (SAX, lxml) is imported by the stages that use it, not at start-up
+    from metadata_rewrite import rewrite_metadata
+    relative_paths = find_metadata_files(aip_path, sip_inventory)
+    results = rewrite_metadata([(relative_path, (aip_path / relative_path), (aip_path / relative_path)) for relative_path in relative_paths],
+                               sip_name, aip_path.name, journal)
+    logging.info("Rewrote %d of %d metadata files" % (sum(1 for replacements in results.values() if replacements), len(relative_paths)))
 
 
 def new_uuid(prefix:str="uuid") -> str:
-    return prefix + "-" + str(uuid.uuid4())
+    return prefix + "-" + random_uuid()
+
 
+def is_rewritten_sip_file(relative_path:Path) -> bool:
+    # METS files the transformation rewrites - root METS and rep METS
+    parts = relative_path.parts
+    return (parts == ('METS.xml',)
+            or (len(parts) == 3 and parts[0] == 'representations' and parts[2] == 'METS.xml'))
 
-def transform_sip_to_aip(sip_path:Path, output_path:Path) -> str:
 
+def transform_sip_to_aip_container(sip_path:Path, output_path:Path, aip_name:str, container_format:str='zip', compress:bool=True, zip64:bool=True, payload_inventory:bool=False, sip_inventory:SIPInventory=None) -> Path:
+    # Write the AIP straight into a ZIP/TAR container
+    # Payload is streamed from the SIP once, METS and metadata are rewritten in a small staging directory
+    # and added last - rep METS after their payload, root METS after the rep METS it checksums
+    from metadata_rewrite import is_metadata_path, rewrite_metadata
     sip_name = sip_path.stem
-    aip_name = new_uuid()
+    container_path = (output_path / (aip_name + '.' + container_format))
+    staging_path = staging_directory(output_path, aip_name)
+    # Left over from an interrupted run
+    overwrite_and_create_directory(staging_path.parent, output_path)
+    staging_path.mkdir(exist_ok=False)
+
+    if sip_inventory is None:
+        sip_inventory = scan_sip(sip_path)
+
+    # Representations are renamed rep01, rep02, ... in SIP directory order
+    rep_names = {}
+    for rep_name in sip_inventory.rep_names():
+        rep_names[rep_name] = 'rep' + str(len(rep_names) + 1).zfill(2)
+
+    def container_relative_path(relative_path:Path) -> Path:
+        # Top level directories keep the stem of their name, as copy_sip_to_aip does
+        parts = list(aip_relative_path(relative_path).parts)
+        if len(parts) > 1 and parts[0] == 'representations' and parts[1] in rep_names:
+            parts[1] = rep_names[parts[1]]
+        return Path(*parts)
+
+    # The payload inventory reuses the checksums computed while streaming files into the container
+    inventories = {rep_name: [] for rep_name in rep_names.values()} if payload_inventory else None
+
+    # Metadata files are rewritten from the SIP into the staging directory once the payload is written
+    metadata_jobs = []
+
+    try:
+        with ContainerWriter(container_path, container_format, compress, zip64) as writer:
+            for relative_path, file_size, file_mtime in sip_inventory.files():
+                source = (sip_path / relative_path)
+                if is_rewritten_sip_file(relative_path):
+                    staged = (staging_path / container_relative_path(relative_path))
+                    staged.parent.mkdir(parents=True, exist_ok=True)
+                    shutil.copy2(source, staged)
+                elif is_metadata_path(aip_relative_path(relative_path)):
+                    # Keeps its SIP rep name - rewrite handlers match paths as update_metadata sees them
+                    metadata_jobs.append((aip_relative_path(relative_path), source, (staging_path / container_relative_path(relative_path))))
+                else:
+                    size, checksum = writer.add_file(source, (Path(aip_name) / container_relative_path(relative_path)).as_posix())
+                    parts = relative_path.parts
+                    if inventories is not None and len(parts) > 3 and parts[0] == 'representations' and parts[1] in rep_names and parts[2] == 'data':
+                        inventories[rep_names[parts[1]]].append(inventory_entry(Path(*parts[2:]).as_posix(), size, checksum, file_mtime))
+
+            for rep_name in rep_names.values():
+                (staging_path / 'representations' / (rep_name + '-preservation') / 'data').mkdir(parents=True, exist_ok=False)
+                writer.add_directory((Path(aip_name) / 'representations' / (rep_name + '-preservation') / 'data').as_posix())
+
+            for relative_path, source, destination in metadata_jobs:
+                destination.parent.mkdir(parents=True, exist_ok=True)
+            results = rewrite_metadata(metadata_jobs, sip_name, aip_name)
+            logging.info("Rewrote %d of %d metadata files" % (sum(1 for replacements in results.values() if replacements), len(metadata_jobs)))
+            for relative_path, source, destination in metadata_jobs:
+                # Files without the SIP name go into the container straight from the SIP
+                writer.add_file(destination if results[relative_path] else source, (Path(aip_name) / destination.relative_to(staging_path)).as_posix())
+
+            if inventories is not None:
+                inventories = {rep_name: sort_inventory(inventory) for rep_name, inventory in inventories.items()}
+            update_rep_mets(staging_path, inventories=inventories)
+            rep_mets_checksums = {}
+            for rep_name in rep_names.values():
+                rep_mets_path = (staging_path / 'representations' / rep_name / 'METS.xml')
+                _, checksum = writer.add_file(rep_mets_path, (Path(aip_name) / rep_mets_path.relative_to(staging_path)).as_posix())
+                rep_mets_checksums[rep_mets_path] = {'sha256': checksum}
+
+            update_root_mets(staging_path, rep_mets_checksums)
+            writer.add_file((staging_path / 'METS.xml'), (Path(aip_name) / 'METS.xml').as_posix())
+            logging.info("Wrote %d files, %d bytes to '%s'" % (writer.files_written, writer.bytes_written, container_path))
+    finally:
+        trash.discard(staging_path.parent, output_path)
+
+    return container_path
+
+
+def run_stage(journal:TransformationJournal, stage:str, function, *args):
+    # Run one transformation stage, skipping it if the journal says an earlier run finished it
+    if journal is not None:
+        if journal.stage_done(stage):
+            logging.info("Skipping finished stage '%s'" % stage)
+            return
+        journal.start_stage(stage)
+    with metrics.stage(stage):
+        function(*args)
+    if journal is not None:
+        journal.finish_stage(stage)
+
+
+def transform_sip_to_aip(sip_path:Path, output_path:Path, aip_name:str=None, ingest_strategy:str='copy', container_format:str=None, compress:bool=True, zip64:bool=True, payload_inventory:bool=False, journal:TransformationJournal=None, sip_inventory:SIPInventory=None) -> dict:
+    # sip_inventory - the scan made by validate_input_directories, so later stages don't list the SIP again
+    # Without a journal or inventory the SIP is validated here, raising AIPError if it isn't one
+    # Returns the AIP name and where it was written
+
+    sip_path, output_path = Path(sip_path), Path(output_path)
+    if sip_inventory is None and journal is None:
+        sip_path, output_path, sip_inventory = validate_input_directories(sip_path, output_path)
+    sip_name = sip_path.stem
+    if aip_name is None:
+        aip_name = new_uuid()
+    result = {
+        'aip': aip_name,
+        'sip': sip_path,
+        'path': None,
+        'ingest_strategy': ingest_strategy,
+        'container_format': container_format,
+    }
+
+    if container_format is not None:
+        run_stage(journal, 'package', transform_sip_to_aip_container, sip_path, output_path, aip_name, container_format, compress, zip64, payload_inventory, sip_inventory)
+        if journal is not None:
+            journal.complete()
+        result['path'] = (output_path / (aip_name + '.' + container_format))
+        return result
 
     # For Testing
     # aip_name = sip_name
 
-    aip_path = (output_path / aip_name)
-
-    # Update metadata to reflect new directory name
-    update_metadata(aip_path, sip_name)
+    # The AIP is built in a staging directory and only appears under its name once it is complete
+    published_path = (output_path / aip_name)
+    aip_path = staging_directory(output_path, aip_name)
 
-    # (Re-)create output directory
-    overwrite_and_create_directory(aip_path)
+    # (Re-)create the staging directory
+    run_stage(journal, 'overwrite_and_create_directory', overwrite_and_create_directory, aip_path, output_path)
     
     # Copy SIP contents to AIP directory
-    copy_sip_to_aip(sip_path, aip_path)
+    run_stage(journal, 'copy_sip_to_aip', copy_sip_to_aip, sip_path, aip_path, ingest_strategy, journal, sip_inventory, output_path)
+
+    # Update metadata to reflect new directory name
+    run_stage(journal, 'update_metadata', update_metadata, aip_path, sip_name, journal, sip_inventory)
 
     # Transform the AIP representations directory to AIP specification
-    transform_representations(aip_path)
+    run_stage(journal, 'transform_representations', transform_representations, aip_path, journal, sip_inventory)
+
+    run_stage(journal, 'update_rep_mets', update_rep_mets, aip_path, journal, payload_inventory, None, sip_inventory)
+
+    if journal is not None and 'update_root_mets' in journal.resumed_stages:
+        restore_from_sip(journal, Path('METS.xml'), (aip_path / 'METS.xml'))
+    rep_names = None
+    if sip_inventory is not None:
+        rep_names = [new_rep_name for sip_rep_name, new_rep_name in plan_rep_renames(aip_path, journal, sip_inventory)]
+    run_stage(journal, 'update_root_mets', update_root_mets, aip_path, None, rep_names)
 
-    update_rep_mets(aip_path)
+    run_stage(journal, 'publish', publish_aip_directory, aip_path, published_path, output_path)
 
-    update_root_mets(aip_path)
+    if journal is not None:
+        journal.complete()
 
-    return aip_name
+    result['path'] = published_path
+    return result
+
+
+def rollback_transformation(output_path:Path, journal:TransformationJournal):
+    # Remove everything an interrupted transformation wrote
+    if journal.options.get('ingest_strategy') == 'move' and 'copy_sip_to_aip' in journal.stages_started:
+        raise AIPError("Can't roll back '%s': the SIP was moved into it" % journal.aip_name)
+    aip_name = journal.aip_name
+    # A published AIP is complete, but its journal wasn't - it goes as well
+    for path in [(output_path / aip_name), staging_directory(output_path, aip_name).parent]:
+        if path.is_dir():
+            trash.discard(path, output_path)
+    for container_format in CONTAINER_FORMATS:
+        for path in [(output_path / (aip_name + '.' + container_format)), (output_path / (aip_name + '.' + container_format + '.partial'))]:
+            if path.is_file():
+                path.unlink()
+    journal.path.unlink()
+    logging.info("Rolled back '%s'" % aip_name)
 
 
 def fatal_error(error:str):
@@ -339,51 +593,120 @@ def fatal_error(error:str):
     sys.exit('Fatal Error: '+ error)
 
 
-def validate_input_directories(sip_path:Path, output_path:Path) -> tuple[Path, Path]:
+def scan_sip(sip_path:Path) -> SIPInventory:
+    try:
+        return SIPInventory.scan(sip_path)
+    except UnsupportedEntryError as e:
+        raise AIPError(str(e))
+
+
+def validate_input_directories(sip_path:Path, output_path:Path) -> tuple[Path, Path, SIPInventory]:
+    # The SIP is scanned once here - the returned SIPInventory is passed on to transform_sip_to_aip
 
     # SIP must exists
     if not sip_path.exists():
-        fatal_error(str(sip_path) + " not found")
+        raise AIPError(str(sip_path) + " not found")
 
     # SIP must be a directory
     if not sip_path.is_dir():
-        fatal_error(str(sip_path) + " is not a directory")
+        raise AIPError(str(sip_path) + " is not a directory")
     
+    sip_inventory = scan_sip(sip_path)
+
     # SIP must contain representations directory
-    representations_path = (sip_path / 'representations')
-    if not representations_path.is_dir():
-        fatal_error("SIP doesn't contain representations directory")
+    representations_path = Path('representations')
+    if not sip_inventory.is_dir(representations_path):
+        raise AIPError("SIP doesn't contain representations directory")
 
     # SIP representations directory must contatin rep directories
-    rep_paths = representations_path.iterdir()
-    if not rep_paths:
-        fatal_error("No rep directories found in representations")
+    rep_directories, rep_files = sip_inventory.entries(representations_path)
+    if not rep_directories:
+        raise AIPError("No rep directories found in representations")
         
     # SIP reps must contain METS.xml files
-    for rep_path in rep_paths:
-        mets_path = (rep_path / 'METS.xml')
-        if not mets_path.is_file():
-            fatal_error("One or more SIP representations don't contain METS.xml")
+    for rep_name in rep_directories + rep_files:
+        mets_path = (representations_path / rep_name / 'METS.xml')
+        if not sip_inventory.is_file(mets_path):
+            raise AIPError("One or more SIP representations don't contain METS.xml")
 
     # Ouput destination should be a directory if it exists
     if output_path.exists() and not output_path.is_dir():
-        fatal_error("Output destination must be a directory")
+        raise AIPError("Output destination must be a directory")
     
-    return sip_path, output_path
+    return sip_path, output_path, sip_inventory
 
-def main(argv) -> str:
-    Path("logs").mkdir(exist_ok=True)
-    logging.basicConfig(level=logging.DEBUG, filemode='a', filename='logs/sip_to_eark_aip.log', format='%(asctime)s %(levelname)s: %(funcName)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+def configure_logging():
+    LOG_DIRECTORY.mkdir(exist_ok=True)
+    logging.basicConfig(level=logging.DEBUG, filemode='a', filename=str(LOG_DIRECTORY / 'sip_to_eark_aip.log'), format='%(asctime)s %(levelname)s: %(funcName)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
 
-    if len(argv) != 2:
-        logging.error("Incorrect script call format")
-        sys.exit("Command should have the form:\npython aip_to_eark_aip.py <SIP Directory> <Output Directory>")
-    
-    sip_path, output_path = validate_input_directories(Path(argv[0]), Path(argv[1]))
-
-    aip_name = transform_sip_to_aip(sip_path, output_path)
 
-    return aip_name
+def main(argv) -> str:
+    configure_logging()
+
+    parser = argparse.ArgumentParser(prog='sip_to_eark_aip.py', description="Convert an E-ARK SIP to an E-ARK AIP")
+    parser.add_argument('sip', help="SIP directory")
+    parser.add_argument('output', help="Output directory")
+    parser.add_argument('--ingest', choices=INGEST_STRATEGIES, default='copy', help="How SIP files are brought into the AIP (default: copy)")
+    parser.add_argument('--container', choices=CONTAINER_FORMATS, default=None, help="Write the AIP as a single ZIP or TAR file instead of a directory")
+    parser.add_argument('--store', action='store_true', help="Store ZIP members without compression")
+    parser.add_argument('--no-zip64', action='store_true', help="Refuse to write ZIP64 extensions")
+    parser.add_argument('--inventory', action='store_true', help="List every payload file with a fresh size and checksum in the rep METS")
+    parser.add_argument('--resume', action='store_true', help="Continue an interrupted transformation of this SIP")
+    parser.add_argument('--rollback', action='store_true', help="Remove the output of interrupted transformations of this SIP")
+    parser.add_argument('--metrics-json', default=os.environ.get(metrics.JSON_ENVIRONMENT_VARIABLE), help="Append per-stage metrics as JSON lines to this file")
+    parser.add_argument('--metrics-textfile', default=os.environ.get(metrics.TEXTFILE_ENVIRONMENT_VARIABLE), help="Write per-stage metrics to this Prometheus textfile")
+    io_scheduler.add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    sip_path, output_path = Path(args.sip), Path(args.output)
+    # IO_SCHEDULER_DIR shares the I/O budgets with other conversions
+    io_scheduler.apply_arguments(args)
+
+    try:
+        return transform_from_arguments(args, sip_path, output_path)
+    except AIPError as e:
+        fatal_error(str(e))
+
+
+def transform_from_arguments(args, sip_path:Path, output_path:Path) -> str:
+    # The command line run after argument parsing - a resume, rollback or new transformation
+    if args.rollback:
+        rolled_back = []
+        for journal in find_unfinished_journals(output_path, sip_path):
+            rollback_transformation(output_path, journal)
+            rolled_back.append(journal.aip_name)
+        return '\n'.join(rolled_back)
+
+    unfinished = find_unfinished_journals(output_path, sip_path) if args.resume else []
+    sip_inventory = None
+    if unfinished:
+        # Resume the most recent interrupted run with the options it was started with
+        journal = TransformationJournal(unfinished[-1].path)
+        logging.info("Resuming '%s'" % journal.aip_name)
+        options = journal.options
+        # A moved SIP is (partly) consumed and can no longer be validated
+        if not (options['ingest_strategy'] == 'move' and 'copy_sip_to_aip' in journal.stages_started):
+            sip_path, output_path, sip_inventory = validate_input_directories(sip_path, output_path)
+    else:
+        sip_path, output_path, sip_inventory = validate_input_directories(sip_path, output_path)
+        options = {
+            'ingest_strategy': args.ingest,
+            'container_format': args.container,
+            'compress': not args.store,
+            'zip64': not args.no_zip64,
+            'payload_inventory': args.inventory,
+        }
+        output_path.mkdir(parents=True, exist_ok=True)
+        journal = TransformationJournal.create(output_path, sip_path, new_uuid(), options)
+
+    if args.metrics_json or args.metrics_textfile:
+        metrics.enable('sip_to_eark_aip', args.metrics_json, args.metrics_textfile, sip=str(sip_path), aip=journal.aip_name)
+    try:
+        result = transform_sip_to_aip(sip_path, output_path, journal.aip_name, journal=journal, sip_inventory=sip_inventory, **options)
+    finally:
+        metrics.disable()
+
+    return result['aip']
 
 
 if __name__ == '__main__':
@@ -0,0 +1,44 @@
+import os
+import tarfile
+import zipfile
+
+import pytest
+
+from aip_container import ContainerWriter, zip_date_time
+
+
+@pytest.mark.parametrize('mtime, date_time', [
+    (0, (1980, 1, 1, 0, 0, 0)),
+    (-86400 * 365, (1980, 1, 1, 0, 0, 0)),
+    (5_000_000_000, (2107, 12, 31, 23, 59, 58)),
+])
+def test_zip_date_time_is_clamped(mtime, date_time):
+    assert zip_date_time(mtime) == date_time
+
+
+def test_zip_container_accepts_files_older_than_1980(tmp_path):
+    source = (tmp_path / 'old.txt')
+    source.write_bytes(b'old payload')
+    os.utime(source, (0, 0))
+    container_path = (tmp_path / 'AIP.zip')
+
+    with ContainerWriter(container_path, 'zip') as writer:
+        size, sha256 = writer.add_file(source, 'AIP/old.txt')
+
+    assert size == len(b'old payload')
+    with zipfile.ZipFile(container_path) as archive:
+        assert archive.getinfo('AIP/old.txt').date_time == (1980, 1, 1, 0, 0, 0)
+        assert archive.read('AIP/old.txt') == b'old payload'
+
+
+def test_tar_container_keeps_the_modification_time(tmp_path):
+    source = (tmp_path / 'old.txt')
+    source.write_bytes(b'old payload')
+    os.utime(source, (0, 0))
+    container_path = (tmp_path / 'AIP.tar')
+
+    with ContainerWriter(container_path, 'tar') as writer:
+        writer.add_file(source, 'AIP/old.txt')
+
+    with tarfile.open(container_path) as archive:
+        assert archive.getmember('AIP/old.txt').mtime == 0
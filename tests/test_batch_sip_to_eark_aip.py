@@ -0,0 +1,30 @@
+from pathlib import Path
+
+from batch_sip_to_eark_aip import collect_sip_paths, read_manifest
+from sip_to_eark_aip import LOG_DIRECTORY
+
+
+def test_collect_sip_paths_skips_hidden_logs_and_output(tmp_path, monkeypatch):
+    for name in ('sip-b', 'sip-a', '.staging', 'logs', 'output'):
+        (tmp_path / name).mkdir()
+    (tmp_path / 'notes.txt').write_text('not a SIP')
+    monkeypatch.chdir(tmp_path)
+
+    sip_paths = collect_sip_paths(tmp_path, (tmp_path / 'output'))
+
+    assert LOG_DIRECTORY.resolve() == (tmp_path / 'logs')
+    assert sip_paths == [(tmp_path / 'sip-a'), (tmp_path / 'sip-b')]
+
+
+def test_collect_sip_paths_keeps_a_sip_named_output_without_an_output_path(tmp_path, monkeypatch):
+    (tmp_path / 'source' / 'output').mkdir(parents=True)
+    monkeypatch.chdir(tmp_path)
+
+    assert collect_sip_paths((tmp_path / 'source')) == [(tmp_path / 'source' / 'output')]
+
+
+def test_read_manifest_resolves_relative_paths(tmp_path):
+    manifest_path = (tmp_path / 'manifest.txt')
+    manifest_path.write_text("# SIPs\n\nsip-a\n/absolute/sip-b\n", encoding='utf-8')
+
+    assert read_manifest(manifest_path) == [(tmp_path / 'sip-a'), Path('/absolute/sip-b')]
@@ -0,0 +1,41 @@
+import pytest
+
+import create_preservation_mets
+import xml_backend
+
+
+ROOT_METS = '''<?xml version="1.0" encoding="UTF-8"?>
+<mets:mets xmlns:mets="http://www.loc.gov/METS/" xmlns:xlink="http://www.w3.org/1999/xlink" OBJID="AIP">
+  <mets:fileSec ID="fs"/>
+  <mets:structMap ID="sm"><mets:div ID="root" LABEL="AIP"/></mets:structMap>
+</mets:mets>
+'''
+
+
+def test_update_root_mets_for_reps_takes_checksum_dicts(tmp_path):
+    aip_path = (tmp_path / 'AIP')
+    rep_path = (aip_path / 'representations' / 'rep1-preservation')
+    rep_path.mkdir(parents=True)
+    (rep_path / 'METS.xml').write_text('<mets/>', encoding='utf-8')
+    (aip_path / 'METS.xml').write_text(ROOT_METS, encoding='utf-8')
+
+    result = create_preservation_mets.update_root_mets_for_reps(aip_path, [rep_path], {(rep_path / 'METS.xml'): {'sha256': 'cafe'}})
+
+    assert result['reps'] == [rep_path]
+    root = xml_backend.parse((aip_path / 'METS.xml')).getroot()
+    file_element = root.find('{http://www.loc.gov/METS/}fileSec/{http://www.loc.gov/METS/}fileGrp/{http://www.loc.gov/METS/}file')
+    assert file_element.get('CHECKSUM') == 'cafe'
+
+
+def test_main_parses_aip_mode(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with pytest.raises(SystemExit) as exit_info:
+        create_preservation_mets.main(['--aip', str(tmp_path / 'missing')])
+    assert exit_info.value.code == "Fatal Error: %s is not a directory" % (tmp_path / 'missing')
+
+
+def test_main_rejects_missing_arguments(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with pytest.raises(SystemExit) as exit_info:
+        create_preservation_mets.main([])
+    assert exit_info.value.code == 2
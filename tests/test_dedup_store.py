@@ -0,0 +1,58 @@
+import os
+
+import pytest
+
+from dedup_store import DedupStore, aip_names_in
+import fixity
+import ingest
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = DedupStore((tmp_path / 'output' / '.dedup-store'))
+    yield store
+    store.close()
+
+
+def payload_destination(aip_path):
+    destination = (aip_path / 'representations' / 'rep1' / 'data' / 'file.bin')
+    destination.parent.mkdir(parents=True)
+    return destination
+
+
+def test_payload_files_are_read_once(tmp_path, store, monkeypatch):
+    source = (tmp_path / 'file.bin')
+    source.write_bytes(b'payload')
+    copies = []
+    copy_and_hash = ingest.copy_and_hash
+    monkeypatch.setattr(ingest, 'copy_and_hash', lambda src, dst: copies.append(src) or copy_and_hash(src, dst))
+    monkeypatch.setattr(fixity, 'get_checksum', lambda *args, **kwargs: pytest.fail("payload hashed separately"))
+
+    for aip_name in ('AIP1', 'AIP2'):
+        aip_path = (tmp_path / 'output' / aip_name)
+        destination = payload_destination(aip_path)
+        ingest._deduplicated(store, aip_path, ingest.io_scheduler.copy_file)(str(source), str(destination))
+        assert destination.read_bytes() == b'payload'
+
+    assert len(copies) == 2
+    assert store.run_summary()['files_linked'] == 1
+    assert os.stat(tmp_path / 'output' / 'AIP1' / 'representations' / 'rep1' / 'data' / 'file.bin').st_nlink == 3
+    assert list(store.temp_path.iterdir()) == []
+
+
+def test_prune_keeps_aips_being_built_or_packaged(tmp_path, store):
+    output_path = (tmp_path / 'output')
+    (output_path / 'finished').mkdir()
+    (output_path / '.staged.staging' / 'staged').mkdir(parents=True)
+    (output_path / 'zipped.zip').write_bytes(b'')
+    (output_path / 'packaging.tar.partial').write_bytes(b'')
+    (output_path / '.work' / 'node-1' / 'worked').mkdir(parents=True)
+    (output_path / '.work' / '.daemon.staging').mkdir(parents=True)
+    live = ['finished', 'staged', 'zipped', 'packaging', 'worked', 'daemon']
+    for aip_name in live + ['deleted']:
+        store._record('0' * 64, 1, aip_name, linked=False)
+    store.flush()
+
+    assert set(live) <= aip_names_in(output_path)
+    assert store.prune_references([output_path]) == 1
+    assert store.stats()['aips'] == len(live)
@@ -0,0 +1,42 @@
+import os
+import sqlite3
+
+from fixity_cache import FixityCache
+
+
+def last_used(cache_path):
+    with sqlite3.connect(str(cache_path)) as connection:
+        return connection.execute('SELECT last_used FROM checksums').fetchone()[0]
+
+
+def test_hits_write_last_used_once_on_close(tmp_path):
+    file = (tmp_path / 'file.bin')
+    file.write_bytes(b'payload')
+    os.utime(file, ns=(0, 0))
+    stat = file.stat()
+    cache_path = (tmp_path / 'cache.sqlite')
+    cache = FixityCache(cache_path)
+    cache.put(file, stat, {'sha256': 'abc'})
+    stored = last_used(cache_path)
+
+    assert cache.get(stat, 'sha256') == 'abc'
+    assert cache.get(stat, 'md5') is None
+    # A hit doesn't write to the database
+    assert last_used(cache_path) == stored
+
+    cache.close()
+    assert last_used(cache_path) > stored
+    assert cache.stats() == {'hits': 1, 'misses': 1}
+
+
+def test_a_changed_file_misses(tmp_path):
+    file = (tmp_path / 'file.bin')
+    file.write_bytes(b'payload')
+    os.utime(file, ns=(0, 0))
+    cache = FixityCache((tmp_path / 'cache.sqlite'))
+    cache.put(file, file.stat(), {'sha256': 'abc'})
+    file.write_bytes(b'changed payload')
+    os.utime(file, ns=(0, 10))
+
+    assert cache.get(file.stat(), 'sha256') is None
+    cache.close()
@@ -0,0 +1,70 @@
+import sqlite3
+import threading
+import time
+
+from generate_sip import generate_sip
+from ingest_daemon import PROCESSED_DIRECTORY, QUEUE_FILENAME, IngestDaemon, InboxWatcher, WorkQueue
+
+
+def jobs(queue_path) -> list:
+    with sqlite3.connect(str(queue_path)) as connection:
+        return connection.execute('SELECT sip, aip, status, attempts FROM jobs ORDER BY id').fetchall()
+
+
+def test_running_jobs_are_queued_again_after_a_restart(tmp_path):
+    queue_path = (tmp_path / QUEUE_FILENAME)
+    work_queue = WorkQueue(queue_path)
+    first = work_queue.enqueue((tmp_path / 'sip-1'), 100)
+    second = work_queue.enqueue((tmp_path / 'sip-2'), 200)
+    job_id, sip, aip_name = work_queue.claim()
+    assert aip_name == first
+    # The daemon dies with the job running
+    work_queue.close()
+
+    work_queue = WorkQueue(queue_path)
+    assert work_queue.counts() == {'queued': 1, 'running': 1, 'converted': 0, 'failed': 0}
+    assert work_queue.requeue_running() == 1
+    assert work_queue.requeue_running() == 0
+
+    # The interrupted job keeps its place and its AIP name
+    assert work_queue.claim() == (job_id, sip, first)
+    assert work_queue.claim()[2] == second
+    work_queue.close()
+    assert [(status, attempts) for sip, aip, status, attempts in jobs(queue_path)] == [('running', 2), ('running', 1)]
+
+
+def test_daemon_finishes_the_interrupted_queue(tmp_path):
+    inbox_path, outbox_path = (tmp_path / 'inbox'), (tmp_path / 'outbox')
+    outbox_path.mkdir()
+    queue_path = (outbox_path / QUEUE_FILENAME)
+    for name in ('sip-1', 'sip-2'):
+        generate_sip(inbox_path, name, reps=1, files_per_rep=2, size_distribution='fixed:1024')
+        (inbox_path / (name + '.ready')).touch()
+    # An earlier daemon queued sip-1 and died while converting it
+    work_queue = WorkQueue(queue_path)
+    interrupted = work_queue.enqueue((inbox_path / 'sip-1'), 2048)
+    work_queue.claim()
+    work_queue.close()
+
+    work_queue = WorkQueue(queue_path)
+    daemon = IngestDaemon(inbox_path, outbox_path, work_queue, InboxWatcher(inbox_path, marker_suffix='.ready'), workers=1, poll_seconds=0.2)
+    thread = threading.Thread(target=daemon.run)
+    thread.start()
+    try:
+        deadline = time.monotonic() + 120
+        while work_queue.counts()['converted'] < 2:
+            assert time.monotonic() < deadline, work_queue.counts()
+            time.sleep(0.1)
+    finally:
+        daemon.stop()
+        thread.join(timeout=60)
+    work_queue.close()
+
+    # sip-1 was converted once, under the name it was queued with, and not queued a second time
+    assert [(sip, status) for sip, aip, status, attempts in jobs(queue_path)] == [
+        (str(inbox_path / 'sip-1'), 'converted'), (str(inbox_path / 'sip-2'), 'converted')]
+    assert jobs(queue_path)[0][1:] == (interrupted, 'converted', 2)
+    aips = sorted(aip for sip, aip, status, attempts in jobs(queue_path))
+    assert sorted(path.name for path in outbox_path.iterdir() if not path.name.startswith('.')) == aips
+    assert all((outbox_path / aip / 'METS.xml').is_file() for aip in aips)
+    assert sorted(path.name for path in inbox_path.iterdir()) == [PROCESSED_DIRECTORY]
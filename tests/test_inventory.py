@@ -0,0 +1,56 @@
+import os
+
+import pytest
+
+from ingest import ingest_sip
+from inventory import SIPInventory, UnsupportedEntryError, scan_files
+from sip_to_eark_aip import AIPError, scan_sip
+
+
+def write_sip(sip_path):
+    (sip_path / 'representations' / 'rep1').mkdir(parents=True)
+    (sip_path / 'METS.xml').write_text('<mets/>')
+    (sip_path / 'representations' / 'rep1' / 'METS.xml').write_text('<mets/>')
+
+
+def test_linked_data_directory_is_scanned_and_ingested(tmp_path):
+    payload_path = (tmp_path / 'payload')
+    payload_path.mkdir()
+    (payload_path / 'file.txt').write_text('payload')
+    sip_path = (tmp_path / 'sip')
+    write_sip(sip_path)
+    os.symlink(payload_path, (sip_path / 'representations' / 'rep1' / 'data'))
+
+    sip_inventory = SIPInventory.scan(sip_path)
+    assert [(str(path), size) for path, size, mtime in sip_inventory.payload('rep1')] == [('data/file.txt', 7)]
+
+    aip_path = (tmp_path / 'output' / 'AIP')
+    aip_path.mkdir(parents=True)
+    ingest_sip(sip_path, aip_path, 'copy', sip_inventory=sip_inventory)
+    assert (aip_path / 'representations' / 'rep1' / 'data' / 'file.txt').read_text() == 'payload'
+
+
+@pytest.mark.skipif(not hasattr(os, 'mkfifo'), reason="no FIFOs")
+def test_special_files_fail_validation(tmp_path):
+    sip_path = (tmp_path / 'sip')
+    write_sip(sip_path)
+    os.mkfifo(sip_path / 'representations' / 'rep1' / 'pipe')
+
+    with pytest.raises(AIPError, match="neither a file nor a directory"):
+        scan_sip(sip_path)
+    # Scans that only size a SIP skip it
+    assert len(scan_files(sip_path, strict=False)) == 2
+
+
+def test_broken_links_and_link_loops_fail_validation(tmp_path):
+    sip_path = (tmp_path / 'sip')
+    write_sip(sip_path)
+    os.symlink((tmp_path / 'missing'), (sip_path / 'broken'))
+    with pytest.raises(UnsupportedEntryError):
+        SIPInventory.scan(sip_path)
+
+    (sip_path / 'broken').unlink()
+    os.symlink(sip_path, (sip_path / 'representations' / 'loop'))
+    with pytest.raises(UnsupportedEntryError, match="links to a directory containing it"):
+        SIPInventory.scan(sip_path)
+    assert len(scan_files(sip_path, strict=False)) == 2
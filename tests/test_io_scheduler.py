@@ -0,0 +1,166 @@
+from multiprocessing import get_context
+import os
+import time
+
+import pytest
+
+import io_scheduler
+from io_scheduler import IOScheduler, TokenBucket, _LocalRecord, _SharedRecord, parse_rate
+
+
+class FakeClock:
+    # Stands in for the time module - sleeping advances the clock instead of waiting
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def perf_counter(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(io_scheduler, 'time', clock)
+    return clock
+
+
+@pytest.fixture(autouse=True)
+def unscheduled(monkeypatch):
+    for variable in (io_scheduler.LIMIT_ENVIRONMENT_VARIABLE, io_scheduler.READ_LIMIT_ENVIRONMENT_VARIABLE,
+                     io_scheduler.WRITE_LIMIT_ENVIRONMENT_VARIABLE, io_scheduler.MAX_LARGE_ENVIRONMENT_VARIABLE,
+                     io_scheduler.LARGE_THRESHOLD_ENVIRONMENT_VARIABLE, io_scheduler.FADVISE_ENVIRONMENT_VARIABLE,
+                     io_scheduler.DIRECTORY_ENVIRONMENT_VARIABLE):
+        monkeypatch.delenv(variable, raising=False)
+    monkeypatch.setattr(io_scheduler, 'SCHEDULER', None)
+
+
+def test_parse_rate():
+    assert parse_rate(None) is None
+    assert parse_rate('') is None
+    assert parse_rate('512') == 512
+    assert parse_rate('200M') == 200 * 1024 * 1024
+    assert parse_rate('1.5KB') == 1536
+    with pytest.raises(ValueError):
+        parse_rate('0')
+
+
+def test_token_bucket_limits_the_rate(clock):
+    bucket = TokenBucket(1000, _LocalRecord(2))
+
+    # A full bucket passes a burst of one second's worth straight through
+    assert bucket.consume(1000) == 0
+    # Then requests wait off their debt
+    assert bucket.consume(500) == pytest.approx(0.5)
+    assert bucket.consume(1000) == pytest.approx(1.0)
+    # An idle bucket saves up at most BURST_SECONDS
+    clock.sleep(10)
+    assert bucket.consume(1500) == pytest.approx(0.5)
+    assert clock.slept[:2] == [pytest.approx(0.5), pytest.approx(1.0)]
+
+
+def test_scheduler_applies_total_and_per_kind_limits(clock):
+    scheduler = IOScheduler(limit=1000, read_limit=500)
+
+    scheduler.read(500)
+    scheduler.write(500)
+    # Reads wait for their own budget - the second refills the total one by 1000 bytes meanwhile
+    scheduler.read(500)
+    # Writes are held by the total budget, which has 500 bytes left
+    scheduler.write(1000)
+    stats = scheduler.stats()
+
+    assert stats['read_bytes'] == 1000 and stats['write_bytes'] == 1500
+    assert stats['read_throttled_seconds'] == pytest.approx(1.0)
+    assert stats['write_throttled_seconds'] == pytest.approx(0.5)
+
+
+def test_shared_buckets_are_one_budget(tmp_path, clock):
+    # Separate open files, as in separate processes - the bucket state lives in the shared file
+    first = TokenBucket(1000, _SharedRecord((tmp_path / 'total.bucket'), 2))
+    second = TokenBucket(1000, _SharedRecord((tmp_path / 'total.bucket'), 2))
+
+    assert first.consume(1000) == 0
+    assert second.consume(1000) == pytest.approx(1.0)
+
+
+def hold_large_slot(directory, log_path, seconds):
+    scheduler = IOScheduler(max_large=1, large_threshold=100, directory=directory)
+    with scheduler.large_operation(1000):
+        start = time.time()
+        time.sleep(seconds)
+        end = time.time()
+    with open(log_path, 'a') as f:
+        f.write('%f %f\n' % (start, end))
+
+
+def test_large_operations_are_capped_across_processes(tmp_path):
+    log_path = (tmp_path / 'slots.log')
+    context = get_context('spawn')
+    processes = [context.Process(target=hold_large_slot, args=((tmp_path / 'scheduler'), log_path, 0.3)) for _ in range(3)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(timeout=60)
+        assert process.exitcode == 0
+
+    intervals = sorted(tuple(map(float, line.split())) for line in log_path.read_text().splitlines())
+    assert len(intervals) == 3
+    for (_, end), (start, _) in zip(intervals, intervals[1:]):
+        assert start >= end
+    stats = IOScheduler(directory=(tmp_path / 'scheduler')).stats()
+    assert stats['large_operations'] == 3
+    assert stats['large_wait_seconds'] > 0
+
+
+def test_small_operations_skip_the_cap(tmp_path):
+    scheduler = IOScheduler(max_large=1, large_threshold=100, directory=tmp_path)
+    with scheduler.large_operation(1000):
+        # A file under the threshold doesn't wait for the held slot
+        with scheduler.large_operation(10):
+            pass
+    assert scheduler.stats()['large_operations'] == 1
+
+
+def test_unscheduled_by_default(tmp_path, monkeypatch):
+    assert io_scheduler.configure_from_environment() is None
+    assert io_scheduler.SCHEDULER is None
+    assert io_scheduler.large_operation(10 ** 12) is io_scheduler._UNSCHEDULED
+    io_scheduler.read(10 ** 12)
+    io_scheduler.write(10 ** 12)
+
+    source = (tmp_path / 'source.txt')
+    source.write_text('payload')
+    os.utime(source, (0, 1234567))
+    copied = []
+    copy2 = io_scheduler.shutil.copy2
+    monkeypatch.setattr(io_scheduler.shutil, 'copy2', lambda src, dst: copied.append(src) or copy2(src, dst))
+    destination = io_scheduler.copy_file(source, (tmp_path / 'destination.txt'))
+
+    # Without a scheduler copies go straight to shutil.copy2
+    assert copied == [source]
+    assert (tmp_path / 'destination.txt').read_text() == 'payload'
+    assert os.stat(destination).st_mtime == 1234567
+
+
+def test_configured_from_environment(tmp_path, monkeypatch):
+    monkeypatch.setenv(io_scheduler.LIMIT_ENVIRONMENT_VARIABLE, '10M')
+    monkeypatch.setenv(io_scheduler.MAX_LARGE_ENVIRONMENT_VARIABLE, '2')
+    monkeypatch.setenv(io_scheduler.DIRECTORY_ENVIRONMENT_VARIABLE, str(tmp_path))
+
+    scheduler = io_scheduler.configure_from_environment()
+
+    assert io_scheduler.SCHEDULER is scheduler
+    assert (scheduler.limit, scheduler.max_large, scheduler.directory) == (10 * 1024 * 1024, 2, tmp_path)
+    source = (tmp_path / 'source.txt')
+    source.write_text('payload')
+    io_scheduler.copy_file(source, (tmp_path / 'destination.txt'))
+    assert (tmp_path / 'destination.txt').read_text() == 'payload'
+    assert scheduler.stats()['read_bytes'] == len('payload')
@@ -0,0 +1,137 @@
+from pathlib import Path
+import os
+
+import pytest
+
+from generate_sip import generate_sip
+import ingest
+from ingest import _journaled_copy_intact
+from journal import TransformationJournal, find_unfinished_journals
+import sip_to_eark_aip
+from sip_to_eark_aip import main, staging_directory
+
+
+class Crash(Exception):
+    # Stands in for the process dying part way through a transformation
+    pass
+
+
+@pytest.fixture
+def sip_path(tmp_path, monkeypatch):
+    # main logs to a directory relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    return generate_sip((tmp_path / 'sips'), 'sip-1', reps=2, files_per_rep=3, size_distribution='fixed:1024')
+
+
+def visible(output_path) -> list:
+    return sorted(path.name for path in output_path.iterdir() if not path.name.startswith('.'))
+
+
+def crash_after(count:int, function):
+    # Wrap a function to raise Crash on its call after count calls
+    calls = []
+
+    def crashing(*args, **kwargs):
+        if len(calls) == count:
+            raise Crash()
+        calls.append(args)
+        return function(*args, **kwargs)
+    return crashing
+
+
+def counted(function, calls:list):
+    def counting(*args, **kwargs):
+        calls.append(args[0])
+        return function(*args, **kwargs)
+    return counting
+
+
+def payload(path) -> list:
+    return sorted(file.read_bytes() for file in path.rglob('*.bin'))
+
+
+def interrupted_journal(output_path, sip_path) -> TransformationJournal:
+    [journal] = find_unfinished_journals(output_path, sip_path)
+    return journal
+
+
+def test_resume_after_a_crash_between_stages(tmp_path, sip_path, monkeypatch):
+    output_path = (tmp_path / 'aips')
+    with monkeypatch.context() as patch:
+        patch.setattr(sip_to_eark_aip, 'update_rep_mets', crash_after(0, sip_to_eark_aip.update_rep_mets))
+        with pytest.raises(Crash):
+            main([str(sip_path), str(output_path)])
+    journal = interrupted_journal(output_path, sip_path)
+    assert journal.stage_done('copy_sip_to_aip') and not journal.stage_done('update_rep_mets')
+    assert visible(output_path) == [journal.path.name]
+
+    copies = []
+    monkeypatch.setattr(ingest, 'copy_and_hash', counted(ingest.copy_and_hash, copies))
+    aip_name = main([str(sip_path), str(output_path), '--resume'])
+
+    # The copied SIP is taken as it is, and the AIP is finished under the journal's name
+    assert aip_name == journal.aip_name
+    assert copies == []
+    assert visible(output_path) == [aip_name]
+    assert (output_path / aip_name / 'METS.xml').is_file()
+    assert not journal.path.exists()
+
+
+def test_resume_recopies_only_what_the_journal_cannot_vouch_for(tmp_path, sip_path, monkeypatch):
+    output_path = (tmp_path / 'aips')
+    with monkeypatch.context() as patch:
+        patch.setattr(ingest, 'copy_and_hash', crash_after(4, ingest.copy_and_hash))
+        with pytest.raises(Crash):
+            main([str(sip_path), str(output_path)])
+    journal = interrupted_journal(output_path, sip_path)
+    recorded = sorted(journal.files)
+    assert len(recorded) == 4
+    assert all(journal.files[path]['sha256'] for path in recorded)
+
+    # A recorded payload file torn by the crash - same size, other content
+    [torn] = [path for path in recorded if path.endswith('.bin')]
+    torn_path = (staging_directory(output_path, journal.aip_name) / ingest.aip_relative_path(Path(torn)))
+    torn_path.write_bytes(b'\0' * torn_path.stat().st_size)
+
+    copies = []
+    monkeypatch.setattr(ingest, 'copy_and_hash', counted(ingest.copy_and_hash, copies))
+    aip_name = main([str(sip_path), str(output_path), '--resume'])
+
+    copied = {Path(source).relative_to(sip_path).as_posix() for source in copies}
+    assert torn in copied
+    assert not copied & (set(recorded) - {torn})
+    assert visible(output_path) == [aip_name]
+    # The AIP's payload is the SIP's
+    assert payload(output_path / aip_name) == payload(sip_path)
+
+
+def test_unhashed_copies_are_checked_by_modification_time(tmp_path):
+    destination = (tmp_path / 'file.txt')
+    destination.write_text('content')
+    stat = destination.stat()
+    record = {'size': stat.st_size, 'sha256': None, 'mtime_ns': stat.st_mtime_ns}
+
+    assert _journaled_copy_intact(destination, record)
+    os.utime(destination, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert not _journaled_copy_intact(destination, record)
+    destination.unlink()
+    assert not _journaled_copy_intact(destination, record)
+
+
+def test_rollback_removes_the_interrupted_output(tmp_path, sip_path, monkeypatch):
+    output_path = (tmp_path / 'aips')
+    with monkeypatch.context() as patch:
+        patch.setattr(sip_to_eark_aip, 'transform_representations', crash_after(0, sip_to_eark_aip.transform_representations))
+        with pytest.raises(Crash):
+            main([str(sip_path), str(output_path)])
+    journal = interrupted_journal(output_path, sip_path)
+    assert staging_directory(output_path, journal.aip_name).is_dir()
+
+    assert main([str(sip_path), str(output_path), '--rollback']) == journal.aip_name
+
+    assert find_unfinished_journals(output_path, sip_path) == []
+    assert not staging_directory(output_path, journal.aip_name).parent.exists()
+    assert not journal.path.exists()
+    assert visible(output_path) == []
+    # The SIP is untouched and can be converted again
+    assert main([str(sip_path), str(output_path)]) in visible(output_path)
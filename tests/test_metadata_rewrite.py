@@ -0,0 +1,122 @@
+import fixity
+import metadata_rewrite
+from metadata_rewrite import has_internal_subset, rewrite_text, rewrite_xml
+
+SIP_NAME = 'SIP-001'
+AIP_NAME = 'AIP-001'
+
+
+def rewrite(rewriter, tmp_path, content:bytes):
+    source = (tmp_path / 'source')
+    source.write_bytes(content)
+    destination = (tmp_path / 'destination')
+    replacements = rewriter(source, destination, SIP_NAME, AIP_NAME)
+    return destination.read_bytes(), replacements
+
+
+def test_xml_replaces_whole_values_only(tmp_path):
+    content = (b'<?xml version="1.0" encoding="UTF-8"?>\n'
+               b'<ead id="SIP-001" label="SIP-001-v2">'
+               b'<unitid> SIP-001 </unitid>'
+               b'<unittitle>Records of SIP-001</unittitle>'
+               b'<!--SIP-001--><!--copied from SIP-001-->'
+               b'</ead>')
+
+    output, replacements = rewrite(rewrite_xml, tmp_path, content)
+
+    assert replacements == 3
+    assert b'id="AIP-001"' in output
+    assert b'label="SIP-001-v2"' in output
+    assert b'<unitid> AIP-001 </unitid>' in output
+    assert b'<unittitle>Records of SIP-001</unittitle>' in output
+    assert b'<!--AIP-001--><!--copied from SIP-001-->' in output
+
+
+def test_xml_text_runs_over_the_buffer_are_kept(tmp_path, monkeypatch):
+    monkeypatch.setattr(metadata_rewrite, 'TEXT_BUFFER_CHARS', 8)
+    content = b'<ead><note>SIP-001 and more SIP-001</note><unitid>SIP-001</unitid></ead>'
+
+    output, replacements = rewrite(rewrite_xml, tmp_path, content)
+
+    assert replacements == 1
+    assert b'<note>SIP-001 and more SIP-001</note><unitid>AIP-001</unitid>' in output
+
+
+def test_xml_with_internal_subset_is_rewritten_as_text(tmp_path):
+    content = (b'<?xml version="1.0"?>\n'
+               b'<!DOCTYPE ead [\n'
+               b'  <!ATTLIST unitid type CDATA "local">\n'
+               b'  <!ENTITY repo "Archive">\n'
+               b']>\n'
+               b'<ead><unitid>SIP-001</unitid><repository>&repo;</repository>'
+               b'<unittitle>SIP-001-v2</unittitle></ead>\n')
+
+    output, replacements = rewrite(rewrite_xml, tmp_path, content)
+
+    assert replacements == 1
+    assert output == content.replace(b'<unitid>SIP-001<', b'<unitid>AIP-001<')
+
+
+def test_has_internal_subset(tmp_path):
+    with_subset = (tmp_path / 'with.xml')
+    with_subset.write_bytes(b'<!DOCTYPE ead [<!ENTITY a "b">]><ead/>')
+    external_only = (tmp_path / 'external.xml')
+    external_only.write_bytes(b'<!DOCTYPE ead SYSTEM "ead.dtd"><ead/>')
+    no_doctype = (tmp_path / 'none.xml')
+    no_doctype.write_bytes(b'<ead/>')
+    broken = (tmp_path / 'broken.xml')
+    broken.write_bytes(b'<ead')
+
+    assert has_internal_subset(with_subset)
+    assert not has_internal_subset(external_only)
+    assert not has_internal_subset(no_doctype)
+    assert not has_internal_subset(broken)
+
+
+def test_unparseable_xml_replaces_whole_values_as_text(tmp_path):
+    content = b'<ead><unitid>SIP-001</unitid><unitid>SIP-001-v2</unitid>'
+
+    output, replacements = rewrite(rewrite_xml, tmp_path, content)
+
+    assert replacements == 1
+    assert output == b'<ead><unitid>AIP-001</unitid><unitid>SIP-001-v2</unitid>'
+
+
+def test_text_replaces_whole_lines_and_fields_only(tmp_path):
+    content = (b'SIP-001\n'
+               b'id,title\n'
+               b'SIP-001,Records of SIP-001\n'
+               b'"SIP-001"; SIP-001 ;SIP-001-v2\n'
+               b'{"id": "SIP-001", "parent": "SIP-0012"}\n'
+               b'SIP-001')
+
+    output, replacements = rewrite(rewrite_text, tmp_path, content)
+
+    assert replacements == 6
+    assert output == (b'AIP-001\n'
+                      b'id,title\n'
+                      b'AIP-001,Records of SIP-001\n'
+                      b'"AIP-001"; AIP-001 ;SIP-001-v2\n'
+                      b'{"id": "AIP-001", "parent": "SIP-0012"}\n'
+                      b'AIP-001')
+
+
+def test_text_values_split_over_buffers(tmp_path, monkeypatch):
+    monkeypatch.setattr(fixity, 'BUFFER_SIZE', 3)
+    content = b'SIP-001\nxSIP-001\nSIP-001,SIP-001x,SIP-001'
+
+    output, replacements = rewrite(rewrite_text, tmp_path, content)
+
+    assert replacements == 3
+    assert output == b'AIP-001\nxSIP-001\nAIP-001,SIP-001x,AIP-001'
+
+
+def test_text_long_values_are_kept(tmp_path, monkeypatch):
+    monkeypatch.setattr(fixity, 'BUFFER_SIZE', 4)
+    monkeypatch.setattr(metadata_rewrite, 'MAX_VALUE_BYTES', 8)
+    content = b'x' * 20 + b'SIP-001\nSIP-001'
+
+    output, replacements = rewrite(rewrite_text, tmp_path, content)
+
+    assert replacements == 1
+    assert output == b'x' * 20 + b'SIP-001\nAIP-001'
@@ -0,0 +1,165 @@
+from xml.etree import ElementTree as ET
+import gc
+import itertools
+import time
+import uuid
+
+import pytest
+
+from mets_ids import IDIndex, random_uuid, remap_idrefs
+from mets_stream import stream_update_mets
+import sip_to_eark_aip
+import xml_backend
+
+
+METS_NS = 'http://www.loc.gov/METS/'
+M = '{%s}' % METS_NS
+
+SIP_METS = '''<?xml version="1.0" encoding="UTF-8"?>
+<mets:mets xmlns:mets="http://www.loc.gov/METS/" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:csip="https://DILCIS.eu/XML/METS/CSIPExtensionMETS" xmlns:xlink="http://www.w3.org/1999/xlink" xmlns:ext="urn:example" OBJID="sip" xsi:schemaLocation="http://www.loc.gov/METS/ http://www.loc.gov/standards/mets/mets.xsd">
+  <mets:metsHdr CREATEDATE="2020-01-01T00:00:00" csip:OAISPACKAGETYPE="SIP"/>
+  <mets:dmdSec ID="dmd-1" CREATED="2020-01-01T00:00:00"><mets:mdWrap MDTYPE="OTHER"><mets:xmlData><ext:record ADMID="amd-1"/></mets:xmlData></mets:mdWrap></mets:dmdSec>
+  <mets:dmdSec ID="dmd-2" CREATED="2020-01-01T00:00:00"/>
+  <mets:amdSec ID="amd-1"><mets:digiprovMD ID="prov-1"/></mets:amdSec>
+  <mets:amdSec ID="amd-2"/>
+  <mets:fileSec ID="fs-1">
+    <mets:fileGrp ID="grp-doc" USE="Documentation" ADMID="amd-2">
+      <mets:file ID="file-1" ADMID="amd-1 external-1 amd-2" DMDID="dmd-2  dmd-1"><mets:FLocat LOCTYPE="URL" xlink:href="documentation/a.txt"/></mets:file>
+      <mets:file ID="file-2" ADMID="external-2" DMDID="dmd-1"><mets:FLocat LOCTYPE="URL" xlink:href="documentation/b.txt"/></mets:file>
+    </mets:fileGrp>
+  </mets:fileSec>
+  <mets:structMap ID="sm-1" TYPE="PHYSICAL">
+    <mets:div ID="div-root" LABEL="sip" DMDID="dmd-1 dmd-2" ADMID="amd-2 amd-1">
+      <mets:div ID="div-doc" LABEL="Documentation" DMDID="external-3"><mets:fptr FILEID="grp-doc"/><mets:fptr FILEID="missing"/></mets:div>
+    </mets:div>
+  </mets:structMap>
+</mets:mets>
+'''
+
+
+@pytest.fixture(autouse=True)
+def restore_backend(monkeypatch):
+    monkeypatch.setattr(xml_backend, 'BACKEND', xml_backend.BACKEND)
+
+
+@pytest.fixture
+def numbered_uuid():
+    counter = itertools.count()
+    return lambda prefix='uuid': '%s-%d' % (prefix, next(counter))
+
+
+def converted(path, backend:str, new_uuid):
+    mets_path = (path / 'AIP' / 'METS.xml')
+    mets_path.parent.mkdir(parents=True)
+    mets_path.write_text(SIP_METS, encoding='utf-8')
+    if backend == 'stream':
+        stream_update_mets(mets_path, new_uuid, sip_to_eark_aip.date_time_now, sip_to_eark_aip.SOFTWARE_NAME, sip_to_eark_aip.SOFTWARE_VERSION)
+    else:
+        xml_backend.use_backend(backend)
+        sip_to_eark_aip.update_mets(mets_path)
+    return ET.parse(mets_path).getroot()
+
+
+def test_remap_idrefs_keeps_unknown_ids():
+    id_updates = {'amd-1': 'uuid-1', 'amd-2': 'uuid-2'}
+
+    assert remap_idrefs('ADMID', 'amd-1', id_updates, random_uuid) == 'uuid-1'
+    assert remap_idrefs('ADMID', 'amd-2 external amd-1', id_updates, random_uuid) == 'uuid-2 external uuid-1'
+    assert remap_idrefs('DMDID', 'external', id_updates, random_uuid) == 'external'
+    assert remap_idrefs('ADMID', '', id_updates, random_uuid) == ''
+    assert remap_idrefs('FILEID', 'missing', id_updates, lambda: 'fresh') == 'fresh'
+
+
+def test_id_index_remaps_references_before_and_after_their_target(numbered_uuid):
+    root = ET.fromstring(SIP_METS)
+    id_index = IDIndex(root, METS_NS, numbered_uuid)
+    file_1 = root.find('.//%sfile[@ID="file-1"]' % M)
+    renewed = {element.get('ID'): id_index.renew(element) for element in root.iter() if element.tag in (M + 'dmdSec', M + 'amdSec')}
+    id_index.apply()
+
+    assert file_1.get('ADMID') == '%s external-1 %s' % (renewed['amd-1'], renewed['amd-2'])
+    assert file_1.get('DMDID') == '%s %s' % (renewed['dmd-2'], renewed['dmd-1'])
+    # Attributes of embedded metadata aren't METS IDREFs
+    assert root.find('.//{urn:example}record').get('ADMID') == 'amd-1'
+
+
+@pytest.mark.parametrize('backend', ['etree', 'lxml', 'stream'])
+def test_update_mets_remaps_idrefs_consistently(tmp_path, monkeypatch, numbered_uuid, backend):
+    if backend == 'lxml':
+        pytest.importorskip('lxml')
+    monkeypatch.setattr(sip_to_eark_aip, 'new_uuid', numbered_uuid)
+    root = converted(tmp_path, backend, numbered_uuid)
+    dmd_ids = [element.get('ID') for element in root.findall(M + 'dmdSec')]
+    amd_ids = [element.get('ID') for element in root.findall(M + 'amdSec')]
+    file_group = root.find('%sfileSec/%sfileGrp' % (M, M))
+    file_1, file_2 = file_group.findall(M + 'file')
+    root_div = root.find('%sstructMap/%sdiv' % (M, M))
+    doc_div = root_div.find(M + 'div')
+    fptrs = doc_div.findall(M + 'fptr')
+
+    # Every renewed ID is new and unique
+    ids = [element.get('ID') for element in root.iter() if element.get('ID') is not None]
+    assert len(ids) == len(set(ids))
+    assert not {'dmd-1', 'dmd-2', 'amd-1', 'amd-2', 'grp-doc', 'file-1', 'div-doc'} & set(ids)
+    # ADMID and DMDID on fileGrp, file and div, single and multi-valued, in their original order
+    assert file_group.get('ADMID') == amd_ids[1]
+    assert file_1.get('ADMID') == '%s external-1 %s' % (amd_ids[0], amd_ids[1])
+    assert file_1.get('DMDID') == '%s %s' % (dmd_ids[1], dmd_ids[0])
+    assert file_2.get('DMDID') == dmd_ids[0]
+    assert root_div.get('DMDID') == '%s %s' % (dmd_ids[0], dmd_ids[1])
+    assert root_div.get('ADMID') == '%s %s' % (amd_ids[1], amd_ids[0])
+    # IDREFs to nothing in the document are kept, except an unresolved FILEID, which gets a fresh ID
+    assert file_2.get('ADMID') == 'external-2'
+    assert doc_div.get('DMDID') == 'external-3'
+    assert fptrs[0].get('FILEID') == file_group.get('ID')
+    assert fptrs[1].get('FILEID') not in ('missing', None)
+    # Embedded metadata is left alone
+    assert root.find('.//{urn:example}record').get('ADMID') == 'amd-1'
+
+
+def test_random_uuid_is_a_version_4_uuid():
+    values = [random_uuid() for _ in range(1000)]
+
+    assert len(set(values)) == len(values)
+    for value in values:
+        parsed = uuid.UUID(value)
+        assert str(parsed) == value
+        assert parsed.version == 4
+        assert parsed.variant == uuid.RFC_4122
+
+
+def scaled_mets(count:int) -> str:
+    # count files, each with its own amdSec and an fptr to it, every one of them an IDREF to remap
+    amd_secs = ''.join('<mets:amdSec ID="amd-%d"/>' % i for i in range(count))
+    files = ''.join('<mets:file ID="file-%d" ADMID="amd-%d"><mets:FLocat LOCTYPE="URL" xlink:href="data/%d.bin"/></mets:file>' % (i, i, i) for i in range(count))
+    fptrs = ''.join('<mets:fptr FILEID="file-%d"/>' % i for i in range(count))
+    return SIP_METS.replace('<mets:amdSec ID="amd-2"/>', '<mets:amdSec ID="amd-2"/>' + amd_secs) \
+        .replace('</mets:fileGrp>', files + '</mets:fileGrp>') \
+        .replace('<mets:fptr FILEID="missing"/>', '<mets:fptr FILEID="missing"/>' + fptrs)
+
+
+def update_seconds(path, count:int) -> float:
+    # Best of three, to keep scheduling noise out of the ratio
+    mets_path = (path / ('%d.xml' % count))
+    times = []
+    for _ in range(3):
+        mets_path.write_text(scaled_mets(count), encoding='utf-8')
+        gc.collect()
+        start = time.perf_counter()
+        sip_to_eark_aip.update_mets(mets_path)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+@pytest.mark.parametrize('backend', ['etree', 'lxml'])
+def test_update_mets_scales_linearly(tmp_path, backend):
+    # The IDREF index and the remap are single passes - four times the references must take about
+    # four times as long, well short of the sixteen of work per reference per renewed ID
+    if backend == 'lxml':
+        pytest.importorskip('lxml')
+    xml_backend.use_backend(backend)
+    update_seconds(tmp_path, 500)
+
+    ratio = update_seconds(tmp_path, 8000) / update_seconds(tmp_path, 2000)
+
+    assert ratio < 8
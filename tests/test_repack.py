@@ -0,0 +1,154 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+import sys
+import zipfile
+import zlib
+
+import pytest
+
+import repack
+from repack import ParallelDeflater, StreamingZipWriter, _zip_date_time, repack_7z_to_zip
+from zip_preflight import check_zip, read_end_records
+
+DATE_TIME = (2020, 5, 17, 12, 30, 44)
+PAYLOAD = b''.join(b'%d,preservation,record\n' % i for i in range(20000))
+
+# Answers the two commands repack runs, for an "archive" that is a JSON list of members
+FAKE_7Z = '''#!%s
+import json, sys
+command, archive_path = sys.argv[1], sys.argv[-1]
+with open(archive_path) as f:
+    members = json.load(f)
+if command == 'l':
+    print('Path = ' + archive_path + '\\nType = 7z\\n\\n----------')
+    for member in members:
+        print('Path = %%s\\nSize = %%d\\nModified = %%s\\nAttributes = %%s\\nCRC = %%s\\n' %% (
+            member['path'], len(member.get('data', '')), member['modified'], 'D' if member.get('dir') else 'A', member.get('crc', '')))
+else:
+    for member in members:
+        sys.stdout.buffer.write(member.get('data', '').encode())
+''' % sys.executable
+
+
+@pytest.fixture
+def fake_7z(tmp_path, monkeypatch):
+    bin_path = (tmp_path / 'bin')
+    bin_path.mkdir()
+    (bin_path / '7z').write_text(FAKE_7Z)
+    (bin_path / '7z').chmod(0o755)
+    monkeypatch.setenv('PATH', str(bin_path) + os.pathsep + os.environ['PATH'])
+
+
+def write_archive(zip_path, members, zip64=True):
+    with open(zip_path, 'wb') as f:
+        archive = StreamingZipWriter(repack._HashingWriter(f, hashlib.sha256()), zip64)
+        for name, data, compressor in members:
+            if data is None:
+                archive.add_directory(name, DATE_TIME)
+            else:
+                archive.add_file(name, DATE_TIME, [data[i:i + 1000] for i in range(0, len(data), 1000)], len(data), compressor)
+        archive.close()
+
+
+def deflater():
+    return zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+
+
+def assert_readable(zip_path, members):
+    check_zip(zip_path, verify_crc=True)
+    with zipfile.ZipFile(zip_path) as archive:
+        assert archive.testzip() is None
+        assert archive.namelist() == [name.rstrip('/') + '/' if data is None else name for name, data, _ in members]
+        for name, data, _ in members:
+            if data is not None:
+                assert archive.read(name) == data
+                assert archive.getinfo(name).date_time == DATE_TIME
+
+
+def test_streaming_writer_is_readable_by_zipfile(tmp_path):
+    members = [('rep', None, None),
+               ('rep/stored.csv', PAYLOAD, None),
+               ('rep/deflated.csv', PAYLOAD, deflater()),
+               ('rep/empty.txt', b'', deflater()),
+               ('rep/café.txt', b'unicode name', None)]
+    zip_path = (tmp_path / 'out.zip')
+    write_archive(zip_path, members)
+
+    assert_readable(zip_path, members)
+    with zipfile.ZipFile(zip_path) as archive:
+        assert archive.getinfo('rep/deflated.csv').compress_size < len(PAYLOAD) // 4
+        assert archive.getinfo('rep/').is_dir()
+
+
+def test_parallel_deflate_matches_the_data(tmp_path, monkeypatch):
+    monkeypatch.setattr(repack, 'PARALLEL_CHUNK_SIZE', 4096)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        members = [('parallel.csv', PAYLOAD, ParallelDeflater(executor, 4)), ('after.csv', PAYLOAD[:5000], deflater())]
+        zip_path = (tmp_path / 'out.zip')
+        write_archive(zip_path, members)
+
+    assert_readable(zip_path, members)
+
+
+def test_zip64_members_and_end_records(tmp_path, monkeypatch):
+    # A low limit exercises every ZIP64 field with small data - zipfile reads them by their 0xFFFFFFFF markers
+    monkeypatch.setattr(zipfile, 'ZIP64_LIMIT', 10000)
+    members = [('small.txt', b'small', None), ('large.csv', PAYLOAD, deflater()), ('last.csv', PAYLOAD, None)]
+    zip_path = (tmp_path / 'out.zip')
+    write_archive(zip_path, members)
+
+    assert_readable(zip_path, members)
+    with open(zip_path, 'rb') as f:
+        assert read_end_records(f, zip_path.stat().st_size)['zip64']
+
+
+def test_zip64_can_be_refused(tmp_path, monkeypatch):
+    monkeypatch.setattr(zipfile, 'ZIP64_LIMIT', 10000)
+    with pytest.raises(RuntimeError, match='ZIP64'):
+        write_archive((tmp_path / 'out.zip'), [('large.csv', PAYLOAD, None)], zip64=False)
+
+
+@pytest.mark.parametrize('modified, date_time', [
+    ('2021-03-04 05:06:07.1234567', (2021, 3, 4, 5, 6, 7)),
+    ('1970-01-01 00:00:00', (1980, 1, 1, 0, 0, 0)),
+    ('2250-06-01 00:00:00', (2107, 12, 31, 23, 59, 58)),
+])
+def test_7z_dates_are_clamped(modified, date_time):
+    assert _zip_date_time(modified) == date_time
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_repack_7z_to_zip(tmp_path, monkeypatch, fake_7z, workers):
+    monkeypatch.setattr(repack, 'PARALLEL_CHUNK_SIZE', 4096)
+    monkeypatch.setattr(repack, 'PARALLEL_THRESHOLD', 8192)
+    data = PAYLOAD.decode()
+    archive_path = (tmp_path / 'package.7z')
+    archive_path.write_text(json.dumps([
+        {'path': 'objects', 'modified': '2019-01-01 00:00:00', 'dir': True},
+        {'path': 'objects/large.csv', 'modified': '2250-01-01 00:00:00', 'data': data, 'crc': '%08X' % zlib.crc32(PAYLOAD)},
+        {'path': 'objects/old.txt', 'modified': '1960-01-01 00:00:00', 'data': 'old'},
+    ]))
+    zip_path = (tmp_path / 'package.zip')
+
+    sha256 = repack_7z_to_zip(archive_path, zip_path, workers=workers)
+
+    assert sha256 == hashlib.sha256(zip_path.read_bytes()).hexdigest()
+    check_zip(zip_path, verify_crc=True)
+    with zipfile.ZipFile(zip_path) as archive:
+        assert archive.namelist() == ['objects/', 'objects/large.csv', 'objects/old.txt']
+        assert archive.read('objects/large.csv') == PAYLOAD
+        assert archive.getinfo('objects/large.csv').date_time == (2107, 12, 31, 23, 59, 58)
+        assert archive.getinfo('objects/old.txt').date_time == (1980, 1, 1, 0, 0, 0)
+
+
+def test_repack_rejects_a_crc_mismatch(tmp_path, fake_7z):
+    archive_path = (tmp_path / 'package.7z')
+    archive_path.write_text(json.dumps([{'path': 'a.txt', 'modified': '2019-01-01 00:00:00', 'data': 'abc', 'crc': '00000000'}]))
+    zip_path = (tmp_path / 'package.zip')
+
+    with pytest.raises(RuntimeError, match='CRC mismatch'):
+        repack_7z_to_zip(archive_path, zip_path)
+    assert not zip_path.exists()
+    assert not (tmp_path / 'package.zip.partial').exists()
@@ -0,0 +1,84 @@
+import time
+
+import pytest
+
+from generate_sip import generate_sip
+import sip_to_eark_aip
+from sip_to_eark_aip import AIPError, publish_aip_directory, staging_directory, transform_sip_to_aip
+from trash import pending, trash_location
+
+
+@pytest.fixture
+def sip_path(tmp_path):
+    return generate_sip((tmp_path / 'sips'), 'sip-1', reps=1, files_per_rep=2, size_distribution='fixed:1024')
+
+
+def make_aip(path):
+    (path / 'representations' / 'rep1').mkdir(parents=True)
+    (path / 'METS.xml').write_text('<mets/>')
+    return path
+
+
+def visible(output_path) -> list:
+    return sorted(path.name for path in output_path.iterdir() if not path.name.startswith('.'))
+
+
+def test_aip_is_built_in_staging_and_published_complete(tmp_path, sip_path, monkeypatch):
+    output_path = (tmp_path / 'aips')
+    seen = []
+
+    def publish(staging_path, aip_path, output_path):
+        # Nothing is visible under the AIP's name until the staged AIP is complete
+        seen.append((aip_path.exists(), (staging_path / 'METS.xml').is_file(), visible(output_path)))
+        publish_aip_directory(staging_path, aip_path, output_path)
+
+    monkeypatch.setattr(sip_to_eark_aip, 'publish_aip_directory', publish)
+    result = transform_sip_to_aip(sip_path, output_path, 'aip-1')
+
+    assert seen == [(False, True, [])]
+    assert result['path'] == (output_path / 'aip-1')
+    assert (output_path / 'aip-1' / 'METS.xml').is_file()
+    assert not staging_directory(output_path, 'aip-1').parent.exists()
+    assert visible(output_path) == ['aip-1']
+
+
+def test_failed_build_publishes_nothing(tmp_path, sip_path, monkeypatch):
+    output_path = (tmp_path / 'aips')
+
+    def fail(*args):
+        raise AIPError("root METS")
+
+    monkeypatch.setattr(sip_to_eark_aip, 'update_root_mets', fail)
+    with pytest.raises(AIPError):
+        transform_sip_to_aip(sip_path, output_path, 'aip-1')
+
+    assert visible(output_path) == []
+
+
+def test_publishing_replaces_an_aip_through_the_trash(tmp_path):
+    old_path = make_aip(tmp_path / 'aip-1')
+    (old_path / 'old.txt').write_text('old')
+    staging_path = make_aip(staging_directory(tmp_path, 'aip-1'))
+
+    publish_aip_directory(staging_path, (tmp_path / 'aip-1'), tmp_path)
+
+    assert (tmp_path / 'aip-1' / 'METS.xml').is_file()
+    assert not (tmp_path / 'aip-1' / 'old.txt').exists()
+    assert not staging_path.parent.exists()
+    # The replaced AIP is deleted by a background reaper
+    deadline = time.monotonic() + 30
+    while pending(trash_location(tmp_path)):
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+
+def test_publishing_again_after_an_interruption_keeps_the_aip(tmp_path):
+    # The AIP was renamed into place, but the run died before recording it - the staging directory is empty
+    make_aip(tmp_path / 'aip-1')
+    staging_path = staging_directory(tmp_path, 'aip-1')
+    staging_path.parent.mkdir()
+
+    publish_aip_directory(staging_path, (tmp_path / 'aip-1'), tmp_path)
+
+    assert (tmp_path / 'aip-1' / 'METS.xml').is_file()
+    assert not staging_path.parent.exists()
@@ -0,0 +1,72 @@
+import fcntl
+import subprocess
+import time
+
+import trash
+from trash import LOCK_FILENAME, discard, main, move_to_trash, pending, reap, trash_location
+
+
+def wait_until_reaped(output_path, timeout:float=30):
+    deadline = time.monotonic() + timeout
+    while pending(trash_location(output_path)):
+        assert time.monotonic() < deadline, "The reaper didn't empty the trash"
+        time.sleep(0.05)
+
+
+def make_aip(path):
+    (path / 'representations' / 'rep1').mkdir(parents=True)
+    (path / 'METS.xml').write_text('<mets/>')
+    (path / 'representations' / 'rep1' / 'data.bin').write_bytes(b'x' * 1000)
+    return path
+
+
+def test_move_to_trash_keeps_every_copy(tmp_path):
+    first = move_to_trash(make_aip(tmp_path / 'aip'), tmp_path)
+    second = move_to_trash(make_aip(tmp_path / 'aip'), tmp_path)
+
+    assert not (tmp_path / 'aip').exists()
+    assert first != second
+    assert pending(trash_location(tmp_path)) == sorted([first, second])
+    # Hidden staging directories are visible in the trash
+    staged = move_to_trash(make_aip(tmp_path / '.aip.staging'), tmp_path)
+    assert staged.name.startswith('aip.staging.')
+
+
+def test_reap_deletes_directories_and_files(tmp_path):
+    move_to_trash(make_aip(tmp_path / 'aip'), tmp_path)
+    (tmp_path / 'aip.zip').write_bytes(b'zip')
+    move_to_trash((tmp_path / 'aip.zip'), tmp_path)
+
+    result = reap(trash_location(tmp_path))
+
+    assert (result['deleted'], result['failed']) == (2, 0)
+    assert pending(trash_location(tmp_path)) == []
+
+
+def test_reap_leaves_the_trash_to_a_running_reaper(tmp_path):
+    move_to_trash(make_aip(tmp_path / 'aip'), tmp_path)
+    trash_path = trash_location(tmp_path)
+    with open((trash_path / LOCK_FILENAME), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        assert reap(trash_path) is None
+        assert main([str(tmp_path), '--quiet', '--niceness', '0'])['running']
+    assert reap(trash_path)['deleted'] == 1
+
+
+def test_discard_reaps_in_the_background(tmp_path):
+    aip_path = make_aip(tmp_path / 'aip')
+
+    discard(aip_path, tmp_path)
+
+    assert not aip_path.exists()
+    wait_until_reaped(tmp_path)
+
+
+def test_nothing_to_reap_starts_no_reaper(tmp_path, monkeypatch):
+    started = []
+    monkeypatch.setattr(subprocess, 'Popen', lambda *args, **kwargs: started.append(args))
+    trash.start_reaper(tmp_path)
+    trash_location(tmp_path).mkdir()
+    trash.start_reaper(tmp_path)
+
+    assert started == []
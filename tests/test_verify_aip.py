@@ -0,0 +1,86 @@
+import json
+
+import pytest
+
+from generate_sip import generate_sip
+from sip_to_eark_aip import transform_sip_to_aip
+from verify_aip import find_aips, main, verify_aips
+
+
+@pytest.fixture
+def shelf_path(tmp_path, monkeypatch):
+    # Two AIPs on a shelf - main logs to a directory relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    for name in ('aip-1', 'aip-2'):
+        sip_path = generate_sip((tmp_path / 'sips'), 'sip-' + name, reps=2, files_per_rep=2, size_distribution='fixed:1024')
+        transform_sip_to_aip(sip_path, (tmp_path / 'shelf'), name)
+    return (tmp_path / 'shelf')
+
+
+def mismatches(report:dict) -> list:
+    return sorted((mismatch['mets'], mismatch['href'], mismatch['problem']) for result in report['results'] for mismatch in result['mismatches'])
+
+
+def test_intact_aips_are_verified(shelf_path):
+    report = verify_aips(find_aips([shelf_path]))
+
+    assert (report['aips'], report['verified'], report['failed']) == (2, 2, 0)
+    # Per AIP: the root METS, two rep METS and two payload files in each rep
+    assert [(result['mets_files'], result['files'], result['checksums_verified']) for result in report['results']] == [(3, 6, 6)] * 2
+
+
+def test_size_mismatch(shelf_path):
+    with open((shelf_path / 'aip-1' / 'representations' / 'rep01' / 'data' / 'file000000.bin'), 'ab') as f:
+        f.write(b'appended')
+
+    report = verify_aips(find_aips([shelf_path]))
+
+    assert (report['verified'], report['failed']) == (1, 1)
+    assert mismatches(report) == [('representations/rep01/METS.xml', 'data/file000000.bin', 'size')]
+    [mismatch] = report['results'][0]['mismatches']
+    assert (mismatch['expected'], mismatch['actual']) == ('1024', '1032')
+
+
+def test_checksum_mismatch(shelf_path):
+    payload_path = (shelf_path / 'aip-2' / 'representations' / 'rep02' / 'data' / 'file000001.bin')
+    payload_path.write_bytes(bytes(reversed(payload_path.read_bytes())))
+
+    report = verify_aips(find_aips([shelf_path]))
+
+    assert mismatches(report) == [('representations/rep02/METS.xml', 'data/file000001.bin', 'checksum')]
+    assert report['results'][0]['status'] == 'verified'
+    [mismatch] = report['results'][1]['mismatches']
+    assert mismatch['expected'] != mismatch['actual']
+
+
+def test_href_outside_the_aip(shelf_path):
+    mets_path = (shelf_path / 'aip-1' / 'representations' / 'rep01' / 'METS.xml')
+    (shelf_path / 'outside.bin').write_bytes(b'x' * 1024)
+    mets_path.write_text(mets_path.read_text().replace('xlink:href="data/file000000.bin"', 'xlink:href="../../../outside.bin"'))
+
+    report = verify_aips(find_aips([shelf_path]))
+
+    # The edited rep METS no longer matches its size in the root METS either
+    assert mismatches(report) == [
+        ('METS.xml', 'representations/rep01/METS.xml', 'size'),
+        ('representations/rep01/METS.xml', '../../../outside.bin', 'outside-aip'),
+    ]
+
+
+def test_missing_file_and_json_report(shelf_path, tmp_path):
+    (shelf_path / 'aip-2' / 'representations' / 'rep01' / 'data' / 'file000001.bin').unlink()
+    report_path = (tmp_path / 'report.json')
+
+    report = main([str(shelf_path / 'aip-1'), str(shelf_path / 'aip-2'), '--report', str(report_path)])
+
+    assert json.loads(report_path.read_text()) == report
+    assert mismatches(report) == [('representations/rep01/METS.xml', 'data/file000001.bin', 'missing')]
+
+
+def test_fail_fast_stops_at_the_first_failed_aip(shelf_path):
+    (shelf_path / 'aip-1' / 'representations' / 'rep02' / 'data' / 'file000000.bin').unlink()
+
+    report = verify_aips(find_aips([shelf_path]), workers=1, fail_fast=True)
+
+    assert report['stopped_early']
+    assert (report['aips'], report['failed']) == (1, 1)
@@ -0,0 +1,133 @@
+from pathlib import Path
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+
+from generate_sip import generate_sip
+import work_ledger
+from work_ledger import LEDGER_DIRECTORY, LedgerNode, WorkLedger, publish_aip
+
+REPO_PATH = Path(__file__).resolve().parents[1]
+
+
+def expire(path:Path):
+    # Age a lease or node record past any lease period
+    past = time.time() - 3600
+    os.utime(path, (past, past))
+
+
+def test_nodes_convert_every_sip_exactly_once(tmp_path):
+    source_path = (tmp_path / 'sips')
+    source_path.mkdir()
+    sips = ['sip-%d' % i for i in range(6)]
+    for sip in sips:
+        generate_sip(source_path, sip, reps=1, files_per_rep=2, size_distribution='fixed:1024')
+    output_path = (tmp_path / 'aips')
+
+    nodes = [subprocess.Popen([sys.executable, str(REPO_PATH / 'work_ledger.py'), 'run', str(source_path), str(output_path),
+                               '--node', 'node-%d' % i, '--workers', '2', '--poll-seconds', '0.2', '--lease-seconds', '30'],
+                              cwd=tmp_path, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+             for i in range(3)]
+    for node in nodes:
+        stdout, stderr = node.communicate(timeout=300)
+        assert node.returncode == 0, stderr.decode()
+
+    ledger = WorkLedger((output_path / LEDGER_DIRECTORY), 'test')
+    records = ledger.records()
+    assert sorted(record['sip'] for record in records) == sips
+    assert all(record['status'] == 'converted' for record in records)
+    aips = {record['aip'] for record in records}
+    assert len(aips) == len(sips)
+    # One AIP per SIP in the output, nothing left behind in the work directories or the leases
+    assert {path.name for path in output_path.iterdir() if not path.name.startswith('.')} == aips
+    assert not list(ledger.leases_path.iterdir())
+    summary = json.loads(subprocess.run([sys.executable, str(REPO_PATH / 'work_ledger.py'), 'summary', str(output_path), '--source', str(source_path)],
+                                        cwd=tmp_path, stdout=subprocess.PIPE, check=True).stdout)
+    assert (summary['converted'], summary['failed'], summary['in_flight'], summary['pending']) == (len(sips), 0, 0, 0)
+
+
+def test_expired_lease_is_reclaimed(tmp_path):
+    first = WorkLedger(tmp_path, 'first', lease_seconds=5)
+    second = WorkLedger(tmp_path, 'second', lease_seconds=5)
+    lease = first.claim('sip', 'aip-1')
+    assert lease['attempts'] == 1
+
+    # A live lease can't be taken
+    assert second.claim('sip', 'aip-2') is None
+
+    expire(first.lease_path('sip'))
+    lease = second.claim('sip', 'aip-2')
+    assert (lease['node'], lease['attempts']) == ('second', 2)
+    # The first node finds out at its next heartbeat, and can't record an outcome
+    assert first.renew() == ['sip']
+    assert not first.complete('sip', {'sip': 'sip', 'status': 'converted'})
+    assert second.complete('sip', {'sip': 'sip', 'status': 'converted'})
+    assert first.claim('sip', 'aip-3') is None
+
+
+def test_max_attempts_records_a_failure(tmp_path):
+    ledger = WorkLedger(tmp_path, 'node', lease_seconds=5, max_attempts=2)
+    for attempt in (1, 2):
+        assert ledger.claim('sip', 'aip-%d' % attempt)['attempts'] == attempt
+        expire(ledger.lease_path('sip'))
+
+    assert ledger.claim('sip', 'aip-3') is None
+    record = ledger.read(ledger.record_path('sip'))
+    assert (record['status'], record['attempts'], record['aip']) == ('failed', 2, 'aip-2')
+    assert 'Abandoned after 2 attempts' in record['error']
+
+
+def test_recover_leaves_aips_of_live_nodes(tmp_path):
+    output_path = (tmp_path / 'aips')
+    ledger = WorkLedger((output_path / LEDGER_DIRECTORY), 'node', lease_seconds=5)
+    other = WorkLedger(ledger.ledger_path, 'other', lease_seconds=5)
+    other.heartbeat_node()
+    work_path = (output_path / work_ledger.WORK_DIRECTORY / 'other')
+    (work_path / 'aip-1').mkdir(parents=True)
+    other.claim('sip', 'aip-1')
+    other.complete('sip', {'sip': 'sip', 'aip': 'aip-1', 'node': 'other', 'status': 'converted', 'work': str(work_path)})
+    node = LedgerNode(ledger, tmp_path, output_path)
+
+    # The other node is about to publish it itself
+    node.recover()
+    assert (work_path / 'aip-1').is_dir()
+
+    expire(other.node_path)
+    node.recover()
+    assert (output_path / 'aip-1').is_dir()
+    assert not (work_path / 'aip-1').exists()
+
+
+def test_publish_treats_a_vanished_aip_as_published(tmp_path, monkeypatch):
+    (tmp_path / 'work' / 'aip-1').mkdir(parents=True)
+
+    def replace(source, destination):
+        raise FileNotFoundError(source)
+
+    monkeypatch.setattr(work_ledger.os, 'replace', replace)
+    assert not publish_aip((tmp_path / 'work'), tmp_path, 'aip-1')
+
+
+def killed_worker(job):
+    os.kill(os.getpid(), signal.SIGKILL)
+
+
+def test_dead_worker_is_recorded_as_failed(tmp_path, monkeypatch):
+    # Pool workers are forked, so they run the patched conversion
+    monkeypatch.setattr(work_ledger, 'convert_sip', killed_worker)
+    source_path = (tmp_path / 'sips')
+    (source_path / 'sip').mkdir(parents=True)
+    output_path = (tmp_path / 'aips')
+    ledger = WorkLedger((output_path / LEDGER_DIRECTORY), 'node', lease_seconds=30)
+
+    summary = LedgerNode(ledger, source_path, output_path, workers=1, poll_seconds=0.2).run()
+
+    assert (summary['converted'], summary['failed'], summary['in_flight']) == (0, 1, 0)
+    record = ledger.read(ledger.record_path('sip'))
+    assert record['status'] == 'failed'
+    assert 'died' in record['error']
+    assert not list(ledger.leases_path.iterdir())
+
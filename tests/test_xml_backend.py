@@ -0,0 +1,111 @@
+from pathlib import Path
+import itertools
+import re
+
+import pytest
+
+from mets_stream import stream_update_mets
+import sip_to_eark_aip
+import xml_backend
+
+
+SIP_METS = '''<?xml version="1.0" encoding="UTF-8"?>
+<mets:mets xmlns:mets="http://www.loc.gov/METS/" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:csip="https://DILCIS.eu/XML/METS/CSIPExtensionMETS" xmlns:xlink="http://www.w3.org/1999/xlink" OBJID="sip" csip:CONTENTINFORMATIONTYPE="MIXED" xsi:schemaLocation="http://www.loc.gov/METS/ http://www.loc.gov/standards/mets/mets.xsd https://dilcis.eu/XML/METS/SIPExtensionMETS https://earkcsip.dilcis.eu/schema/DILCISExtensionSIPMETS.xsd">
+  <mets:metsHdr CREATEDATE="2020-01-01T00:00:00" csip:OAISPACKAGETYPE="SIP">
+    <mets:agent ROLE="CREATOR" TYPE="INDIVIDUAL"><mets:name>Someone</mets:name></mets:agent>
+    <mets:metsDocumentID>METS.xml</mets:metsDocumentID>
+  </mets:metsHdr>
+  <mets:dmdSec ID="dmd-1" CREATED="2020-01-01T00:00:00">
+    <mets:mdWrap MDTYPE="OTHER">
+      <mets:xmlData><premis:object xmlns:premis="http://www.loc.gov/premis/v3" xsi:type="premis:file"><premis:note>a &amp; b &lt; c &gt; d "quoted" &#233;</premis:note><premis:empty/></premis:object></mets:xmlData>
+    </mets:mdWrap>
+  </mets:dmdSec>
+  <mets:amdSec ID="amd-1"><mets:digiprovMD ID="prov-1"><mets:mdRef LOCTYPE="URL" MDTYPE="PREMIS" xlink:href="metadata/preservation/premis.xml" xlink:type="simple"/></mets:digiprovMD></mets:amdSec>
+  <mets:fileSec ID="fs-1">
+    <mets:fileGrp ID="grp-doc" USE="Documentation" ADMID="amd-1">
+      <mets:file ID="file-1" MIMETYPE="text/plain" SIZE="5" ADMID="prov-1 amd-1" DMDID="dmd-1" CHECKSUM="00" CHECKSUMTYPE="SHA-256"><mets:FLocat LOCTYPE="URL" xlink:type="simple" xlink:href="documentation/a &amp; b.txt"/></mets:file>
+    </mets:fileGrp>
+    <mets:fileGrp ID="grp-rep" USE="Representations/rep1"><mets:file ID="file-rep"><mets:FLocat LOCTYPE="URL" xlink:href="representations/rep1/METS.xml"/></mets:file></mets:fileGrp>
+  </mets:fileSec>
+  <mets:structMap ID="sm-1" TYPE="PHYSICAL" LABEL="CSIP">
+    <mets:div ID="div-root" LABEL="sip">
+      <mets:div ID="div-md" LABEL="Metadata" DMDID="dmd-1" ADMID="amd-1"/>
+      <mets:div ID="div-doc" LABEL="Documentation"><mets:fptr FILEID="grp-doc"/></mets:div>
+      <mets:div ID="div-rep" LABEL="Representations/rep1"><mets:mptr LOCTYPE="URL" xlink:href="representations/rep1/METS.xml" xlink:title="grp-rep"/></mets:div>
+    </mets:div>
+  </mets:structMap>
+</mets:mets>
+'''
+REP_METS = '<?xml version="1.0" encoding="UTF-8"?>\n<mets:mets xmlns:mets="http://www.loc.gov/METS/"/>\n'
+
+
+@pytest.fixture(autouse=True)
+def restore_backend(monkeypatch):
+    monkeypatch.setattr(xml_backend, 'BACKEND', xml_backend.BACKEND)
+
+
+@pytest.fixture
+def deterministic(monkeypatch):
+    # Numbered IDs and a fixed date, so converted METS can be compared byte for byte
+    counter = itertools.count()
+    monkeypatch.setattr(sip_to_eark_aip, 'new_uuid', lambda prefix='uuid': '%s-%d' % (prefix, next(counter)))
+    monkeypatch.setattr(sip_to_eark_aip, 'date_time_now', lambda: '2024-01-01T00:00:00')
+
+
+def write_aip(path:Path) -> Path:
+    (path / 'representations' / 'rep1').mkdir(parents=True)
+    (path / 'representations' / 'rep1' / 'METS.xml').write_text(REP_METS, encoding='utf-8')
+    mets_path = (path / 'METS.xml')
+    mets_path.write_text(SIP_METS, encoding='utf-8')
+    return mets_path
+
+
+def numbered_ids(mets:bytes) -> bytes:
+    # The streaming rewriter renews IDs in document order, update_mets section by section - IDs are
+    # renumbered in order of appearance, so only the structure and everything else is compared
+    seen = {}
+    return re.sub(rb'\b(?:uuid|ID)-\d+\b', lambda m: seen.setdefault(m.group(0), b'N%d' % len(seen)), mets)
+
+
+def converted(path:Path, backend:str) -> bytes:
+    mets_path = write_aip(path)
+    if backend == 'stream':
+        stream_update_mets(mets_path, sip_to_eark_aip.new_uuid, sip_to_eark_aip.date_time_now, sip_to_eark_aip.SOFTWARE_NAME, sip_to_eark_aip.SOFTWARE_VERSION)
+    else:
+        xml_backend.use_backend(backend)
+        sip_to_eark_aip.update_mets(mets_path)
+    return mets_path.read_bytes()
+
+
+def test_lxml_and_etree_write_identical_mets(tmp_path, deterministic):
+    pytest.importorskip('lxml')
+    etree_mets = converted((tmp_path / 'etree' / 'AIP'), 'etree')
+    lxml_mets = converted((tmp_path / 'lxml' / 'AIP'), 'lxml')
+
+    assert lxml_mets.startswith(b"<?xml version='1.0' encoding='utf-8'?>\n<mets ")
+    assert b' />' in lxml_mets and b'"/>' not in lxml_mets
+    assert numbered_ids(lxml_mets) == numbered_ids(etree_mets)
+
+
+@pytest.mark.parametrize('backend', ['etree', 'lxml'])
+def test_streaming_rewrite_matches_the_tree(tmp_path, deterministic, backend):
+    if backend == 'lxml':
+        pytest.importorskip('lxml')
+    tree_mets = converted((tmp_path / 'tree' / 'AIP'), backend)
+    stream_mets = converted((tmp_path / 'stream' / 'AIP'), 'stream')
+
+    assert numbered_ids(stream_mets) == numbered_ids(tree_mets)
+
+
+@pytest.mark.parametrize('backend', ['etree', 'lxml'])
+def test_write_without_indent(tmp_path, backend):
+    if backend == 'lxml':
+        pytest.importorskip('lxml')
+    xml_backend.use_backend(backend)
+    source = (tmp_path / 'DC.xml')
+    source.write_text('<?xml version="1.0"?>\n<dc xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:title>x</dc:title><dc:subject/></dc>', encoding='utf-8')
+    xml_backend.write(xml_backend.parse(source), (tmp_path / 'out.xml'), indent=False)
+
+    assert (tmp_path / 'out.xml').read_bytes() == (
+        b"<?xml version='1.0' encoding='utf-8'?>\n"
+        b'<dc xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:title>x</dc:title><dc:subject /></dc>')
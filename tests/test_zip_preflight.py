@@ -0,0 +1,108 @@
+import zipfile
+import zlib
+
+import pytest
+
+from create_preservation_mets import check_preservation_zip
+from sip_to_eark_aip import AIPError
+from zip_preflight import check_zip, main
+
+PAYLOAD = b''.join(b'line %d of the preservation file\n' % i for i in range(5000))
+
+
+def write_zip(zip_path, compression=zipfile.ZIP_DEFLATED):
+    with zipfile.ZipFile(zip_path, 'w', compression) as archive:
+        archive.writestr('rep/data.txt', PAYLOAD)
+        archive.writestr('rep/other.txt', b'other')
+    return zip_path
+
+
+def member_data_range(zip_path, name):
+    with zipfile.ZipFile(zip_path) as archive:
+        info = archive.getinfo(name)
+    start = info.header_offset + 30 + len(info.orig_filename.encode()) + len(info.extra)
+    return start, start + info.compress_size
+
+
+def corrupt_deflate_stream(zip_path):
+    # Flip a byte of the member data that makes the raw deflate stream itself invalid, not just its CRC
+    data = bytearray(zip_path.read_bytes())
+    start, end = member_data_range(zip_path, 'rep/data.txt')
+    for position in range(start, end):
+        data[position] ^= 0xFF
+        try:
+            zlib.decompressobj(-15).decompress(bytes(data[start:end]))
+        except zlib.error:
+            zip_path.write_bytes(data)
+            return
+        data[position] ^= 0xFF
+    raise AssertionError("No single byte flip broke the deflate stream")
+
+
+def test_intact_zip(tmp_path):
+    result = check_zip(write_zip(tmp_path / 'ok.zip'), verify_crc=True)
+
+    assert result['members'] == 2
+    assert result['uncompressed_size'] == len(PAYLOAD) + 5
+    assert result['crc_checked']
+
+
+def test_truncated_zip_is_rejected(tmp_path):
+    zip_path = write_zip(tmp_path / 'truncated.zip')
+    zip_path.write_bytes(zip_path.read_bytes()[:-10])
+
+    with pytest.raises(zipfile.BadZipFile, match='end of central directory'):
+        check_zip(zip_path)
+
+
+def test_corrupt_deflate_member_is_rejected(tmp_path):
+    zip_path = write_zip(tmp_path / 'corrupt.zip')
+    corrupt_deflate_stream(zip_path)
+
+    # The central directory is intact, only decompressing finds the damage
+    check_zip(zip_path)
+    with pytest.raises(zipfile.BadZipFile, match="'rep/data.txt' can't be decompressed"):
+        check_zip(zip_path, verify_crc=True)
+
+
+def test_corrupt_lzma_member_is_rejected(tmp_path):
+    zip_path = write_zip((tmp_path / 'corrupt.zip'), zipfile.ZIP_LZMA)
+    data = bytearray(zip_path.read_bytes())
+    start, end = member_data_range(zip_path, 'rep/data.txt')
+    data[start + 40:start + 56] = bytes(16)
+    zip_path.write_bytes(data)
+
+    with pytest.raises(zipfile.BadZipFile):
+        check_zip(zip_path, verify_crc=True)
+
+
+def test_bad_crc_is_rejected(tmp_path):
+    zip_path = (tmp_path / 'stored.zip')
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED) as archive:
+        archive.writestr('rep/data.txt', PAYLOAD)
+    data = bytearray(zip_path.read_bytes())
+    start, _ = member_data_range(zip_path, 'rep/data.txt')
+    data[start] ^= 0xFF
+    zip_path.write_bytes(data)
+
+    with pytest.raises(zipfile.BadZipFile, match='Bad CRC-32'):
+        check_zip(zip_path, verify_crc=True)
+
+
+def test_main_reports_corrupt_members(tmp_path, capsys):
+    ok_path = write_zip(tmp_path / 'ok.zip')
+    corrupt_path = write_zip(tmp_path / 'corrupt.zip')
+    corrupt_deflate_stream(corrupt_path)
+
+    assert main(['--crc', str(ok_path), str(corrupt_path)]) == 1
+    output = capsys.readouterr().out
+    assert "can't be decompressed" in output
+
+
+def test_preservation_zip_check_raises_aip_error(tmp_path, monkeypatch):
+    monkeypatch.setenv('ZIP_CHECK', 'crc')
+    zip_path = write_zip(tmp_path / 'corrupt.zip')
+    corrupt_deflate_stream(zip_path)
+
+    with pytest.raises(AIPError, match='is damaged'):
+        check_preservation_zip(zip_path)
@@ -0,0 +1,148 @@
+from pathlib import Path
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+import uuid
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# Output subdirectory that replaced and abandoned output is renamed into, to be deleted in the background
+TRASH_DIRECTORY = '.trash'
+# Held by the reaper deleting a trash directory - a second reaper started meanwhile exits straight away
+LOCK_FILENAME = '.reaper.lock'
+# CPU niceness of the reaper. On Linux it also runs in the lowest best-effort I/O priority, through ionice when
+# it is installed - idle class I/O could be starved indefinitely by a busy pipeline while the trash grows
+REAPER_NICENESS = 19
+IONICE_COMMAND = ['ionice', '-c', '2', '-n', '7']
+
+
+def trash_location(output_path:Path) -> Path:
+    return (Path(output_path) / TRASH_DIRECTORY)
+
+
+def move_to_trash(path:Path, output_path:Path) -> Path:
+    # Rename a file or directory of output_path into its trash directory - instant, as both are on the same filesystem
+    # Trash names are unique, so the same AIP can be replaced again before its old copy is gone
+    trash_path = trash_location(output_path)
+    trash_path.mkdir(parents=True, exist_ok=True)
+    destination = (trash_path / (Path(path).name.lstrip('.') + '.' + uuid.uuid4().hex))
+    os.rename(path, destination)
+    logging.info("Moved '%s' to the trash" % path)
+    return destination
+
+
+def start_reaper(output_path:Path):
+    # Delete output_path's trash in a detached, low priority process that outlives the caller
+    # Nothing waits for it - trash left by a reaper that was killed is deleted by the next one
+    trash_path = trash_location(output_path)
+    if not pending(trash_path):
+        return
+    # Only imported once there is something to reap - it adds to the start-up of every script that imports trash
+    import subprocess
+    command = [sys.executable, str(Path(__file__).resolve()), str(trash_path.resolve()), '--quiet']
+    if sys.platform.startswith('linux') and shutil.which(IONICE_COMMAND[0]):
+        command = IONICE_COMMAND + command
+    subprocess.Popen(command, start_new_session=True, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL)
+
+
+def discard(path:Path, output_path:Path):
+    # Move path to the trash and have it deleted in the background
+    move_to_trash(path, output_path)
+    start_reaper(output_path)
+
+
+def pending(trash_path:Path) -> list:
+    # Trash entries waiting to be deleted
+    if not trash_path.is_dir():
+        return []
+    return sorted(p for p in trash_path.iterdir() if p.name != LOCK_FILENAME)
+
+
+def _delete(path:Path) -> bool:
+    failed = []
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(path, onerror=lambda function, failed_path, exc_info: failed.append((failed_path, exc_info[1])))
+    else:
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            failed.append((path, e))
+    for failed_path, error in failed:
+        # Gone already - another reaper got there first where there is no lock
+        if not isinstance(error, FileNotFoundError):
+            logging.warning("Couldn't delete '%s' from the trash: %s" % (failed_path, error))
+            return False
+    return True
+
+
+def reap(trash_path:Path) -> dict:
+    # Delete everything in a trash directory, returning the counts - None if another reaper holds the lock
+    # The lock is released before a last look at the directory: an entry moved in while a second reaper gave up
+    # on the lock is never left behind
+    start = time.monotonic()
+    deleted, failed = 0, set()
+    while True:
+        lock_file = None
+        if fcntl is not None:
+            lock_file = open((trash_path / LOCK_FILENAME), 'a')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                # The reaper holding it now deletes anything left
+                if deleted == 0 and not failed:
+                    return None
+                break
+        try:
+            entries = [p for p in pending(trash_path) if p.name not in failed]
+            while entries:
+                for path in entries:
+                    if _delete(path):
+                        deleted += 1
+                    else:
+                        failed.add(path.name)
+                entries = [p for p in pending(trash_path) if p.name not in failed]
+        finally:
+            if lock_file is not None:
+                lock_file.close()
+        if not [p for p in pending(trash_path) if p.name not in failed]:
+            break
+    return {'deleted': deleted, 'failed': len(failed), 'seconds': round(time.monotonic() - start, 3)}
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='trash.py', description="Delete the trash of an output directory")
+    parser.add_argument('trash', help="The trash directory, or the output directory holding %s" % TRASH_DIRECTORY)
+    parser.add_argument('--quiet', action='store_true', help="Don't print the result")
+    parser.add_argument('--niceness', type=int, default=REAPER_NICENESS, help="Lower the reaper's priority by this much (default: %d)" % REAPER_NICENESS)
+    args = parser.parse_args(argv)
+
+    trash_path = Path(args.trash)
+    if trash_location(trash_path).is_dir():
+        trash_path = trash_location(trash_path)
+    if not trash_path.is_dir():
+        sys.exit("Fatal Error: No trash directory found at " + str(trash_path))
+    if args.niceness and hasattr(os, 'nice'):
+        os.nice(args.niceness)
+
+    result = reap(trash_path)
+    if result is None:
+        result = {'deleted': 0, 'failed': 0, 'seconds': 0.0, 'running': True}
+    if not args.quiet:
+        print(json.dumps(result, indent=4))
+    return result
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,258 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+from pathlib import Path
+from urllib.parse import unquote
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+import fixity
+import io_scheduler
+import metrics
+from sip_to_eark_aip import configure_logging
+
+
+METS_NAMESPACE = 'http://www.loc.gov/METS/'
+XLINK_NAMESPACE = 'http://www.w3.org/1999/xlink'
+# METS CHECKSUMTYPE values to hashlib algorithm names
+CHECKSUM_ALGORITHMS = {mets_type: algorithm for algorithm, mets_type in fixity.CHECKSUM_TYPES.items()}
+# Hash jobs queued per worker thread - enough to keep every worker busy without holding a whole shelf in memory
+QUEUE_DEPTH = 4
+
+
+def iter_mets_files(mets_path:Path):
+    # Stream the (SIZE, CHECKSUM, CHECKSUMTYPE, href) of every mets:file with an FLocat, without building the tree
+    file_tag, flocat_tag = '{%s}file' % METS_NAMESPACE, '{%s}FLocat' % METS_NAMESPACE
+    href_attribute = '{%s}href' % XLINK_NAMESPACE
+    for event, element in ET.iterparse(mets_path, events=('end',)):
+        if element.tag == file_tag:
+            flocat = element.find(flocat_tag)
+            if flocat is not None and flocat.get(href_attribute):
+                yield element.get('SIZE'), element.get('CHECKSUM'), element.get('CHECKSUMTYPE'), flocat.get(href_attribute)
+            element.clear()
+
+
+def resolve_href(aip_path:Path, base_path:Path, href:str) -> Path:
+    # FLocat hrefs are relative to the METS that holds them - percent-encoded hrefs are decoded if needed
+    if href.startswith('file://'):
+        href = href[len('file://'):]
+    path = (base_path / href)
+    if not path.exists() and '%' in href:
+        path = (base_path / unquote(href))
+    path = Path(os.path.normpath(path))
+    if not path.is_relative_to(aip_path):
+        return None
+    return path
+
+
+class AIPVerification:
+    # Result of verifying one AIP - mismatches hold every failed check
+
+    def __init__(self, aip_path:Path):
+        self.aip_path = aip_path
+        self.mets_files = 0
+        self.files = 0
+        self.size_checked = 0
+        self.checksums_verified = 0
+        self.not_sampled = 0
+        self.bytes_hashed = 0
+        self.mismatches = []
+
+    def mismatch(self, mets_path:Path, href:str, problem:str, expected=None, actual=None):
+        self.mismatches.append({
+            'mets': str(mets_path.relative_to(self.aip_path)),
+            'href': href,
+            'problem': problem,
+            'expected': expected,
+            'actual': actual,
+        })
+
+    def report(self) -> dict:
+        return {
+            'aip': str(self.aip_path),
+            'status': 'failed' if self.mismatches else 'verified',
+            'mets_files': self.mets_files,
+            'files': self.files,
+            'size_checked': self.size_checked,
+            'checksums_verified': self.checksums_verified,
+            'not_sampled': self.not_sampled,
+            'bytes_hashed': self.bytes_hashed,
+            'mismatches': self.mismatches,
+        }
+
+
+def collect_checks(verification:AIPVerification, sample:float=None, rng:random.Random=None) -> list:
+    # Walk the root METS and every METS it references, checking existence and size on the way
+    # Returns the (mets path, href, file path, algorithm, expected checksum, size) still to hash
+    aip_path = verification.aip_path
+    hash_jobs = []
+    pending_mets = [(aip_path / 'METS.xml')]
+    seen_mets = set()
+    while pending_mets:
+        mets_path = pending_mets.pop(0)
+        if mets_path in seen_mets:
+            continue
+        seen_mets.add(mets_path)
+        verification.mets_files += 1
+        try:
+            entries = list(iter_mets_files(mets_path))
+        except (OSError, ET.ParseError) as e:
+            verification.mismatch(mets_path, None, 'unreadable-mets', actual=str(e))
+            continue
+        for size, checksum, checksum_type, href in entries:
+            verification.files += 1
+            file_path = resolve_href(aip_path, mets_path.parent, href)
+            if file_path is None:
+                verification.mismatch(mets_path, href, 'outside-aip')
+                continue
+            try:
+                actual_size = file_path.stat().st_size
+            except OSError:
+                verification.mismatch(mets_path, href, 'missing')
+                continue
+            if file_path.name == 'METS.xml' and file_path != mets_path:
+                pending_mets.append(file_path)
+            if size is not None:
+                verification.size_checked += 1
+                if size != str(actual_size):
+                    verification.mismatch(mets_path, href, 'size', size, str(actual_size))
+                    continue
+            if checksum is None:
+                continue
+            algorithm = CHECKSUM_ALGORITHMS.get(checksum_type)
+            if algorithm is None:
+                verification.mismatch(mets_path, href, 'unsupported-checksum-type', checksum_type)
+                continue
+            # METS files are always hashed, other files only when sampled
+            if sample is not None and file_path.name != 'METS.xml' and rng.random() >= sample:
+                verification.not_sampled += 1
+                continue
+            hash_jobs.append((mets_path, href, file_path, algorithm, checksum.lower(), actual_size))
+    return hash_jobs
+
+
+def hash_job(job:tuple) -> tuple:
+    mets_path, href, file_path, algorithm, expected, size = job
+    try:
+        return job, fixity.get_checksums(file_path, (algorithm,))[algorithm], None
+    except OSError as e:
+        return job, None, str(e)
+
+
+def find_aips(paths:list) -> list:
+    # An AIP is a directory with a root METS.xml - any other directory is a shelf of AIPs
+    aip_paths = []
+    for path in paths:
+        path = Path(path).resolve()
+        if (path / 'METS.xml').is_file():
+            aip_paths.append(path)
+        elif path.is_dir():
+            aip_paths.extend(sorted(p for p in path.iterdir() if (p / 'METS.xml').is_file()))
+        else:
+            logging.error("No AIP found at '%s'" % path)
+    return aip_paths
+
+
+def verify_aips(aip_paths:list, workers:int=None, fail_fast:bool=False, sample:float=None, seed:int=None) -> dict:
+    # Checksums of all AIPs share one thread pool, so hashing one AIP overlaps walking the METS of the next
+    workers = workers or fixity.HASH_WORKERS
+    rng = random.Random(seed)
+    verifications = []
+    in_flight = {}
+    failed = False
+    started = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+    start = time.perf_counter()
+
+    def collect(futures):
+        nonlocal failed
+        for future in futures:
+            verification = in_flight.pop(future)
+            (mets_path, href, file_path, algorithm, expected, size), actual, error = future.result()
+            if error is not None:
+                verification.mismatch(mets_path, href, 'unreadable', actual=error)
+            elif actual != expected:
+                verification.mismatch(mets_path, href, 'checksum', expected, actual)
+            else:
+                verification.checksums_verified += 1
+            verification.bytes_hashed += size
+            failed = failed or bool(verification.mismatches)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for aip_path in aip_paths:
+            if fail_fast and failed:
+                break
+            verification = AIPVerification(aip_path)
+            verifications.append(verification)
+            hash_jobs = collect_checks(verification, sample, rng)
+            failed = failed or bool(verification.mismatches)
+            for job in hash_jobs:
+                if fail_fast and failed:
+                    break
+                if len(in_flight) >= workers * QUEUE_DEPTH:
+                    done, pending = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(done)
+                in_flight[executor.submit(hash_job, job)] = verification
+        if fail_fast and failed:
+            for future in in_flight:
+                future.cancel()
+        collect([future for future in list(in_flight) if not future.cancelled()])
+
+    duration = time.perf_counter() - start
+    reports = [verification.report() for verification in verifications]
+    bytes_hashed = sum(report['bytes_hashed'] for report in reports)
+    return {
+        'started': started,
+        'aips': len(reports),
+        'verified': sum(1 for report in reports if report['status'] == 'verified'),
+        'failed': sum(1 for report in reports if report['status'] == 'failed'),
+        'stopped_early': fail_fast and failed and len(reports) < len(aip_paths),
+        'sample': sample,
+        'files': sum(report['files'] for report in reports),
+        'bytes_hashed': bytes_hashed,
+        'duration_seconds': round(duration, 3),
+        'bytes_per_second': round(bytes_hashed / duration) if duration else None,
+        'results': reports,
+    }
+
+
+def main(argv) -> dict:
+    configure_logging()
+
+    parser = argparse.ArgumentParser(prog='verify_aip.py', description="Verify the fixity of AIPs against the SIZE and CHECKSUM in their METS files")
+    parser.add_argument('paths', nargs='+', help="AIP directories, or directories of AIPs")
+    parser.add_argument('--workers', type=int, default=None, help="Hashing threads (default: %d)" % fixity.HASH_WORKERS)
+    parser.add_argument('--fail-fast', action='store_true', help="Stop at the first mismatch")
+    parser.add_argument('--sample', type=float, default=None, help="Only checksum this fraction (0-1) of the payload files, sizes are always checked")
+    parser.add_argument('--seed', type=int, default=None, help="Random seed for --sample")
+    parser.add_argument('--report', default=None, help="Write the JSON report to this file (default: stdout)")
+    args = parser.parse_args(argv)
+
+    if args.sample is not None and not 0 < args.sample <= 1:
+        parser.error("--sample must be between 0 and 1")
+
+    # Audits must read the files - never trust a checksum cache
+    fixity.use_cache(None)
+    io_scheduler.configure_from_environment()
+    metrics.enable_from_environment('verify_aip')
+    try:
+        with metrics.stage('verify'):
+            report = verify_aips(find_aips(args.paths), args.workers, args.fail_fast, args.sample, args.seed)
+    finally:
+        metrics.disable()
+
+    logging.info("Verified %d AIPs: %d failed, %d bytes hashed in %.1fs" % (report['aips'], report['failed'], report['bytes_hashed'], report['duration_seconds']))
+    if args.report:
+        Path(args.report).write_text(json.dumps(report, indent=4), encoding='utf-8')
+    else:
+        print(json.dumps(report, indent=4))
+    return report
+
+
+if __name__ == '__main__':
+    report = main(sys.argv[1:])
+    sys.exit(1 if report['failed'] or not report['aips'] else 0)
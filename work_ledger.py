@@ -0,0 +1,545 @@
+from multiprocessing import Pool
+import multiprocessing
+from pathlib import Path
+import argparse
+import json
+import logging
+import os
+import queue
+import signal
+import socket
+import sys
+import threading
+import time
+import uuid
+import zlib
+
+from aip_container import CONTAINER_FORMATS
+from batch_sip_to_eark_aip import convert_sip
+import dedup_store
+from ingest import INGEST_STRATEGIES
+from ingest_daemon import discard_aip, ignore_interrupts
+from inventory import scan_files
+import io_scheduler
+import metrics
+from sip_to_eark_aip import configure_logging, new_uuid
+import trash
+
+
+LEDGER_DIRECTORY = '.work-ledger'
+# Output subdirectory each node builds its AIPs in, before they are published into the output directory
+WORK_DIRECTORY = '.work'
+# A lease not renewed for this long belongs to a node that has died, and its SIP is taken over
+LEASE_SECONDS = 60
+# SIPs whose conversion took down its node this many times are recorded as failed instead of tried again
+MAX_ATTEMPTS = 3
+
+
+class WorkLedger:
+    # Coordinates nodes converting a shared directory of SIPs, through files on the shared filesystem
+    #   leases/<SIP>.json - held by the node converting the SIP, renewed (touched) by its heartbeat
+    #   done/<SIP>.json   - the outcome, written once by the node holding the lease - the commit point
+    #   nodes/<node>.json - each node's last heartbeat
+    # Records are written to a temporary file and linked into place. link fails if the name exists,
+    # so creating a record is atomic and exclusive and readers never see it half written, on NFS as well.
+    # Lease ages are measured with the filesystem's clock, so nodes' clocks don't have to agree.
+
+    def __init__(self, ledger_path:Path, node:str, lease_seconds:float=LEASE_SECONDS, max_attempts:int=MAX_ATTEMPTS):
+        self.ledger_path = Path(ledger_path)
+        self.node = node
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.leases_path = (self.ledger_path / 'leases')
+        self.done_path = (self.ledger_path / 'done')
+        self.nodes_path = (self.ledger_path / 'nodes')
+        self.temp_path = (self.ledger_path / 'tmp')
+        for path in (self.leases_path, self.done_path, self.nodes_path, self.temp_path):
+            path.mkdir(parents=True, exist_ok=True)
+        self.node_path = (self.nodes_path / (node + '.json'))
+        # {SIP: lease token} of the leases this node holds - the heartbeat thread renews them
+        self._held = {}
+        self._lock = threading.Lock()
+        # Filesystem clock minus this node's clock, measured by every heartbeat
+        self._clock_offset = None
+
+    def lease_path(self, sip:str) -> Path:
+        return (self.leases_path / (sip + '.json'))
+
+    def record_path(self, sip:str) -> Path:
+        return (self.done_path / (sip + '.json'))
+
+    def _temp_file(self, record:dict) -> Path:
+        temp_path = (self.temp_path / ('%s.%s' % (self.node, uuid.uuid4().hex)))
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(record, f)
+            f.flush()
+            os.fsync(f.fileno())
+        return temp_path
+
+    def _create(self, path:Path, record:dict) -> bool:
+        # Exclusive create - False if the record already exists
+        temp_path = self._temp_file(record)
+        try:
+            os.link(temp_path, path)
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            temp_path.unlink()
+
+    @staticmethod
+    def read(path:Path) -> dict:
+        try:
+            with open(path, encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def filesystem_now(self) -> float:
+        # The shared filesystem's current time - file mtimes are set by its clock
+        if self._clock_offset is None:
+            now = time.time()
+            temp_path = self._temp_file({})
+            self._clock_offset = os.stat(temp_path).st_mtime - now
+            temp_path.unlink()
+        return time.time() + self._clock_offset
+
+    def heartbeat_node(self, **status):
+        record = self.read(self.node_path) or {'node': self.node, 'host': socket.gethostname(), 'started': time.time()}
+        record.update(status, pid=os.getpid(), last_seen=time.time())
+        now = time.time()
+        os.replace(self._temp_file(record), self.node_path)
+        os.utime(self.node_path)
+        self._clock_offset = os.stat(self.node_path).st_mtime - now
+
+    def node_alive(self, node:str) -> bool:
+        # Whether a node of this name has renewed its record within a lease period
+        node_path = (self.nodes_path / (node + '.json'))
+        try:
+            return self.filesystem_now() - os.stat(node_path).st_mtime <= self.lease_seconds
+        except FileNotFoundError:
+            return False
+
+    def done_sips(self) -> set:
+        return {name[:-len('.json')] for name in os.listdir(self.done_path) if name.endswith('.json')}
+
+    def _take_away(self, path:Path, keep) -> dict:
+        # Rename path out of the way, then put it back if keep(record, mtime) is False
+        # The rename succeeds for exactly one of the nodes racing for it
+        stale_path = path.with_name('%s.%s.stale' % (path.name, uuid.uuid4().hex))
+        try:
+            os.rename(path, stale_path)
+        except FileNotFoundError:
+            return None
+        record = self.read(stale_path)
+        if keep(record, os.stat(stale_path).st_mtime):
+            stale_path.unlink()
+            return record if record is not None else {}
+        try:
+            os.link(stale_path, path)
+        except FileExistsError:
+            # A new lease already took its place - the old holder finds out at its next heartbeat
+            pass
+        stale_path.unlink()
+        return None
+
+    def _reclaim(self, sip:str) -> dict:
+        # Take over an expired lease, returns its record ({} if there was no lease) or None if it is live
+        lease_path = self.lease_path(sip)
+        try:
+            mtime = os.stat(lease_path).st_mtime
+        except FileNotFoundError:
+            return {}
+        if self.filesystem_now() - mtime <= self.lease_seconds:
+            return None
+        # Renewed between the check and the rename - it goes back
+        record = self._take_away(lease_path, lambda record, stale_mtime: stale_mtime == mtime)
+        if record is not None:
+            logging.warning("Reclaimed '%s' from node '%s', its lease expired" % (sip, record.get('node')))
+        return record
+
+    def claim(self, sip:str, aip_name:str) -> dict:
+        # Take the SIP's lease, returns the lease record or None if the SIP is done or another node holds it
+        if self.record_path(sip).exists():
+            return None
+        stale = self._reclaim(sip)
+        if stale is None:
+            return None
+        attempts = (stale.get('attempts') or 0) + 1
+        lease = {'sip': sip, 'node': self.node, 'token': uuid.uuid4().hex, 'aip': aip_name, 'attempts': attempts, 'acquired': time.time()}
+        if attempts > self.max_attempts:
+            logging.error("Giving up on '%s' after %d attempts" % (sip, attempts - 1))
+            self._create(self.record_path(sip), {'sip': sip, 'aip': stale.get('aip'), 'node': stale.get('node'), 'status': 'failed',
+                                                 'error': "Abandoned after %d attempts" % (attempts - 1), 'attempts': attempts - 1,
+                                                 'finished': time.time()})
+            return None
+        if not self._create(self.lease_path(sip), lease):
+            return None
+        with self._lock:
+            self._held[sip] = lease['token']
+        # The previous holder writes its record before it releases the lease
+        if self.record_path(sip).exists():
+            self.release(sip)
+            return None
+        return lease
+
+    def holds(self, sip:str) -> bool:
+        with self._lock:
+            token = self._held.get(sip)
+        record = self.read(self.lease_path(sip))
+        return token is not None and record is not None and record.get('token') == token
+
+    def renew(self) -> list:
+        # Heartbeat - touch every lease this node still holds, returns the SIPs whose leases were lost
+        lost = []
+        with self._lock:
+            held = list(self._held.items())
+        for sip, token in held:
+            record = self.read(self.lease_path(sip))
+            try:
+                if record is None or record.get('token') != token:
+                    raise FileNotFoundError
+                os.utime(self.lease_path(sip))
+            except FileNotFoundError:
+                lost.append(sip)
+                with self._lock:
+                    self._held.pop(sip, None)
+        self.heartbeat_node(leases=len(held) - len(lost))
+        return lost
+
+    def release(self, sip:str):
+        with self._lock:
+            token = self._held.pop(sip, None)
+        if token is not None:
+            self._take_away(self.lease_path(sip), lambda record, mtime: record is not None and record.get('token') == token)
+
+    def complete(self, sip:str, record:dict) -> bool:
+        # Record the SIP's outcome and release its lease - False if the lease was lost or the SIP already has a record
+        if not self.holds(sip):
+            self.release(sip)
+            return False
+        created = self._create(self.record_path(sip), record)
+        self.release(sip)
+        return created
+
+    def records(self) -> list:
+        return [record for record in (self.read(path) for path in sorted(self.done_path.glob('*.json'))) if record is not None]
+
+    def summary(self, sips:list=None) -> dict:
+        # Outcome counts, live leases and the throughput of every node
+        # sips - the SIP names to convert, to count the ones not started yet
+        records = self.records()
+        leases = [record for record in (self.read(path) for path in self.leases_path.glob('*.json')) if record is not None]
+        node_records = {record['node']: record for record in (self.read(path) for path in self.nodes_path.glob('*.json')) if record is not None}
+        now = time.time()
+        nodes = {}
+        for node in sorted(set(node_records) | {record['node'] for record in records if record.get('node')}):
+            converted = [record for record in records if record.get('node') == node and record['status'] == 'converted']
+            failed = [record for record in records if record.get('node') == node and record['status'] != 'converted']
+            # Over the span from the node's first conversion start to its last finish, on the node's own clock
+            timed = [record for record in converted + failed if record.get('started') is not None]
+            span = max(record['finished'] for record in timed) - min(record['started'] for record in timed) if timed else 0
+            converted_bytes = sum(record.get('bytes') or 0 for record in converted)
+            nodes[node] = {
+                'converted': len(converted),
+                'failed': len(failed),
+                'bytes': converted_bytes,
+                'in_flight': sum(1 for lease in leases if lease.get('node') == node),
+                'sips_per_minute': round(len(converted) * 60 / span, 3) if span else None,
+                'bytes_per_second': round(converted_bytes / span) if span else None,
+                'mean_conversion_seconds': round(sum(record['duration_seconds'] for record in converted) / len(converted), 3) if converted else None,
+                'last_seen_seconds': round(now - node_records[node]['last_seen'], 1) if node in node_records else None,
+            }
+        done = {record['sip'] for record in records}
+        leased = {lease['sip'] for lease in leases} - done
+        return {
+            'ledger': str(self.ledger_path),
+            'converted': sum(1 for record in records if record['status'] == 'converted'),
+            'failed': sum(1 for record in records if record['status'] != 'converted'),
+            'in_flight': len(leased),
+            'pending': len(set(sips) - done - leased) if sips is not None else None,
+            'nodes': nodes,
+        }
+
+
+def publish_aip(work_path:Path, output_path:Path, aip_name:str) -> bool:
+    # Move a finished AIP (directory or container) from a work directory into the output directory
+    # A path gone by the time it is moved has been published by another node recovering it
+    published = False
+    for aip_path in work_path.glob(aip_name + '*'):
+        try:
+            os.replace(aip_path, (output_path / aip_path.name))
+        except FileNotFoundError:
+            continue
+        published = True
+    return published
+
+
+def worker_pid_path(work_path:Path, aip_name:str) -> Path:
+    # Hidden, so publishing and discarding the AIP's paths (aip_name*) leave it alone
+    return (work_path / ('.%s.pid' % aip_name))
+
+
+def convert_leased_sip(job:tuple, pid_path:Path) -> dict:
+    # Runs in a pool worker - the PID file names the worker converting the SIP and is removed once the
+    # conversion has returned, so a PID file left by a process that has gone means the worker died converting it
+    pid_path.write_text(str(os.getpid()))
+    try:
+        return convert_sip(job)
+    finally:
+        pid_path.unlink()
+
+
+class LedgerNode:
+    # One node of a multi-node conversion: claims SIPs from the ledger and converts them on a pool of worker processes
+    # A heartbeat thread renews the node's leases every quarter lease period. The node exits once every SIP
+    # in the source directory has a record - until then it waits, to take over SIPs of nodes that die.
+
+    def __init__(self, ledger:WorkLedger, source_path:Path, output_path:Path, workers:int=None, poll_seconds:float=5,
+                 max_sips_per_worker:int=None, transform_options:dict=None):
+        self.ledger = ledger
+        self.source_path = source_path
+        self.output_path = output_path
+        self.work_path = (output_path / WORK_DIRECTORY / ledger.node)
+        self.workers = workers or os.cpu_count() or 1
+        self.poll_seconds = poll_seconds
+        self.max_sips_per_worker = max_sips_per_worker
+        self.transform_options = transform_options or {}
+        self.results = queue.Queue()
+        # {SIP: lease record plus 'bytes' and 'started'} of conversions running in the pool
+        self.in_flight = {}
+        # SIPs whose lease was lost while they were converted - their AIPs are discarded
+        self.lost = set()
+        # Set once a worker died converting a SIP - the pool then still counts that task as outstanding
+        self.worker_lost = False
+        self.stopping = threading.Event()
+
+    def sip_names(self) -> list:
+        # Every node starts at a different place in the list, so nodes don't all contend for the same SIPs
+        names = sorted(p.name for p in self.source_path.iterdir() if p.is_dir() and not p.name.startswith('.'))
+        if not names:
+            return names
+        offset = zlib.crc32(self.ledger.node.encode('utf-8')) % len(names)
+        return names[offset:] + names[:offset]
+
+    def recover(self):
+        # Publish AIPs recorded as converted by nodes that died before moving them out of their work directory
+        # A live node may be between recording and publishing an AIP, so its AIPs are left to it
+        for record in self.ledger.records():
+            if record['status'] != 'converted' or not record.get('work'):
+                continue
+            if record['node'] != self.ledger.node and self.ledger.node_alive(record['node']):
+                continue
+            if not any(self.output_path.glob(record['aip'] + '*')) and publish_aip(Path(record['work']), self.output_path, record['aip']):
+                logging.info("Published '%s', left in '%s' by node '%s'" % (record['aip'], record['work'], record['node']))
+
+    def heartbeat(self):
+        while not self.stopping.wait(self.ledger.lease_seconds / 4):
+            for sip in self.ledger.renew():
+                logging.warning("Lost the lease of '%s' - another node has taken it over" % sip)
+                self.lost.add(sip)
+
+    def dispatch(self, pool, sips:list):
+        for sip in sips:
+            if len(self.in_flight) >= self.workers or self.stopping.is_set():
+                return
+            if sip in self.in_flight:
+                continue
+            lease = self.ledger.claim(sip, new_uuid())
+            if lease is None:
+                continue
+            sip_path = (self.source_path / sip)
+            lease.update(bytes=sum(size for path, size, mtime in scan_files(sip_path, strict=False)), started=time.time())
+            self.in_flight[sip] = lease
+            logging.info("Claimed '%s' as '%s' (attempt %d)" % (sip, lease['aip'], lease['attempts']))
+            pool.apply_async(convert_leased_sip, ((sip_path, self.work_path, lease['aip'], self.transform_options),
+                                                  worker_pid_path(self.work_path, lease['aip'])),
+                             callback=lambda result, sip=sip: self.results.put((sip, result)),
+                             error_callback=lambda e, sip=sip: self.results.put((sip, {'status': 'failed', 'error': str(e), 'duration_seconds': None})))
+
+    def check_workers(self):
+        # multiprocessing.Pool replaces a worker that is killed (OOM, segfault) but drops its task without a callback
+        # The PID files are read before the live workers are listed: one whose process is gone and whose file is
+        # still there afterwards died before its conversion returned, and the SIP is recorded as failed
+        pids = {}
+        for sip, lease in self.in_flight.items():
+            try:
+                pids[sip] = int(worker_pid_path(self.work_path, lease['aip']).read_text())
+            except (FileNotFoundError, ValueError):
+                continue
+        if not pids:
+            return
+        alive = {process.pid for process in multiprocessing.active_children()}
+        for sip, pid in pids.items():
+            if pid in alive:
+                continue
+            pid_path = worker_pid_path(self.work_path, self.in_flight[sip]['aip'])
+            try:
+                if int(pid_path.read_text()) != pid:
+                    continue
+            except (FileNotFoundError, ValueError):
+                continue
+            pid_path.unlink()
+            self.worker_lost = True
+            logging.error("Worker process %d died converting '%s'" % (pid, sip))
+            self.results.put((sip, {'status': 'failed', 'error': "Worker process %d died during the conversion" % pid, 'duration_seconds': None}))
+
+    def finish(self, sip:str, result:dict):
+        # Commit the outcome, then publish the AIP - a node dying in between leaves it for recover
+        lease = self.in_flight.pop(sip)
+        record = {
+            'sip': sip,
+            'aip': lease['aip'],
+            'node': self.ledger.node,
+            'status': result['status'],
+            'error': result['error'],
+            'attempts': lease['attempts'],
+            'bytes': lease['bytes'],
+            'started': lease['started'],
+            'finished': time.time(),
+            'duration_seconds': result['duration_seconds'],
+            'work': str(self.work_path),
+        }
+        if sip in self.lost or not self.ledger.complete(sip, record):
+            self.lost.discard(sip)
+            logging.warning("Discarding '%s': '%s' was taken over by another node" % (lease['aip'], sip))
+            discard_aip(self.work_path, lease['aip'])
+            return
+        if result['status'] == 'converted':
+            publish_aip(self.work_path, self.output_path, lease['aip'])
+            logging.info("Converted '%s' -> '%s' in %.1fs" % (sip, lease['aip'], result['duration_seconds']))
+        else:
+            discard_aip(self.work_path, lease['aip'])
+            logging.error("Conversion of '%s' failed: %s" % (sip, result['error']))
+
+    def run(self) -> dict:
+        self.ledger.heartbeat_node(workers=self.workers, stopped=None)
+        self.recover()
+        # Anything else in this node's work directory is left by a conversion this node didn't finish
+        if self.work_path.exists():
+            trash.discard(self.work_path, self.output_path)
+        self.work_path.mkdir(parents=True)
+        heartbeat = threading.Thread(target=self.heartbeat, name='heartbeat', daemon=True)
+        heartbeat.start()
+        try:
+            with Pool(processes=self.workers, initializer=ignore_interrupts, maxtasksperchild=self.max_sips_per_worker) as pool:
+                next_scan = 0
+                while True:
+                    if time.monotonic() >= next_scan:
+                        sips = self.sip_names()
+                        done = self.ledger.done_sips()
+                        remaining = [sip for sip in sips if sip not in done]
+                        next_scan = time.monotonic() + self.poll_seconds
+                        if not remaining and not self.in_flight:
+                            break
+                        self.dispatch(pool, remaining)
+                    if self.stopping.is_set() and not self.in_flight:
+                        break
+                    try:
+                        sip, result = self.results.get(timeout=min(self.poll_seconds, 1))
+                    except queue.Empty:
+                        self.check_workers()
+                        continue
+                    self.finish(sip, result)
+                    # A free worker takes the next SIP straight away
+                    next_scan = 0
+                # The task of a worker that died never completes, so pool.join would wait for it forever
+                if self.worker_lost:
+                    pool.terminate()
+                else:
+                    pool.close()
+                pool.join()
+        finally:
+            self.stopping.set()
+            heartbeat.join()
+            self.ledger.heartbeat_node(leases=0, stopped=time.time())
+        return self.ledger.summary(self.sip_names())
+
+    def stop(self, *args):
+        if not self.stopping.is_set():
+            logging.info("Stopping - waiting for %d running conversions" % len(self.in_flight))
+        self.stopping.set()
+
+
+def main(argv) -> dict:
+    configure_logging()
+
+    parser = argparse.ArgumentParser(prog='work_ledger.py', description="Convert a shared directory of SIPs on several nodes, coordinated through a ledger on the shared filesystem")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run', help="Run one node of the conversion")
+    run_parser.add_argument('source', help="Shared directory of SIP directories")
+    run_parser.add_argument('output', help="Shared output directory for the AIPs")
+    run_parser.add_argument('--ledger', default=None, help="Ledger directory, on the shared filesystem (default: <output>/%s)" % LEDGER_DIRECTORY)
+    run_parser.add_argument('--node', default=socket.gethostname(), help="Name of this node, unique among the nodes (default: host name)")
+    run_parser.add_argument('--lease-seconds', type=float, default=LEASE_SECONDS, help="Take over the SIPs of a node silent for this long (default: %d)" % LEASE_SECONDS)
+    run_parser.add_argument('--max-attempts', type=int, default=MAX_ATTEMPTS, help="Record a SIP as failed once this many nodes died converting it (default: %d)" % MAX_ATTEMPTS)
+    run_parser.add_argument('--workers', type=int, default=None, help="Number of worker processes on this node (default: CPU count)")
+    run_parser.add_argument('--max-sips-per-worker', type=int, default=None, help="Replace a worker process after it has converted this many SIPs")
+    run_parser.add_argument('--poll-seconds', type=float, default=5, help="Seconds between scans of the source directory (default: 5)")
+    run_parser.add_argument('--ingest', choices=INGEST_STRATEGIES, default='copy', help="How SIP files are brought into the AIPs (default: copy)")
+    run_parser.add_argument('--container', choices=CONTAINER_FORMATS, default=None, help="Write each AIP as a single ZIP or TAR file")
+    run_parser.add_argument('--store', action='store_true', help="Store ZIP members without compression")
+    run_parser.add_argument('--no-zip64', action='store_true', help="Refuse to write ZIP64 extensions")
+    run_parser.add_argument('--inventory', action='store_true', help="List every payload file with a fresh size and checksum in the rep METS")
+    run_parser.add_argument('--metrics-json', default=None, help="Append per-stage metrics of every SIP as JSON lines to this file")
+    run_parser.add_argument('--metrics-textfile', default=None, help="Write per-stage metrics of the last converted SIP to this Prometheus textfile")
+    io_scheduler.add_arguments(run_parser)
+    summary_parser = subparsers.add_parser('summary', help="Print the progress and per-node throughput as JSON")
+    summary_parser.add_argument('ledger', help="Ledger directory, or the output directory holding %s" % LEDGER_DIRECTORY)
+    summary_parser.add_argument('--source', default=None, help="Shared directory of SIP directories, to count the SIPs not started yet")
+    args = parser.parse_args(argv)
+
+    if args.command == 'summary':
+        ledger_path = Path(args.ledger)
+        if (ledger_path / LEDGER_DIRECTORY).is_dir():
+            ledger_path = (ledger_path / LEDGER_DIRECTORY)
+        if not (ledger_path / 'done').is_dir():
+            sys.exit("Fatal Error: No work ledger found at " + str(ledger_path))
+        sips = None
+        if args.source is not None:
+            sips = [p.name for p in Path(args.source).iterdir() if p.is_dir() and not p.name.startswith('.')]
+        summary = WorkLedger(ledger_path, 'summary').summary(sips)
+        print(json.dumps(summary, indent=4))
+        return summary
+
+    source_path, output_path = Path(args.source).resolve(), Path(args.output).resolve()
+    if not source_path.is_dir():
+        logging.error("Source must be a directory")
+        sys.exit("Fatal Error: Source must be a directory")
+    output_path.mkdir(parents=True, exist_ok=True)
+    ledger = WorkLedger(Path(args.ledger) if args.ledger else (output_path / LEDGER_DIRECTORY), args.node, args.lease_seconds, args.max_attempts)
+    record = ledger.read(ledger.node_path)
+    if ledger.node_alive(args.node) and record is not None and record.get('stopped') is None:
+        logging.error("Node '%s' is already running" % args.node)
+        sys.exit("Fatal Error: Node '%s' is already running - every node needs its own --node name" % args.node)
+
+    # Workers pick the metrics outputs up from their inherited environment
+    if args.metrics_json:
+        os.environ[metrics.JSON_ENVIRONMENT_VARIABLE] = str(Path(args.metrics_json).resolve())
+    if args.metrics_textfile:
+        os.environ[metrics.TEXTFILE_ENVIRONMENT_VARIABLE] = str(Path(args.metrics_textfile).resolve())
+
+    # The I/O budgets are per node - each node's workers share them through state files of their own
+    io_scheduler.apply_arguments(args, (output_path / io_scheduler.SCHEDULER_DIRECTORY / args.node))
+
+    # AIPs are built in the node's work directory, but their dedup store belongs to the output directory
+    os.environ.setdefault(dedup_store.STORE_ENVIRONMENT_VARIABLE, str(output_path / dedup_store.STORE_DIRECTORY))
+
+    transform_options = {
+        'ingest_strategy': args.ingest,
+        'container_format': args.container,
+        'compress': not args.store,
+        'zip64': not args.no_zip64,
+        'payload_inventory': args.inventory,
+    }
+    node = LedgerNode(ledger, source_path, output_path, args.workers, args.poll_seconds, args.max_sips_per_worker, transform_options)
+    signal.signal(signal.SIGINT, node.stop)
+    signal.signal(signal.SIGTERM, node.stop)
+    summary = node.run()
+    print(json.dumps(summary, indent=4))
+    return summary
+
+
+if __name__ == '__main__':
+    summary = main(sys.argv[1:])
+    sys.exit(1 if summary['failed'] else 0)
@@ -0,0 +1,94 @@
+from pathlib import Path
+import importlib.util
+import os
+import threading
+import xml.etree.ElementTree as ElementTree
+
+
+# lxml (C parsing) when installed, ElementTree otherwise - both are written out by ElementTree, see write
+# XML_BACKEND=etree forces ElementTree even when lxml is available
+# lxml is only imported by the first call that needs it, so scripts that never touch XML start faster
+BACKENDS = ('lxml', 'etree')
+BACKEND = 'lxml' if importlib.util.find_spec('lxml') is not None and os.environ.get('XML_BACKEND', 'lxml') != 'etree' else 'etree'
+
+INDENT = '    '
+
+_lxml_etree = None
+# Namespaces registered so far, replayed into lxml's registry when it is imported
+_registered_namespaces = {}
+_lxml_lock = threading.Lock()
+
+
+def _lxml():
+    global _lxml_etree
+    if _lxml_etree is None:
+        with _lxml_lock:
+            if _lxml_etree is None:
+                from lxml import etree as lxml_etree
+                for prefix, uri in _registered_namespaces.items():
+                    lxml_etree.register_namespace(prefix, uri)
+                _lxml_etree = lxml_etree
+    return _lxml_etree
+
+
+def _etree():
+    return _lxml() if BACKEND == 'lxml' else ElementTree
+
+
+def use_backend(name:str):
+    global BACKEND
+    if name not in BACKENDS:
+        raise ValueError("Unknown XML backend '%s'" % name)
+    if name == 'lxml':
+        # Raises ImportError if lxml is not installed
+        _lxml()
+    BACKEND = name
+
+
+def iter_namespaces(path:Path):
+    # (prefix, uri) for every namespace declaration in the document, '' for the default namespace
+    for _, (prefix, uri) in _etree().iterparse(str(path), events=('start-ns',)):
+        yield prefix or '', uri
+
+
+def register_namespace(prefix:str, uri:str):
+    # ElementTree picks output prefixes from its global registry; lxml keeps document prefixes
+    # and only consults its registry for namespaces not declared in scope
+    ElementTree.register_namespace(prefix, uri)
+    if prefix:
+        with _lxml_lock:
+            _registered_namespaces[prefix] = uri
+            if _lxml_etree is not None:
+                _lxml_etree.register_namespace(prefix, uri)
+
+
+def parse(path:Path):
+    if BACKEND == 'lxml':
+        # Comments and processing instructions are dropped, as ElementTree does
+        lxml_etree = _lxml()
+        parser = lxml_etree.XMLParser(remove_comments=True, remove_pis=True, huge_tree=True)
+        return lxml_etree.parse(str(path), parser)
+    return ElementTree.parse(path)
+
+
+def Element(tag:str, attrib:dict={}, **extra):
+    return _etree().Element(tag, attrib, **extra)
+
+
+def SubElement(parent, tag:str, attrib:dict={}, **extra):
+    return _etree().SubElement(parent, tag, attrib, **extra)
+
+
+def write(tree, path:Path, indent:bool=True):
+    # Serialize with an XML declaration, optionally indented with four spaces
+    # lxml trees are serialized by ElementTree too, so the bytes of a file don't depend on the backend and
+    # lxml only speeds up parsing and indenting, not writing:
+    # lxml would write another XML declaration and '/>' for empty elements, and keep namespace declarations
+    # where the source had them rather than on the root, prefixed as registered
+    if BACKEND == 'lxml':
+        tree = ElementTree.ElementTree(tree.getroot())
+        if indent:
+            _lxml().indent(tree.getroot(), space=INDENT)
+    elif indent:
+        ElementTree.indent(tree, space=INDENT, level=0)
+    tree.write(path, encoding='utf-8', xml_declaration=True)
@@ -0,0 +1,177 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import argparse
+import json
+import lzma
+import struct
+import sys
+import zipfile
+import zlib
+
+import fixity
+import io_scheduler
+
+
+# End of central directory record, ZIP64 end record and ZIP64 end locator (APPNOTE 4.3.14 - 4.3.16)
+END_RECORD = struct.Struct('<4s4H2LH')
+ZIP64_END_RECORD = struct.Struct('<4sQ2H2L4Q')
+ZIP64_LOCATOR = struct.Struct('<4sLQL')
+END_SIGNATURE = b'PK\x05\x06'
+ZIP64_END_SIGNATURE = b'PK\x06\x06'
+ZIP64_LOCATOR_SIGNATURE = b'PK\x06\x07'
+# Smallest local file header - signature, fixed fields and no name or extra field
+LOCAL_HEADER_SIZE = 30
+# Members decompressed to check their CRCs are read this much at a time
+CRC_BUFFER_SIZE = 64 * 1024
+# Compression methods zipfile can read
+SUPPORTED_COMPRESSION = (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED, zipfile.ZIP_BZIP2, zipfile.ZIP_LZMA)
+
+
+def read_end_records(f, file_size:int) -> dict:
+    # Locate and cross-check the end of central directory record and, when present, the ZIP64 end record
+    tail_size = min(file_size, END_RECORD.size + 0xFFFF)
+    f.seek(file_size - tail_size)
+    tail = f.read(tail_size)
+    # The last signature whose comment length reaches exactly to the end of the file
+    position = tail.rfind(END_SIGNATURE)
+    while position != -1:
+        if position + END_RECORD.size <= len(tail):
+            fields = END_RECORD.unpack_from(tail, position)
+            if position + END_RECORD.size + fields[7] == len(tail):
+                break
+        position = tail.rfind(END_SIGNATURE, 0, position)
+    if position == -1:
+        raise zipfile.BadZipFile("No end of central directory record at the end of the file - it is truncated, has trailing data or is not a zip")
+    _, disk, directory_disk, disk_entries, entries, directory_size, directory_offset, _ = END_RECORD.unpack_from(tail, position)
+    end_offset = file_size - tail_size + position
+    if disk != 0 or directory_disk != 0 or disk_entries != entries:
+        raise zipfile.BadZipFile("Multi-disk zips are not supported")
+
+    records = {'entries': entries, 'directory_size': directory_size, 'directory_offset': directory_offset,
+               'directory_end': end_offset, 'zip64': False}
+    saturated = entries == 0xFFFF or directory_size == 0xFFFFFFFF or directory_offset == 0xFFFFFFFF
+    locator_offset = end_offset - ZIP64_LOCATOR.size
+    locator = None
+    if locator_offset >= 0:
+        f.seek(locator_offset)
+        data = f.read(ZIP64_LOCATOR.size)
+        if data[:4] == ZIP64_LOCATOR_SIGNATURE:
+            locator = ZIP64_LOCATOR.unpack(data)
+    if locator is None:
+        if saturated:
+            raise zipfile.BadZipFile("End of central directory record needs ZIP64 but there is no ZIP64 end locator")
+        return records
+
+    _, locator_disk, zip64_end_offset, disks = locator
+    if locator_disk != 0 or disks > 1:
+        raise zipfile.BadZipFile("Multi-disk zips are not supported")
+    if zip64_end_offset + ZIP64_END_RECORD.size > locator_offset:
+        raise zipfile.BadZipFile("ZIP64 end locator points past itself")
+    f.seek(zip64_end_offset)
+    data = f.read(ZIP64_END_RECORD.size)
+    if len(data) != ZIP64_END_RECORD.size or data[:4] != ZIP64_END_SIGNATURE:
+        raise zipfile.BadZipFile("ZIP64 end locator doesn't point at a ZIP64 end record")
+    _, record_size, _, _, disk, directory_disk, disk_entries64, entries64, directory_size64, directory_offset64 = ZIP64_END_RECORD.unpack(data)
+    if zip64_end_offset + 12 + record_size != locator_offset:
+        raise zipfile.BadZipFile("ZIP64 end record size doesn't match its locator")
+    if disk != 0 or directory_disk != 0 or disk_entries64 != entries64:
+        raise zipfile.BadZipFile("Multi-disk zips are not supported")
+    # Fields that aren't saturated must agree with the ZIP64 values
+    for name, value, value64, limit in [('entry count', entries, entries64, 0xFFFF),
+                                        ('central directory size', directory_size, directory_size64, 0xFFFFFFFF),
+                                        ('central directory offset', directory_offset, directory_offset64, 0xFFFFFFFF)]:
+        if value != limit and value != value64:
+            raise zipfile.BadZipFile("ZIP64 %s %d doesn't match the end record's %d" % (name, value64, value))
+    records.update({'entries': entries64, 'directory_size': directory_size64, 'directory_offset': directory_offset64,
+                    'directory_end': zip64_end_offset, 'zip64': True})
+    return records
+
+
+def check_members(infos:list, directory_offset:int):
+    # Member data must lie before the central directory without overlapping, with no unresolved ZIP64 fields
+    previous_end = 0
+    names = set()
+    for info in sorted(infos, key=lambda info: info.header_offset):
+        for field in ('file_size', 'compress_size', 'header_offset'):
+            if getattr(info, field) == 0xFFFFFFFF:
+                raise zipfile.BadZipFile("'%s' has no ZIP64 extra field for its %s" % (info.filename, field))
+        if info.flag_bits & 0x1:
+            raise zipfile.BadZipFile("'%s' is encrypted" % info.filename)
+        if info.compress_type not in SUPPORTED_COMPRESSION:
+            raise zipfile.BadZipFile("'%s' uses unsupported compression method %d" % (info.filename, info.compress_type))
+        if info.header_offset < previous_end:
+            raise zipfile.BadZipFile("'%s' overlaps the member before it" % info.filename)
+        previous_end = info.header_offset + LOCAL_HEADER_SIZE + len(info.orig_filename.encode('utf-8' if info.flag_bits & 0x800 else 'cp437')) + info.compress_size
+        if previous_end > directory_offset:
+            raise zipfile.BadZipFile("'%s' runs into the central directory" % info.filename)
+        if info.filename in names:
+            raise zipfile.BadZipFile("'%s' appears more than once" % info.filename)
+        names.add(info.filename)
+
+
+def _check_crc(archive:zipfile.ZipFile, info:zipfile.ZipInfo):
+    # zipfile compares the CRC once the member has been read to the end, raising BadZipFile on a mismatch
+    # Each read takes the archive's file lock only while it reads, decompression runs in parallel
+    # A corrupt compressed stream fails in the decompressor instead, and is reported the same way
+    io_scheduler.read(info.compress_size)
+    try:
+        with archive.open(info) as member:
+            while member.read(CRC_BUFFER_SIZE):
+                pass
+    except (zlib.error, lzma.LZMAError) as e:
+        raise zipfile.BadZipFile("'%s' can't be decompressed: %s" % (info.filename, e)) from e
+
+
+def check_zip(zip_path:Path, verify_crc:bool=False, workers:int=None) -> dict:
+    # Pre-flight check of a zip from its central directory, without extracting anything
+    # verify_crc - also decompress every member (in parallel, memory bounded) and check its CRC-32
+    # Returns the member count and sizes, raises zipfile.BadZipFile on the first problem
+    zip_path = Path(zip_path)
+    file_size = zip_path.stat().st_size
+    with open(zip_path, 'rb') as f:
+        records = read_end_records(f, file_size)
+    if records['directory_offset'] + records['directory_size'] != records['directory_end']:
+        raise zipfile.BadZipFile("Central directory (offset %d, size %d) doesn't end where the end record starts (%d)"
+                                 % (records['directory_offset'], records['directory_size'], records['directory_end']))
+    with zipfile.ZipFile(zip_path) as archive:
+        infos = archive.infolist()
+        if len(infos) != records['entries']:
+            raise zipfile.BadZipFile("End record lists %d entries, the central directory has %d" % (records['entries'], len(infos)))
+        check_members(infos, records['directory_offset'])
+        files = [info for info in infos if not info.is_dir()]
+        if verify_crc and files:
+            with ThreadPoolExecutor(max_workers=min(workers or fixity.HASH_WORKERS, len(files))) as executor:
+                for _ in executor.map(lambda info: _check_crc(archive, info), files):
+                    pass
+    return {
+        'members': len(infos),
+        'files': len(files),
+        'uncompressed_size': sum(info.file_size for info in files),
+        'compressed_size': sum(info.compress_size for info in files),
+        'zip64': records['zip64'] or any(info.file_size >= zipfile.ZIP64_LIMIT or info.compress_size >= zipfile.ZIP64_LIMIT
+                                         or info.header_offset >= zipfile.ZIP64_LIMIT for info in infos),
+        'crc_checked': verify_crc,
+    }
+
+
+def main(argv) -> int:
+    parser = argparse.ArgumentParser(prog='zip_preflight.py', description="Check zips from their central directory without extracting them")
+    parser.add_argument('zips', nargs='+', help="Zip files to check")
+    parser.add_argument('--crc', action='store_true', help="Also decompress every member and check its CRC-32")
+    parser.add_argument('--workers', type=int, default=None, help="Threads checking CRCs (default: %d)" % fixity.HASH_WORKERS)
+    args = parser.parse_args(argv)
+
+    io_scheduler.configure_from_environment()
+    results, failed = {}, 0
+    for zip_path in args.zips:
+        try:
+            results[zip_path] = check_zip(Path(zip_path), args.crc, args.workers)
+        except (zipfile.BadZipFile, OSError, EOFError) as e:
+            results[zip_path] = {'error': str(e)}
+            failed += 1
+    print(json.dumps(results, indent=4))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))